@@ -0,0 +1,926 @@
+# Micro-benchmarks for the declarative nodes and normalised cuts
+#
+# Usage: python benchmark.py [name ...] (runs all benchmarks if no names given)
+#        python benchmark.py suite --json results.json [--grid full] (the suite, saved with the environment)
+#        python benchmark.py --compare old.json new.json (flags regressions between two suite results)
+import argparse, json, os, sys, time, warnings
+
+import torch
+from torch.autograd import grad
+
+# local imports
+import profiling
+from node import DeclarativeLayer
+from nc import NormalizedCuts, EigenvectorCache, de_minW, old_de_minW, manual_weight, old_manual_weight, partition, old_partition
+
+def timeit(func, repeats=3):
+    """Returns the best wall time (in seconds) of repeats calls to func, and its last output"""
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        output = func()
+        best = min(best, time.perf_counter() - start)
+    return best, output
+
+def random_affinity(b, N, dtype=torch.double, seed=0):
+    """Random symmetric positive (b, N, N) affinity matrices"""
+    generator = torch.Generator().manual_seed(seed)
+    A = torch.rand((b, N, N), dtype=dtype, generator=generator)
+    return A @ A.mT
+
+def rectangle_images(b, size, noise=0.05, dtype=torch.float, seed=0):
+    """(b, size, size) random rectangles on a blank background (like the simple01 dataset), plus gaussian noise"""
+    generator = torch.Generator().manual_seed(seed)
+    images = torch.zeros((b, size, size), dtype=dtype)
+    for image in images:
+        x0, y0 = torch.randint(0, size // 2, (2,), generator=generator)
+        x1, y1 = torch.randint(size // 2 + 1, size + 1, (2,), generator=generator)
+        image[x0:x1, y0:y1] = 1
+    return images + noise * torch.randn(images.shape, dtype=dtype, generator=generator)
+
+def image_affinity(b, size, radius=3, sigma_I=0.1, sigma_X=4.0, dtype=torch.float, seed=0):
+    """
+    (b, N, N) affinities of noisy random rectangle images (like the simple01 dataset),
+    W_ij = exp(-|I_i - I_j|^2 / sigma_I) * exp(-|X_i - X_j|^2 / sigma_X) for pixels within radius
+    """
+    I = rectangle_images(b, size, dtype=dtype, seed=seed).reshape(b, -1)
+    X = torch.stack(torch.meshgrid(torch.arange(size), torch.arange(size), indexing='ij'), dim=-1).reshape(-1, 2).to(dtype)
+    dist = torch.cdist(X, X) ** 2
+    W = torch.exp(-(I.unsqueeze(-1) - I.unsqueeze(-2)) ** 2 / sigma_I) * torch.exp(-dist / sigma_X)
+    return W * (dist <= radius ** 2)
+
+def image_band(b, size, r=None, sigma_I=0.1, dtype=torch.double, seed=0):
+    """
+    (b, r, N) minVer style bands of noisy random rectangle images, W_u,u+i = exp(-|I_u - I_u+i|^2 / sigma_I)
+    for the r (default size, so vertical neighbours are connected) diagonals above the main one
+    """
+    r = r or size
+    I = rectangle_images(b, size, dtype=dtype, seed=seed).reshape(b, -1)
+    N = size * size
+    band = torch.zeros((b, r, N), dtype=dtype)
+    for i in range(1, r + 1):
+        band[:, i-1, :N-i] = torch.exp(-(I[:, :N-i] - I[:, i:]) ** 2 / sigma_I)
+    return band
+
+def bench_jacobian(sizes=(4, 8, 16), b=4, repeats=3):
+    """
+    Compare the looped and vectorized AbstractDeclarativeNode._batch_jacobian
+    on the normalized cuts fYY (m x m) and fXY (m x N^2) Jacobians, for m = size^2
+    """
+    print(f'{"m":>6} {"jacobian":>8} {"loop (s)":>10} {"vmap (s)":>10} {"speedup":>8} {"max diff":>10}')
+    for size in sizes:
+        N = size * size
+        A = random_affinity(b, N)
+        node = NormalizedCuts(eps=1e-3)
+        y, _ = node.solve(A)
+        y = y.detach().requires_grad_(True)
+        A.requires_grad_(True)
+        node.b, node.m = b, N
+
+        f = node.objective(A, y=y)
+        fY = grad(f, y, grad_outputs=torch.ones_like(f), create_graph=True)[0].reshape(b, -1)
+
+        for name, x in (('fYY', y), ('fXY', A)):
+            times, outputs = [], []
+            for vectorize in (False, True):
+                node.vectorize = vectorize
+                node._batch_jacobian(fY, x) # warm up (vmap compiles its batching rules on first use)
+                t, jacobian = timeit(lambda: node._batch_jacobian(fY, x), repeats)
+                times.append(t)
+                outputs.append(jacobian)
+            diff = (outputs[0] - outputs[1]).abs().max().item()
+            print(f'{N:>6} {name:>8} {times[0]:>10.4f} {times[1]:>10.4f} {times[0]/times[1]:>7.1f}x {diff:>10.2e}')
+
+def bench_full_jacobian(sizes=(4, 8, 16), b=1, loop_max=8, repeats=1):
+    """
+    Compare the full normalized cuts Jacobian dy/dA as one vector--Jacobian product per output (the loop)
+    against factorizing once (the generic -H^-1 fXY of the objective, and the analytic bordered system),
+    for size x size images (the loop only up to loop_max, it takes minutes at 16x16)
+    """
+    print(f'{"size":>5} {"method":>13} {"time (s)":>10} {"max diff":>10}')
+    for size in sizes:
+        N = size * size
+        A = image_affinity(b, size, dtype=torch.double).requires_grad_(True)
+        for analytic in (False, True):
+            node = NormalizedCuts(analytic_gradient=analytic, gamma=None if analytic else 1.0, eps=1e-3)
+            y, ctx = node.solve(A)
+            t_new, (J_new,) = timeit(lambda: node.jacobian(A, y=y, ctx=ctx), repeats)
+            name = 'analytic' if analytic else 'generic'
+            if size <= loop_max:
+                t_loop, (J_loop,) = timeit(lambda: node._jacobian_from_gradients(A, y=y, ctx=ctx), repeats)
+                diff = (J_new - J_loop).abs().max().item()
+                print(f'{size:>5} {name+" loop":>13} {t_loop:>10.4f}')
+                print(f'{size:>5} {name:>13} {t_new:>10.4f} {diff:>10.2e}')
+            else:
+                print(f'{size:>5} {name:>13} {t_new:>10.4f}')
+
+def bench_linear_solver(b=256, m=64, repeats=3):
+    """
+    Compare AbstractDeclarativeNode._solve_linear_system (batched Cholesky, then batched LU / pseudo-inverse
+    for only the failing samples) against the previous fallback (a loop over the whole batch once any sample
+    fails Cholesky), for b (m x m) systems with some indefinite and singular samples
+    """
+    from node import AbstractDeclarativeNode
+    def looped_solve(A, B):
+        try:
+            return torch.cholesky_solve(B, torch.linalg.cholesky(A, upper=False), upper=False)
+        except RuntimeError:
+            X = torch.zeros_like(B)
+            for i in range(A.size(0)):
+                try:
+                    X[i] = torch.cholesky_solve(B[i], torch.linalg.cholesky(A[i], upper=False), upper=False)
+                except RuntimeError:
+                    X[i] = torch.linalg.solve(A[i], B[i])
+            return X
+
+    generator = torch.Generator().manual_seed(0)
+    P = torch.randn((b, m, m), dtype=torch.double, generator=generator)
+    B = torch.randn((b, m, 1), dtype=torch.double, generator=generator)
+    print(f'{"indefinite":>10} {"singular":>9} {"loop (s)":>10} {"batched (s)":>12} {"speedup":>8} {"residual":>10}  paths')
+    for indefinite, singular in ((0, 0), (1, 0), (b // 2, 0), (b, 0), (1, 1)):
+        A = P @ P.mT + torch.eye(m, dtype=torch.double)
+        A[:indefinite] -= 2 * m * torch.eye(m, dtype=torch.double) # indefinite, but not singular
+        A[b-singular:] = P[b-singular:, :, :m//2] @ P[b-singular:, :, :m//2].mT # rank m/2
+        node = AbstractDeclarativeNode()
+        t_batched, X = timeit(lambda: node._solve_linear_system(A, B), repeats)
+        residual = (A[:b-singular] @ X[:b-singular] - B[:b-singular]).abs().max().item() # singular ones are least squares
+        if singular == 0:
+            t_loop, _ = timeit(lambda: looped_solve(A, B), repeats)
+            loop = f'{t_loop:>10.4f} {"":>12} {t_loop / t_batched:>7.1f}x'
+        else: # the loop raises for singular samples
+            loop = f'{"fails":>10} {"":>12} {"":>8}'
+        paths = {name: count // repeats for name, count in node.solver_stats.items()}
+        print(f'{indefinite:>10} {singular:>9} {loop[:10]} {t_batched:>12.4f} {loop[-8:]} {residual:>10.2e}  {paths}')
+
+def bench_constrained(batch_sizes=(8, 32, 128), n=32, repeats=3):
+    """
+    Compare the IneqConstDeclarativeNode gradient as one masked (padded active set) solve for the batch
+    against one solve per subset with the same number of active constraints (the previous approach),
+    on euclidean projection onto the simplex (y >= 0, sum y = 1) with a closed form Jacobian
+    """
+    from node import IneqConstDeclarativeNode
+    class Simplex(IneqConstDeclarativeNode):
+        def objective(self, x, y):
+            return 0.5 * ((y - x) ** 2).sum(-1)
+        def equality_constraints(self, x, y):
+            return y.sum(-1) - 1
+        def inequality_constraints(self, x, y):
+            return -y
+        def solve(self, x): # sort based projection
+            u = x.detach().sort(dim=-1, descending=True)[0]
+            css = u.cumsum(-1) - 1
+            rho = ((u - css / torch.arange(1, x.size(-1) + 1, dtype=x.dtype)) > 0).long().cumsum(-1).argmax(-1, keepdim=True)
+            return (x.detach() - css.gather(-1, rho) / (rho + 1)).clamp(min=0).requires_grad_(True), None
+
+    print(f'{"b":>5} {"subsets":>8} {"subsets (s)":>12} {"masked (s)":>11} {"speedup":>8} {"max error":>10}')
+    for b in batch_sizes:
+        generator = torch.Generator().manual_seed(0)
+        x = (torch.randn((b, n), dtype=torch.double, generator=generator) * 3 * torch.rand((b, 1), dtype=torch.double, generator=generator)).requires_grad_(True)
+        v = torch.randn((b, n), dtype=torch.double, generator=generator)
+        node = Simplex(eps=1e-9)
+        y, _ = node.solve(x)
+        support = (y > 0).to(x.dtype)
+        exact = support * v - support * (support * v).sum(-1, keepdim=True) / support.sum(-1, keepdim=True)
+
+        def subsets():
+            gradient = torch.zeros_like(x)
+            for count in support.sum(-1).unique():
+                indices = (support.sum(-1) == count).nonzero().squeeze(-1)
+                gradient[indices] = node.gradient(x[indices].detach().requires_grad_(True), y=y[indices].detach().requires_grad_(True), v=v[indices])[0]
+            return gradient
+        t_subsets, _ = timeit(subsets, repeats)
+        t_masked, (gradient,) = timeit(lambda: node.gradient(x, y=y, v=v), repeats)
+        error = (gradient - exact).abs().max().item()
+        print(f'{b:>5} {len(support.sum(-1).unique()):>8} {t_subsets:>12.4f} {t_masked:>11.4f} {t_subsets / t_masked:>7.1f}x {error:>10.2e}')
+
+def bench_matrix_free(sizes=(4, 8, 16), b=2, gamma=5.0, repeats=3):
+    """
+    Compare the dense and matrix-free (cg, minres) AbstractDeclarativeNode.gradient
+    on normalized cuts (damped by gamma so that H is positive definite), for m = size^2
+    """
+    print(f'{"m":>6} {"mode":>8} {"time (s)":>10} {"max diff":>10} {"fYY+fXY (MB)":>13}')
+    for size in sizes:
+        N = size * size
+        A = random_affinity(b, N)
+        v = torch.randn((b, size, size), dtype=A.dtype, generator=torch.Generator().manual_seed(1))
+        dense_mb = b * N * (N + N * N) * A.element_size() / 2**20
+        reference = None
+        for mode in (None, 'cg', 'minres'):
+            node = NormalizedCuts(eps=1e-3, gamma=gamma, matrix_free=mode, analytic_gradient=False)
+            y, _ = node.solve(A)
+            y = y.detach().requires_grad_(True)
+            t, (gradient,) = timeit(lambda: node.gradient(A.requires_grad_(True), y=y, v=v), repeats)
+            reference = gradient if reference is None else reference
+            diff = (gradient - reference).abs().max().item()
+            print(f'{N:>6} {str(mode):>8} {t:>10.4f} {diff:>10.2e} {dense_mb if mode is None else 0:>13.1f}')
+
+def bench_nc_gradient(sizes=(4, 8, 16), b=2, repeats=3):
+    """
+    Compare the generic (fYY, fXY of the objective) and analytic (eigenvector derivative)
+    NormalizedCuts.gradient, for N = size^2 (the two differentiate different problems, so only time is compared)
+    """
+    print(f'{"N":>6} {"generic (s)":>12} {"analytic (s)":>13} {"speedup":>8}')
+    for size in sizes:
+        N = size * size
+        A = random_affinity(b, N)
+        v = torch.randn((b, size, size), dtype=A.dtype, generator=torch.Generator().manual_seed(1))
+        times = []
+        for analytic_gradient in (False, True):
+            node = NormalizedCuts(eps=1e-3, analytic_gradient=analytic_gradient, vectorize=False)
+            y, ctx = node.solve(A)
+            y = y.detach().requires_grad_(True)
+            t, _ = timeit(lambda: node.gradient(A.requires_grad_(True), y=y, v=v, ctx=ctx), repeats)
+            times.append(t)
+        print(f'{N:>6} {times[0]:>12.4f} {times[1]:>13.4f} {times[0]/times[1]:>7.1f}x')
+
+def bench_profile(sizes=(4, 8), b=2, repeats=3):
+    """
+    Time a forward and backward pass through a NormalizedCuts layer (generic gradient, fYY and fXY) with profiling disabled and
+    enabled (the overhead of the phase hooks), and print the phases of the profiled passes of the largest size
+    """
+    print(f'{"N":>6} {"disabled (s)":>13} {"enabled (s)":>12} {"overhead":>9}')
+    for size in sizes:
+        A = random_affinity(b, size * size)
+        v = torch.randn((b, size, size), dtype=A.dtype, generator=torch.Generator().manual_seed(1))
+        layer = DeclarativeLayer(NormalizedCuts(eps=1e-3, analytic_gradient=False, vectorize=False))
+        def step():
+            A.grad = None
+            (layer(A.requires_grad_(True)) * v).sum().backward()
+        t_disabled, _ = timeit(step, repeats)
+        profiler = profiling.enable()
+        t_enabled, _ = timeit(step, repeats)
+        profiling.disable()
+        print(f'{size*size:>6} {t_disabled:>13.4f} {t_enabled:>12.4f} {t_enabled/t_disabled - 1:>8.1%}')
+    print(profiler)
+
+def bench_precision(sizes=(16, 32), b=8, repeats=3):
+    """
+    Compare NormalizedCuts precision policies (solve_dtype, refine) for float32 image affinities: time of solve and
+    gradient, and the errors of the Fiedler vector (1-|cos|) and the gradient (relative) against a float64 solve
+    """
+    print(f'{"N":>6} {"solver":>6} {"solve dtype":>12} {"refine":>6} {"solve (s)":>10} {"grad (s)":>9} {"1-|cos|":>10} {"grad err":>9}')
+    for size in sizes:
+        A = image_affinity(b, size)
+        v = torch.randn((b, size, size), generator=torch.Generator().manual_seed(0))
+        reference = NormalizedCuts()
+        A_ref = A.double().requires_grad_(True)
+        y_ref, ctx_ref = reference.solve(A_ref)
+        g_ref, = reference.gradient(A_ref, y=y_ref, v=v.double(), ctx=ctx_ref)
+        for eig_solver in ('scipy', 'eigh'):
+            for solve_dtype, refine in ((None, 0), (None, 1), (None, 2), (torch.double, 0)):
+                node = NormalizedCuts(eig_solver=eig_solver, solve_dtype=solve_dtype, refine=refine)
+                A.requires_grad_(True)
+                t_solve, (y, ctx) = timeit(lambda: node.solve(A), repeats)
+                t_grad, (g,) = timeit(lambda: node.gradient(A, y=y, v=v, ctx=ctx), repeats)
+                cos = torch.einsum('bij,bij->b', y.double(), y_ref)
+                g_err = (g.double() - cos.sign().view(-1, 1, 1) * g_ref).norm() / g_ref.norm() # the sign of y is arbitrary
+                dtype = str(solve_dtype or A.dtype).replace('torch.', '')
+                print(f'{size*size:>6} {eig_solver:>6} {dtype:>12} {refine:>6} {t_solve:>10.4f} {t_grad:>9.4f} {(1 - cos.abs()).max().item():>10.2e} {g_err.item():>9.2e}')
+
+def _recursive_bipartitions(A, k):
+    """k segments of each (N, N) affinity of A by recursively bipartitioning the largest segment (k - 1 Fiedler solves)"""
+    import numpy as np
+    from scipy import linalg
+    for a in A.numpy():
+        segments = [np.arange(len(a))]
+        while len(segments) < k:
+            segment = segments.pop(max(range(len(segments)), key=lambda i: len(segments[i])))
+            W = a[np.ix_(segment, segment)]
+            _, v = linalg.eigh(np.diag(W.sum(0)) - W, check_finite=False, subset_by_index=[0, 1], driver='evr')
+            split = v[:, 1] > np.median(v[:, 1])
+            segments += [segment[split], segment[~split]]
+
+def bench_k_way(sizes=(16, 32), b=4, k=4, repeats=3):
+    """
+    Compare k-way NormalizedCuts (eigenvectors 2 to k from one partial eigendecomposition, its solve and gradient)
+    against the k - 1 Fiedler solves of recursively bipartitioning into k segments (solve only)
+    """
+    print(f'{"N":>6} {"k":>3} {"k-way solve (s)":>16} {"k-way grad (s)":>15} {"recursive (s)":>14} {"speedup":>8}')
+    for size in sizes:
+        A = image_affinity(b, size, dtype=torch.double)
+        v = torch.randn((b, k - 1, size, size), dtype=A.dtype, generator=torch.Generator().manual_seed(1))
+        node = NormalizedCuts(k=k - 1)
+        t_solve, (y, ctx) = timeit(lambda: node.solve(A), repeats)
+        t_grad, _ = timeit(lambda: node.gradient(A.requires_grad_(True), y=y, v=v, ctx=ctx), repeats)
+        t_recursive, _ = timeit(lambda: _recursive_bipartitions(A.detach(), k), repeats)
+        print(f'{size*size:>6} {k:>3} {t_solve:>16.4f} {t_grad:>15.4f} {t_recursive:>14.4f} {t_recursive/t_solve:>7.1f}x')
+
+def bench_partition(sizes=(16, 32), batch_sizes=(8, 64), repeats=3):
+    """
+    Compare the looped (old_partition) and batched mean threshold partition of Fiedler vectors, and time
+    the batched Shi & Malik (lowest ncut) threshold with its ncut against the mean threshold's
+    """
+    from nc import ncut_thresholds
+    print(f'{"b":>4} {"N":>6} {"loop (s)":>9} {"batched (s)":>12} {"speedup":>8} {"ncut (s)":>9} {"mean ncut":>10} {"best ncut":>10}')
+    for size in sizes:
+        A = image_affinity(max(batch_sizes), size, dtype=torch.double)
+        y, _ = NormalizedCuts(eig_solver='eigh').solve(A)
+        for b in batch_sizes:
+            t_old, _ = timeit(lambda: old_partition(y[:b]), repeats)
+            t_new, _ = timeit(lambda: partition(y[:b]), repeats)
+            t_ncut, (_, ncuts) = timeit(lambda: ncut_thresholds(y[:b].flatten(-2), A[:b]), repeats)
+            S = partition(y[:b]).flatten(-2) # the ncut of the mean split
+            cut = torch.einsum('bi,bij,bj->b', S, A[:b], 1 - S)
+            mean_ncut = cut / torch.einsum('bi,bij->b', S, A[:b]) + cut / torch.einsum('bi,bij->b', 1 - S, A[:b])
+            print(f'{b:>4} {size*size:>6} {t_old:>9.4f} {t_new:>12.5f} {t_old/t_new:>7.1f}x {t_ncut:>9.4f} {mean_ncut.mean().item():>10.2e} {ncuts.mean().item():>10.2e}')
+
+def bench_eigensolvers(sizes=(8, 16, 32), b=8, repeats=3):
+    """
+    Compare the NormalizedCuts.solve eigensolver backends (scipy is the per sample
+    linalg.eigh(subset_by_index=[0,1], driver='evr') default) on image affinities in float32
+    """
+    print(f'{"N":>6} {"solver":>8} {"time (s)":>10} {"speedup":>8} {"1-|cos|":>10} {"eigval err":>11}')
+    for size in sizes:
+        N = size * size
+        A = image_affinity(b, size)
+        reference = torch.linalg.eigh(NormalizedCuts().laplacian(A.double())) # fp64 reference
+        v_ref, w_ref = reference.eigenvectors[..., 1], reference.eigenvalues[:, 1]
+        baseline = None
+        for eig_solver in ('scipy', 'eigh', 'lobpcg'):
+            node = NormalizedCuts(eig_solver=eig_solver)
+            t, (y, ctx) = timeit(lambda: node.solve(A), repeats)
+            baseline = t if baseline is None else baseline
+            cos = torch.einsum('bi,bi->b', y.reshape(b, N).double(), v_ref).abs()
+            err = (ctx['eigenvalues'].double() - w_ref).abs().max().item()
+            print(f'{N:>6} {eig_solver:>8} {t:>10.4f} {baseline/t:>7.1f}x {(1 - cos).max().item():>10.2e} {err:>11.2e}')
+
+def bench_multiscale(sizes=(24, 32, 48), b=2, repeats=3):
+    """
+    Compare the coarse to fine NormalizedCuts(eig_solver='multiscale') solve with the direct eigh and a cold started
+    lobpcg on image affinities in float64: time, lobpcg iterations (per solve, summed over the levels) and the
+    largest 1-|cos| and eigenvalue error against eigh
+    """
+    print(f'{"N":>6} {"solver":>11} {"time (s)":>10} {"speedup":>8} {"iterations":>11} {"1-|cos|":>10} {"eigval err":>11}')
+    for size in sizes:
+        A = image_affinity(b, size, dtype=torch.double)
+        baseline, reference = None, None
+        for eig_solver in ('eigh', 'lobpcg', 'multiscale'):
+            node = NormalizedCuts(eig_solver=eig_solver)
+            t, (y, ctx) = timeit(lambda: node.solve(A), repeats)
+            if reference is None:
+                baseline, reference = t, (y.reshape(b, -1), ctx['eigenvalues'])
+            cos = torch.einsum('bi,bi->b', y.reshape(b, -1), reference[0]).abs()
+            err = (ctx['eigenvalues'] - reference[1]).abs().max().item()
+            iterations = node.eig_stats['iterations'] // repeats
+            print(f'{size*size:>6} {eig_solver:>11} {t:>10.4f} {baseline/t:>7.1f}x {iterations:>11} {(1 - cos).max().item():>10.2e} {err:>11.2e}')
+
+def bench_nystrom(sizes=(28, 48), samples=(25, 50, 100, 200), repeats=3):
+    """
+    Error of the Nystrom approximation of the second normalized Laplacian eigenpair against the exact (dense eigh) one,
+    for global weights: nc_suite.nystrom_ncut of the intensity_weight_matrix of a rectangle image (0..255), and
+    NormalizedCuts(eig_solver='nystrom') of image affinities connecting every pixel pair. The measured sin(angle) of the
+    eigenvector, its component along the trivial eigenvector (which only shifts z = D^-0.5 y by a constant), and for
+    the eigenvector with that component removed (v, Rayleigh quotient rho, residual r = L v - rho v) the measured errors
+    against their a posteriori bounds: sin(angle) <= |r| / gap (Davis-Kahan) and |rho - exact| <= |r|^2 / gap,
+    gap = exact third eigenvalue - rho (inf if not positive: the Nystrom pair missed the Fiedler vector)
+    """
+    import numpy as np
+    from nc_suite import nystrom_ncut, intensity_weight_matrix
+    print(f'{"path":>14} {"N":>6} {"m":>5} {"exact (s)":>10} {"nystrom (s)":>12} {"sin angle":>10} {"trivial":>9} '
+          f'{"sin defl":>9} {"bound":>9} {"eig err":>9} {"bound":>9}')
+    def errors(L, v, w_exact, v_exact):
+        sin = lambda u: np.sqrt(max(1 - (u @ v_exact[:, 1]) ** 2, 0))
+        trivial = v @ v_exact[:, 0]
+        v_perp = v - trivial * v_exact[:, 0]
+        v_perp /= np.linalg.norm(v_perp)
+        rho = v_perp @ L @ v_perp
+        r = np.linalg.norm(L @ v_perp - rho * v_perp)
+        gap = w_exact[2] - rho
+        bound = lambda b: b if gap > 0 else np.inf
+        return sin(v), abs(trivial), sin(v_perp), bound(r / gap), abs(rho - w_exact[1]), bound(r**2 / gap)
+    def row(path, size, m, t_exact, t, errors):
+        print(f'{path:>14} {size*size:>6} {m:>5} {t_exact:>10.4f} {t:>12.4f} ' + ' '.join(f'{e:>{10 if i == 0 else 9}.2e}' for i, e in enumerate(errors)))
+    for size in sizes:
+        img = rectangle_images(1, size, dtype=torch.double)[0].numpy() * 255
+        W = intensity_weight_matrix(img).astype('float64')
+        d = W.sum(axis=0)
+        L = np.eye(len(d)) - W / np.sqrt(np.outer(d, d))
+        t_exact, (w_exact, v_exact) = timeit(lambda: np.linalg.eigh(L), repeats)
+        for m in samples:
+            t, (w, v) = timeit(lambda: nystrom_ncut(img, intensity_weight_matrix, samples=m), repeats)
+            row('intensity', size, m, t_exact, t, errors(L, v[:, 1], w_exact, v_exact))
+
+        A = image_affinity(1, size, radius=2*size, sigma_X=size**2, dtype=torch.double) # every pixel pair
+        exact = NormalizedCuts(eig_solver='eigh', symm_norm_L=True)
+        t_exact, _ = timeit(lambda: exact.solve(A), repeats)
+        L = exact.laplacian(A)[0].numpy()
+        w_exact, v_exact = np.linalg.eigh(L)
+        for m in samples:
+            node = NormalizedCuts(eig_solver='nystrom', symm_norm_L=True, nystrom_samples=m)
+            t, (y, _) = timeit(lambda: node.solve(A), repeats)
+            row('NormalizedCuts', size, m, t_exact, t, errors(L, y[0].detach().flatten().numpy(), w_exact, v_exact))
+
+def bench_warm_start(sizes=(8, 16, 32), b=8, epochs=4, step=1e-3, repeats=1):
+    """
+    Compare the lobpcg iterations (and time) of NormalizedCuts.solve from a cold start against warm starts
+    from an EigenvectorCache of the last epoch, over epochs of image affinities that each change by a
+    relative step (like the learned weights between epochs), after the first (cold) epoch.
+    Iterations are per batched solve (lobpcg stops at 200)
+    """
+    print(f'{"N":>6} {"cold its":>9} {"warm its":>9} {"cold (s)":>9} {"warm (s)":>9} {"1-|cos|":>10}')
+    for size in sizes:
+        N = size * size
+        A = image_affinity(b, size)
+        generator = torch.Generator().manual_seed(1)
+        cold, warm = NormalizedCuts(eig_solver='lobpcg'), NormalizedCuts(eig_solver='lobpcg', warm_start=EigenvectorCache())
+        warm.sample_index = torch.arange(b)
+        warm.solve(A) # the first epoch fills the cache
+        warm.eig_stats['iterations'] = 0
+        t_cold, t_warm, cos = 0, 0, 1
+        for epoch in range(epochs):
+            noise = torch.randn(A.shape, generator=generator)
+            A = A * (1 + step * (noise + noise.mT) / 2)
+            t, (y_cold, _) = timeit(lambda: cold.solve(A), 1)
+            t_cold += t
+            t, (y_warm, _) = timeit(lambda: warm.solve(A), 1)
+            t_warm += t
+            cos = min(cos, torch.einsum('bi,bi->b', y_cold.reshape(b, N).double(), y_warm.reshape(b, N).double()).abs().min().item())
+        print(f'{N:>6} {cold.eig_stats["iterations"] / epochs:>9.1f} {warm.eig_stats["iterations"] / epochs:>9.1f} {t_cold / epochs:>9.4f} {t_warm / epochs:>9.4f} {1 - cos:>10.2e}')
+
+def bench_sparse(sizes=(16, 32, 64, 128), b=2, dense_max=32, repeats=3):
+    """
+    Compare the dense (eigh) and sparse (banded) NormalizedCuts solve + analytic gradient
+    on minVer style bands with r = size, for N = size^2 (dense only up to dense_max)
+    """
+    print(f'{"N":>6} {"mode":>8} {"solve (s)":>10} {"grad (s)":>10} {"weights (MB)":>13} {"grad diff":>10}')
+    for size in sizes:
+        N = size * size
+        band = image_band(b, size)
+        v = torch.randn((b, size, size), dtype=band.dtype, generator=torch.Generator().manual_seed(1))
+        reference = None
+        for eig_solver in ('eigh', 'sparse'):
+            if eig_solver == 'eigh' and size > dense_max:
+                continue
+            A = de_minW(band).double() if eig_solver == 'eigh' else band
+            node = NormalizedCuts(eig_solver=eig_solver)
+            t_solve, (y, ctx) = timeit(lambda: node.solve(A), repeats)
+            if reference is not None: # fix the (arbitrary) sign of the eigenvector
+                y = y * torch.einsum('bij,bij->b', reference[0], y).sign().view(-1, 1, 1)
+            t_grad, (gradient,) = timeit(lambda: node.gradient(A.requires_grad_(True), y=y, v=v, ctx=ctx), repeats)
+            diff = ''
+            if reference is None and size <= dense_max:
+                reference = (y.detach(), gradient)
+            elif reference is not None: # dense gradient wrt W, summed onto the band entries
+                band_reference = torch.stack([torch.nn.functional.pad(torch.diagonal(reference[1], i, -2, -1)
+                    + torch.diagonal(reference[1], -i, -2, -1), (0, i)) for i in range(1, band.shape[1] + 1)], dim=1)
+                diff = f'{(gradient - band_reference).abs().max().item():.2e}'
+            mb = A.numel() * A.element_size() / 2**20
+            print(f'{N:>6} {eig_solver:>8} {t_solve:>10.4f} {t_grad:>10.4f} {mb:>13.1f} {diff:>10}')
+
+def bench_de_minW(shapes=((8, 1, 256), (8, 5, 256), (8, 5, 1024), (8, 32, 1024), (8, 5, 4096)), repeats=3):
+    """
+    Compare the looped (old_de_minW) and vectorized de_minW forward + backward on (b, r, N) bands
+    """
+    print(f'{"b":>4} {"r":>4} {"N":>6} {"loop (s)":>10} {"vector (s)":>11} {"speedup":>8} {"max diff":>10}')
+    for b, r, N in shapes:
+        band = torch.rand((b, r, N), generator=torch.Generator().manual_seed(0)).requires_grad_(True)
+        def forward_backward(func):
+            W = func(band)
+            W.sum().backward()
+            return W.detach()
+        t_old, W_old = timeit(lambda: forward_backward(old_de_minW), repeats)
+        t_new, W_new = timeit(lambda: forward_backward(de_minW), repeats)
+        diff = (W_old - W_new).abs().max().item()
+        print(f'{b:>4} {r:>4} {N:>6} {t_old:>10.4f} {t_new:>11.4f} {t_old/t_new:>7.1f}x {diff:>10.2e}')
+
+def bench_manual_weight(shapes=((8, 28, 5), (8, 64, 5), (64, 28, 5), (8, 28, 28)), repeats=3):
+    """
+    Compare the looped (old_manual_weight) and vectorized manual_weight on (b, 1, size, size)
+    rectangle images with radius r, for both the minVer band and the full weights
+    """
+    print(f'{"b":>4} {"size":>5} {"r":>4} {"minVer":>7} {"loop (s)":>10} {"vector (s)":>11} {"speedup":>8} {"equal":>6}')
+    for b, size, r in shapes:
+        images = rectangle_images(b, size, noise=0).unsqueeze(1)
+        for minVer in (True, False):
+            t_old, W_old = timeit(lambda: old_manual_weight(images, r, minVer), repeats)
+            t_new, W_new = timeit(lambda: manual_weight(images, r, minVer), repeats)
+            print(f'{b:>4} {size:>5} {r:>4} {str(minVer):>7} {t_old:>10.4f} {t_new:>11.4f} {t_old/t_new:>7.1f}x {str(torch.equal(W_old, W_new)):>6}')
+
+def bench_weights(size=28, radius=5, choices=(0, 1, 3, 6, 7, 8, 10, 12, 14, 15, 16, 17, 18), repeats=3):
+    """
+    Compare the looped (og_nc_suite) and vectorised (nc_suite) big_helper.get_weights choices on a size x size
+    rectangle image (2, 4, 5 were already vectorised, the texture choices 9, 11, 13 fail at the borders in both)
+    """
+    import og_nc_suite
+    from big_helper import get_weights
+    img = rectangle_images(1, size, dtype=torch.double)[0].numpy()
+    print(f'{"choice":>6} {"loop (s)":>10} {"vector (s)":>11} {"speedup":>8} {"max diff":>10}')
+    for choice in choices:
+        t_old, W_old = timeit(lambda: get_weights(img, choice, radius, suite=og_nc_suite), repeats)
+        t_new, W_new = timeit(lambda: get_weights(img, choice, radius), repeats)
+        print(f'{choice:>6} {t_old:>10.4f} {t_new:>11.4f} {t_old/t_new:>7.1f}x {abs(W_old - W_new).max():>10.2e}')
+
+def bench_solve_ncut(sizes=(28, 64, 128), radius=3, slow_max=64, repeats=1):
+    """
+    Compare the nc_suite.solve_ncut modes on the sparse weights_2 of noisy size x size rectangle images: the original
+    call (og_nc_suite, dense), the same 100 eigenpair ARPACK smallest magnitude call on the correctly normalised
+    Laplacian ('eigsh'), and the deflated single eigenpair 'shift_invert' and ILU preconditioned 'lobpcg' modes
+    ('multiscale' started from the coarse to fine solution),
+    with their iterations (Lanczos steps, or LOBPCG iterations) and 1-|cos| to the shift_invert eigenvector.
+    The two slow calls only up to slow_max (the original needs the dense N x N matrices)
+    """
+    import numpy as np, scipy.sparse
+    import og_nc_suite
+    from nc_suite import weights_2, solve_ncut
+    rng = np.random.default_rng(0)
+    print(f'{"N":>6} {"mode":>14} {"time (s)":>10} {"iterations":>11} {"1-|cos|":>10}')
+    for size in sizes:
+        img = rectangle_images(1, size, dtype=torch.double)[0].numpy() + 0.1 * rng.random((size, size))
+        W = weights_2(img, r=radius, sparse=True)
+        D = scipy.sparse.diags(np.asarray(W.sum(axis=0)).ravel())
+        reference = solve_ncut(D, W, mode='shift_invert')
+        runs = [('lobpcg', lambda: solve_ncut(D, W, mode='lobpcg', return_info=True)),
+                ('multiscale', lambda: solve_ncut(D, W, mode='multiscale', return_info=True)),
+                ('shift_invert', lambda: solve_ncut(D, W, mode='shift_invert', return_info=True))]
+        if size <= slow_max:
+            runs += [('eigsh', lambda: solve_ncut(D, W, mode='eigsh', return_info=True)),
+                ('original', lambda: (og_nc_suite.solve_ncut(D.toarray(), W.toarray()), {'iterations': None}))]
+        for mode, run in runs:
+            t, (ev, info) = timeit(run, repeats)
+            iterations = '' if info['iterations'] is None else info['iterations']
+            print(f'{size*size:>6} {mode:>14} {t:>10.4f} {iterations:>11} {1 - abs(ev @ reference):>10.2e}')
+
+def _rss():
+    """Current resident set size (MB) of this process"""
+    with open('/proc/self/statm') as fp:
+        return int(fp.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+
+def _training_step_rss(size, b, radius, lean, eig_solver):
+    """
+    Memory (MB) of one training step of a minify style Net: conv -> band (b, r, N) -> de_minW -> NormalizedCuts -> conv
+    -> loss -> backward, with the lean backward_context of NormalizedCuts or saving the inputs. Returns the memory held
+    by the graph between the forward and backward passes, and the peak RSS of the step, over the RSS before the step
+    """
+    import resource
+    from node import DeclarativeLayer
+    class SaveInputs(NormalizedCuts):
+        def backward_context(self, *xs, y=None, ctx=None):
+            return xs, None
+    torch.manual_seed(0)
+    N = size * size
+    weights_net = torch.nn.Sequential(torch.nn.Conv2d(1, 4, 3, padding=1), torch.nn.ReLU(), torch.nn.Conv2d(4, radius, 3, padding=1), torch.nn.Sigmoid())
+    post_net = torch.nn.Sequential(torch.nn.Conv2d(1, 4, 3, padding=1), torch.nn.ReLU(), torch.nn.Conv2d(4, 1, 3, padding=1))
+    node = (NormalizedCuts if lean else SaveInputs)(eps=1e-3, eig_solver=eig_solver)
+    layer = DeclarativeLayer(node)
+    images = rectangle_images(b, size).unsqueeze(1)
+
+    before = _rss()
+    band = weights_net(images).view(b, radius, N)
+    y = layer(de_minW(band)).view(b, 1, size, size)
+    loss = torch.nn.functional.binary_cross_entropy_with_logits(post_net(y), (images > 0.5).float())
+    held = _rss() - before
+    loss.backward()
+    return held, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 - before
+
+def bench_memory(sizes=(32, 64), b=4, radius=5, eig_solver='scipy', repeats=1):
+    """
+    Compare the memory of a training step (conv -> de_minW -> NormalizedCuts -> conv) when DeclarativeFunction saves
+    the dense b x N x N weights for backward and when it saves the NormalizedCuts.backward_context (the minVer band),
+    each in a fresh process, for size x size images: held between the forward and backward passes, and peak RSS
+    """
+    import multiprocessing
+    os.environ['MALLOC_MMAP_THRESHOLD_'] = str(2**16) # large blocks are returned to the os when freed, so the rss is what is held
+    print(f'{"size":>5} {"dense A (MB)":>13} {"context":>12} {"held (MB)":>10} {"peak (MB)":>10}')
+    with multiprocessing.get_context('spawn').Pool(1, maxtasksperchild=1) as pool:
+        for size in sizes:
+            for lean in (False, True):
+                held, peak = pool.apply(_training_step_rss, (size, b, radius, lean, eig_solver))
+                print(f'{size:>5} {b * (size * size) ** 2 * 4 / 2**20:>13.0f} {"band" if lean else "inputs":>12} {held:>10.0f} {peak:>10.0f}')
+
+def _gradient_rss(size, b, max_backward_memory):
+    """
+    Peak RSS growth (MB) and time of the generic NormalizedCuts gradient (fYY and chunked fXY, analytic_gradient=False)
+    for (b, N, N) image affinities, with a max_backward_memory budget
+    """
+    import resource
+    warnings.simplefilter('ignore') # the eigenvectors are not exactly optimal
+    node = NormalizedCuts(analytic_gradient=False, max_backward_memory=max_backward_memory)
+    for size in (4, size): # the first loads the libraries (which add to the rss once)
+        A = image_affinity(b, size, dtype=torch.double).requires_grad_(True)
+        y, ctx = node.solve(A)
+        v = torch.randn(y.shape, dtype=y.dtype, generator=torch.Generator().manual_seed(0))
+        if size == 4:
+            node.gradient(A, y=y, v=v, ctx=ctx)
+    before = _rss()
+    start = time.perf_counter()
+    node.gradient(A, y=y, v=v, ctx=ctx)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 - before, time.perf_counter() - start
+
+def bench_backward_memory(sizes=(12, 16), b=2, budgets_mb=(None, 256, 64), repeats=1):
+    """
+    Compare the peak RSS growth of the generic gradient of NormalizedCuts (b x N x N^2 cross derivatives fXY)
+    without a budget and with max_backward_memory budgets, each in a fresh process, for size x size images
+    """
+    import multiprocessing
+    os.environ['MALLOC_MMAP_THRESHOLD_'] = str(2**16) # large blocks are returned to the os when freed
+    print(f'{"size":>5} {"fXY (MB)":>9} {"budget (MB)":>12} {"peak (MB)":>10} {"time (s)":>9}')
+    with multiprocessing.get_context('spawn').Pool(1, maxtasksperchild=1) as pool:
+        for size in sizes:
+            N = size * size
+            for budget in budgets_mb:
+                peak, t = pool.apply(_gradient_rss, (size, b, None if budget is None else budget * 2**20))
+                print(f'{size:>5} {b * N * N * N * 8 / 2**20:>9.0f} {"none" if budget is None else budget:>12} {peak:>10.0f} {t:>9.2f}')
+
+def bench_store(sizes=(1000, 10000), size=32, radius=5, repeats=3):
+    """
+    Compare the pickled dataset (a list of png paths and a list of weight tensors, decoding each png)
+    and the packed store.PackedArray (memory-mapped) start-up and one epoch of random access
+    """
+    import pickle, tempfile, cv2
+    from store import PackedArray
+    print(f'{"images":>7} {"format":>7} {"start-up (s)":>13} {"epoch (s)":>10}')
+    for n in sizes:
+        with tempfile.TemporaryDirectory() as dir:
+            images = (rectangle_images(n, size, noise=0) * 255).to(torch.uint8).numpy()
+            weights = torch.rand((n, radius, size * size)) # minVer weights
+            names = []
+            for i, image in enumerate(images):
+                names.append(os.path.join(dir, f'img{i}.png'))
+                cv2.imwrite(names[-1], image)
+            with open(os.path.join(dir, 'dataset'), 'wb') as fp:
+                pickle.dump([names, list(images.astype(float) / 255)], fp)
+            with open(os.path.join(dir, 'weights'), 'wb') as fp:
+                pickle.dump([w.clone() for w in weights], fp) # separate storages, as data() made them
+            PackedArray(os.path.join(dir, 'images')).append(images)
+            PackedArray(os.path.join(dir, 'segmentations')).append(images.astype(float) / 255)
+            PackedArray(os.path.join(dir, 'weights')).append(weights.numpy())
+
+            def load_pickles():
+                with open(os.path.join(dir, 'dataset'), 'rb') as fp:
+                    names, segmentations = pickle.load(fp)
+                with open(os.path.join(dir, 'weights'), 'rb') as fp:
+                    weights = pickle.load(fp)
+                return names, segmentations, weights
+            def load_packed():
+                return tuple(PackedArray(os.path.join(dir, name)) for name in ('images', 'segmentations', 'weights'))
+            order = torch.randperm(n, generator=torch.Generator().manual_seed(0)).tolist()
+            def epoch_pickles(names, segmentations, weights):
+                return [(cv2.imread(names[i], 0), segmentations[i], weights[i]) for i in order]
+            def epoch_packed(images, segmentations, weights):
+                return [(images[i], segmentations[i], torch.from_numpy(weights[i])) for i in order]
+
+            for name, load, epoch in (('pickle', load_pickles, epoch_pickles), ('packed', load_packed, epoch_packed)):
+                t_load, loaded = timeit(load, repeats)
+                t_epoch, _ = timeit(lambda: epoch(*loaded), repeats)
+                print(f'{n:>7} {name:>7} {t_load:>13.4f} {t_epoch:>10.4f}')
+
+def bench_weight_cache(size=32, radius=10, choices=(3, 10, 14), repeats=3):
+    """
+    Compare computing big_helper.get_weights against reading them from a warm weight_cache.WeightCache,
+    and the size of a cache entry against the raw (dense float64) weights
+    """
+    import tempfile
+    from big_helper import get_weights
+    from weight_cache import WeightCache
+    img = rectangle_images(1, size)[0].numpy()
+    print(f'{"choice":>7} {"compute (s)":>12} {"cached (s)":>11} {"speedup":>8} {"entry (KB)":>11} {"raw (KB)":>9}')
+    with tempfile.TemporaryDirectory() as dir:
+        cache = WeightCache(dir)
+        for choice in choices:
+            t_compute, W = timeit(lambda: get_weights(img, choice, radius), repeats)
+            get_weights(img, choice, radius, cache=cache) # warm
+            t_cached, W_cached = timeit(lambda: get_weights(img, choice, radius, cache=cache), repeats)
+            assert (W == W_cached).all()
+            entry = sum(entry.stat().st_size for d in os.scandir(dir) for entry in os.scandir(d.path)) / 1024
+            print(f'{choice:>7} {t_compute:>12.4f} {t_cached:>11.4f} {t_compute / t_cached:>7.1f}x {entry:>11.1f} {W.nbytes / 1024:>9.1f}')
+            for d in os.scandir(dir): # one entry at a time
+                for entry in os.scandir(d.path):
+                    os.remove(entry.path)
+
+# Benchmark suite: a sweep of the main code paths over image size, batch size, radius and minify, saved as JSON
+# (with the environment) by `python benchmark.py suite --json results.json`, and compared between two result files
+# (flagging regressions) by `python benchmark.py --compare old.json new.json`
+
+SUITE_GRIDS = {
+    'quick': {'size': (8, 16), 'batch': (2,), 'radius': (3,), 'minify': (False, True)},
+    'full': {'size': (8, 16, 32), 'batch': (1, 4, 8), 'radius': (3, 5, 10), 'minify': (False, True)},
+}
+
+def _suite_input(size, batch, radius, minify):
+    """The (b, r, N) band (minify) or dense (b, N, N) weights of rectangle images"""
+    band = image_band(batch, size, r=radius)
+    return band if minify else de_minW(band)
+
+def suite_nc_solve(size, batch, radius, minify):
+    """NormalizedCuts.solve with each eigensolver"""
+    A = _suite_input(size, batch, radius, minify)
+    for eig_solver in ('scipy', 'eigh', 'lobpcg', 'sparse'):
+        node = NormalizedCuts(eig_solver=eig_solver)
+        yield {'eig_solver': eig_solver}, lambda: node.solve(A)
+
+def suite_nc_objective(size, batch, radius):
+    """NormalizedCuts.objective at the solution"""
+    A = de_minW(image_band(batch, size, r=radius))
+    node = NormalizedCuts()
+    y, _ = node.solve(A)
+    yield {}, lambda: node.objective(A, y=y)
+
+def suite_nc_gradient(size, batch, radius):
+    """NormalizedCuts.gradient, analytic (eigenvector derivative) and generic (AbstractDeclarativeNode.gradient, size <= 16)"""
+    A = de_minW(image_band(batch, size, r=radius)).requires_grad_(True)
+    v = torch.randn((batch, size, size), dtype=A.dtype, generator=torch.Generator().manual_seed(1))
+    for analytic_gradient in (True, False):
+        if not analytic_gradient and size > 16: # fXY is b x N x N^2
+            continue
+        node = NormalizedCuts(eps=1e-3, analytic_gradient=analytic_gradient, vectorize=False)
+        y, ctx = node.solve(A)
+        yield {'gradient': 'analytic' if analytic_gradient else 'generic'}, lambda: node.gradient(A, y=y, v=v, ctx=ctx)
+
+def suite_de_minW(size, batch, radius):
+    """de_minW of a (b, r, N) band"""
+    band = image_band(batch, size, r=radius)
+    yield {}, lambda: de_minW(band)
+
+def suite_manual_weight(size, batch, radius, minify):
+    """manual_weight of (b, 1, size, size) images"""
+    images = rectangle_images(batch, size, noise=0).unsqueeze(1)
+    yield {}, lambda: manual_weight(images, radius, minify)
+
+def _suite_args(size, batch, radius, minify):
+    from net_argparser import net_argparser
+    args = net_argparser(ipynb=True)
+    args.img_size, args.batch_size, args.radius, args.minify = (size, size), batch, radius, minify
+    return args
+
+def suite_dataset(size, batch, radius, minify):
+    """One epoch of batches of SimpleDatasets (64 images of data/benchmark/, created on the first run)"""
+    from data import SimpleDatasets, transforms
+    args = _suite_args(size, batch, radius, minify)
+    args.dataset, args.total_images, args.weight_cache = 'benchmark', 64, ''
+    dataset = SimpleDatasets(args, transform=transforms.ToTensor())
+    loader = torch.utils.data.DataLoader(dataset, batch_size=batch)
+    yield {}, lambda: [sample for sample in loader]
+
+def suite_train_step(size, batch, radius, minify):
+    """One training step (forward, loss, backward, optimizer step) of Net on rectangle images"""
+    from model import Net
+    args = _suite_args(size, batch, radius, minify)
+    torch.manual_seed(0)
+    model = Net(args)
+    optimizer = torch.optim.SGD(model.parameters(), lr=args.lr, momentum=args.momentum)
+    criterion = torch.nn.BCEWithLogitsLoss()
+    images = rectangle_images(batch, size).unsqueeze(1).to(next(model.parameters()).device)
+    target = (images > 0.5).float()
+    def step():
+        optimizer.zero_grad()
+        loss = criterion(model(images), target)
+        loss.backward()
+        optimizer.step()
+    yield {}, step
+
+SUITE = {
+    'nc_solve': suite_nc_solve,
+    'nc_objective': suite_nc_objective,
+    'nc_gradient': suite_nc_gradient,
+    'de_minW': suite_de_minW,
+    'manual_weight': suite_manual_weight,
+    'dataset': suite_dataset,
+    'train_step': suite_train_step,
+}
+
+def environment():
+    """Metadata of the machine, libraries and code the results were measured with"""
+    import datetime, platform, subprocess, numpy, scipy
+    def git(*command):
+        try:
+            return subprocess.run(['git', *command], capture_output=True, text=True,
+                cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError): # not a git checkout
+            return None
+    status = git('status', '--porcelain', '--untracked-files=no')
+    return {
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'git_commit': git('rev-parse', 'HEAD'),
+        'git_dirty': None if status is None else status != '',
+        'hostname': platform.node(),
+        'platform': platform.platform(),
+        'processor': platform.processor() or platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'python': platform.python_version(),
+        'torch': torch.__version__,
+        'numpy': numpy.__version__,
+        'scipy': scipy.__version__,
+        'threads': torch.get_num_threads(),
+        'cuda': torch.cuda.get_device_name() if torch.cuda.is_available() else None,
+    }
+
+def run_suite(grid='quick', cases=None, repeats=3):
+    """
+    Times each case of SUITE (all, or the names in cases) for each combination of the grid values of the parameters
+    the case takes. Returns {'environment', 'grid', 'repeats', 'results'}, the results being a list of
+    {'case', 'params', 'time' (best, s), 'median' (s)}, or {'case', 'params', 'skipped': reason}
+    """
+    import inspect, itertools, statistics
+    values = SUITE_GRIDS[grid]
+    results = []
+    for case in cases or SUITE:
+        func = SUITE[case]
+        names = list(inspect.signature(func).parameters)
+        for combination in itertools.product(*(values[name] for name in names)):
+            params = dict(zip(names, combination))
+            try:
+                for extra, run in func(**params):
+                    run() # warm up
+                    times = []
+                    for _ in range(repeats):
+                        start = time.perf_counter()
+                        run()
+                        times.append(time.perf_counter() - start)
+                    results.append({'case': case, 'params': {**params, **extra}, 'time': min(times), 'median': statistics.median(times)})
+                    print(f'{case:>14} {_format_params(results[-1]["params"]):<60} {min(times):>10.4f}')
+            except ImportError as e: # the dataset and model need the training dependencies (torchvision, wandb, ...)
+                results.append({'case': case, 'params': params, 'skipped': str(e)})
+                print(f'{case:>14} {_format_params(params):<60} {"skipped":>10} ({e})')
+    return {'environment': environment(), 'grid': grid, 'repeats': repeats, 'results': results}
+
+def _format_params(params):
+    return ' '.join(f'{name}={value}' for name, value in params.items())
+
+def _result_key(result):
+    return result['case'], tuple(sorted(result['params'].items()))
+
+def compare(old, new, threshold=0.1, min_time=1e-4):
+    """
+    Compares the best times of the results (as returned by run_suite) measured in both old and new, flagging
+    regressions (new slower than old by more than the threshold fraction and min_time seconds). Returns the number
+    of regressions
+    """
+    for name in ('hostname', 'processor', 'torch', 'threads', 'cuda'):
+        if old['environment'].get(name) != new['environment'].get(name):
+            print(f'warning: {name} differs ({old["environment"].get(name)} vs {new["environment"].get(name)})')
+    old_times = {_result_key(result): result['time'] for result in old['results'] if 'time' in result}
+    regressions = 0
+    print(f'{"case":>14} {"params":<60} {"old (s)":>10} {"new (s)":>10} {"change":>8}')
+    for result in new['results']:
+        key = _result_key(result)
+        if 'time' not in result or key not in old_times:
+            continue
+        t_old, t_new = old_times[key], result['time']
+        regression = t_new > t_old * (1 + threshold) and t_new - t_old > min_time
+        regressions += regression
+        flag = '  REGRESSION' if regression else ('  faster' if t_new < t_old / (1 + threshold) else '')
+        print(f'{result["case"]:>14} {_format_params(result["params"]):<60} {t_old:>10.4f} {t_new:>10.4f} {t_new/t_old - 1:>+7.1%}{flag}')
+    print(f'{regressions} regression(s) over {threshold:.0%}')
+    return regressions
+
+def bench_suite(repeats=3, grid='quick', path=None):
+    """
+    Sweep NormalizedCuts.solve (each eigensolver), objective and gradient, de_minW, manual_weight, SimpleDatasets
+    loading and a Net training step over image size, batch size, radius and minify (saved as JSON with --json)
+    """
+    results = run_suite(grid, repeats=repeats)
+    if path:
+        with open(path, 'w') as fp:
+            json.dump(results, fp, indent=2)
+        print(f'saved {len(results["results"])} results to {path}')
+
+BENCHMARKS = {
+    'jacobian': bench_jacobian,
+    'full_jacobian': bench_full_jacobian,
+    'linear_solver': bench_linear_solver,
+    'constrained': bench_constrained,
+    'matrix_free': bench_matrix_free,
+    'nc_gradient': bench_nc_gradient,
+    'profile': bench_profile,
+    'precision': bench_precision,
+    'eigensolvers': bench_eigensolvers,
+    'k_way': bench_k_way,
+    'multiscale': bench_multiscale,
+    'nystrom': bench_nystrom,
+    'partition': bench_partition,
+    'warm_start': bench_warm_start,
+    'sparse': bench_sparse,
+    'de_minW': bench_de_minW,
+    'manual_weight': bench_manual_weight,
+    'weights': bench_weights,
+    'solve_ncut': bench_solve_ncut,
+    'memory': bench_memory,
+    'backward_memory': bench_backward_memory,
+    'store': bench_store,
+    'weight_cache': bench_weight_cache,
+    'suite': bench_suite,
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Micro-benchmarks for the declarative nodes')
+    parser.add_argument('names', nargs='*', metavar='name', help=f'benchmarks to run, any of {list(BENCHMARKS)} (default: all)')
+    parser.add_argument('--repeats', type=int, default=3, help='number of timed repeats (best is reported)')
+    parser.add_argument('--grid', type=str, default='quick', choices=list(SUITE_GRIDS), help='parameter sweep of the suite benchmark')
+    parser.add_argument('--json', type=str, default=None, metavar='PATH', help='save the results of the suite benchmark (with the environment) as JSON')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), default=None, help='compare two suite JSON results (exits with 1 on regressions) instead of running')
+    parser.add_argument('--threshold', type=float, default=0.1, help='slowdown (fraction) flagged as a regression by --compare')
+    args = parser.parse_args()
+    for name in args.names:
+        if name not in BENCHMARKS:
+            parser.error(f'unknown benchmark {name}, choose from {list(BENCHMARKS)}')
+
+    if args.compare:
+        with open(args.compare[0]) as old, open(args.compare[1]) as new:
+            sys.exit(1 if compare(json.load(old), json.load(new), args.threshold) else 0)
+
+    warnings.simplefilter('ignore') # the random problems are not exactly optimal, which the nodes warn about
+    torch.set_num_threads(1) # more consistent timings
+    for name in args.names or BENCHMARKS:
+        print(f'\n{name}: {BENCHMARKS[name].__doc__.strip()}')
+        kwargs = {'grid': args.grid, 'path': args.json} if name == 'suite' else {}
+        BENCHMARKS[name](repeats=args.repeats, **kwargs)
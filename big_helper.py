@@ -176,12 +176,14 @@ def plot_images(imgs, labels=None, row_headers=None, col_headers=None, colmns=No
     # plt.tight_layout()
 
 # different weighting functions
-def get_weights(img, choice=0, radius=10, sigmaI=0.1, sigmaX=1):
+def get_weights(img, choice=0, radius=10, sigmaI=0.1, sigmaX=1, suite=None, cache=None):
     """For an image, get the weights matrix W for the image
 
     Args:
         img (Array): the img to convert to weights
         choice (int, optional): Which weight func to use, instead of names uses number system. Defaults to 1.
+        suite (module, optional): module providing the weight funcs, nc_suite (vectorised) or og_nc_suite (original loops). Defaults to nc_suite.
+        cache (weight_cache.WeightCache, optional): reuse the weights of the same image and spec (from any script or dataset). Defaults to None.
         
         choices correspond to: 
         [manual_weights_binary, manual_weights_abs, intensity_weight_matrix, weights_2,
@@ -191,46 +193,49 @@ def get_weights(img, choice=0, radius=10, sigmaI=0.1, sigmaX=1):
         Array: W, weights matrix (or affinity matrix depending on who you ask :) )
     """
     from functools import partial
+    if suite is None:
+        import nc_suite as suite
     # TODO: use these :)
-    from nc_suite import manual_weights_binary, manual_weights_abs # radius
-    from nc_suite import weights_2 # radius, sigmas
-    from nc_suite import intensity_weight_matrix, positional_weight_matrix, intens_posit_wm
+    # manual_weights_binary, manual_weights_abs # radius
+    # weights_2 # radius, sigmas
+    # intensity_weight_matrix, positional_weight_matrix, intens_posit_wm
     # TODO: verify these ones work (does the formula make sense)
-    from nc_suite import weight_tot, weight_int, weight_dist # test radius, sigmas 
-    from nc_suite import generic_weight, generic_weight_noexp, generic_weight_rawfunc # test params
-    from nc_suite import colour_diff, texture_diff, manual_weights_abs_upper
-    from nc_suite import weight_int_broken, weight_int_broken2, final_weight_test
+    # weight_tot, weight_int, weight_dist # test radius, sigmas 
+    # generic_weight, generic_weight_noexp, generic_weight_rawfunc # test params
     # TODO: once one is confirmed working, remove others and bring its implementation into this file
     
     # colour_func = partial()
-    texture_func = partial(texture_diff, neighborhood_size=radius)
+    texture_func = partial(suite.texture_diff, neighborhood_size=radius)
     
-    choices = [partial(manual_weights_binary, r=radius),                            # 0
-               partial(manual_weights_abs, r=radius),                               # 1
-                       intensity_weight_matrix,                                     # 2
-                partial(weights_2,r=radius, sigma_I=sigmaI, sigma_X=sigmaX),        # 3
-                       positional_weight_matrix,                                    # 4
-                       intens_posit_wm,                                             # 5
-                partial(weight_tot,radius=radius, sigmaI=sigmaI, sigmaX=sigmaX),    # 6
-                partial(weight_int,radius=radius, sigmaI=sigmaI),                   # 7
-                partial(weight_dist,radius=radius, sigmaX=sigmaX),                  # 8
-                partial(generic_weight, radius=radius, func=texture_func,           # 9
+    choices = [partial(suite.manual_weights_binary, r=radius),                            # 0
+               partial(suite.manual_weights_abs, r=radius),                               # 1
+                       suite.intensity_weight_matrix,                                     # 2
+                partial(suite.weights_2,r=radius, sigma_I=sigmaI, sigma_X=sigmaX),        # 3
+                       suite.positional_weight_matrix,                                    # 4
+                       suite.intens_posit_wm,                                             # 5
+                partial(suite.weight_tot,radius=radius, sigmaI=sigmaI, sigmaX=sigmaX),    # 6
+                partial(suite.weight_int,radius=radius, sigmaI=sigmaI),                   # 7
+                partial(suite.weight_dist,radius=radius, sigmaX=sigmaX),                  # 8
+                partial(suite.generic_weight, radius=radius, func=texture_func,           # 9
                                         sigmaI=sigmaI, sigmaX=sigmaX),
-                partial(generic_weight, radius=radius, func=colour_diff,            # 10
+                partial(suite.generic_weight, radius=radius, func=suite.colour_diff,      # 10
                                         sigmaI=sigmaI, sigmaX=sigmaX),
-                partial(generic_weight_noexp, radius=radius, func=texture_func,     # 11
+                partial(suite.generic_weight_noexp, radius=radius, func=texture_func,     # 11
                                         sigmaX=sigmaX),
-                partial(generic_weight_noexp, radius=radius, func=colour_diff,      # 12
+                partial(suite.generic_weight_noexp, radius=radius, func=suite.colour_diff,# 12
                                         sigmaX=sigmaX),
-                partial(generic_weight_rawfunc, radius=radius, func=texture_func),  # 13
-                partial(generic_weight_rawfunc, radius=radius, func=colour_diff),   # 14
-                partial(manual_weights_abs_upper, r=radius),                        # 15
-                partial(weight_int_broken,radius=radius, sigmaI=sigmaI),            # 16 
-                partial(weight_int_broken2,radius=radius, sigmaI=sigmaI),           # 17
-                partial(final_weight_test,r=radius, sigma=sigmaI)                   # 18
+                partial(suite.generic_weight_rawfunc, radius=radius, func=texture_func),  # 13
+                partial(suite.generic_weight_rawfunc, radius=radius, func=suite.colour_diff), # 14
+                partial(suite.manual_weights_abs_upper, r=radius),                        # 15
+                partial(suite.weight_int_broken,radius=radius, sigmaI=sigmaI),            # 16 
+                partial(suite.weight_int_broken2,radius=radius, sigmaI=sigmaI),           # 17
+                partial(suite.final_weight_test,r=radius, sigma=sigmaI)                   # 18
                 ]
     
     func = choices[choice]
+    if cache is not None:
+        spec = {'func': 'big_helper.get_weights', 'choice': choice, 'radius': radius, 'sigmaI': sigmaI, 'sigmaX': sigmaX, 'suite': suite.__name__}
+        return cache.get_or_compute(img, spec, func)
     W = func(img)
     # TODO: W = W / np.max(W), but might be better as a pre-process func... :)
     return W
@@ -11,6 +11,8 @@ from torch.utils.data import random_split
 
 # local imports
 from nc import de_minW, manual_weight
+from store import PackedArray
+from weight_cache import WeightCache
 
 # imports for plot_multiple_images
 import matplotlib.pyplot as plt
@@ -26,9 +28,12 @@ import torchvision.transforms.functional as F
 def get_dataset(args):
     """
     Creates the train_loader, val_loader
-    calls SimpleDatasets() which creates the data (if needed) using data()
+    calls SimpleDatasets() which creates the data (if needed) using data(),
+    or CustomFolders() for --dataset folders (--img-path)
     """
-    train_dataset = SimpleDatasets(args, transform=transforms.ToTensor())
+    warm_start = args.warm_start_mb > 0 and args.network == 0 # Net keys the eigenvector cache by dataset index
+    Folder = CustomFolders if args.dataset == 'folders' else SimpleDatasets
+    train_dataset = Folder(args, transform=transforms.ToTensor(), return_index=warm_start)
     print(f'Total dataset size {len(train_dataset)}')
 
     # Training and Validation dataset
@@ -122,6 +127,58 @@ def load_dataset(full_path, weights_path, num_images):
                 weights = output[:num_images] # weights
     return inputs, outputs, weights
 
+def open_packed(full_path, weights_name):
+    """
+    Returns the packed (memory-mapped, append-only) images, segmentations and weights of a dataset,
+    as store.PackedArray's in full_path/packed/. Migrates the pickled dataset and weights (from before
+    the packed store) the first time.
+    """
+    packed_path = full_path + 'packed/'
+    os.makedirs(packed_path, exist_ok=True)
+    images, segmentations = PackedArray(packed_path+'images'), PackedArray(packed_path+'segmentations')
+    weights = PackedArray(packed_path+weights_name)
+
+    if len(images) == 0 and os.path.isfile(full_path+'dataset'):
+        names, answers, _ = load_dataset(full_path+'dataset', '', None)
+        if len(names) > 0:
+            images.append(np.stack([cv2.imread(name, 0) for name in names]))
+            segmentations.append(np.stack(answers))
+            print(f'migrated {len(names)} images from the dataset pickle')
+    if len(weights) == 0 and os.path.isfile(full_path+weights_name):
+        _, _, old_weights = load_dataset('', full_path+weights_name, None)
+        if len(old_weights) > 0:
+            weights.append(torch.stack(old_weights).numpy())
+            print(f'migrated {len(old_weights)} weights from {weights_name}')
+    return images, segmentations, weights
+
+def weight_cache(args):
+    """The WeightCache shared by the datasets (None if disabled with --weight-cache '')"""
+    return WeightCache(args.weight_cache, max_mb=args.weight_cache_mb) if args.weight_cache else None
+
+def weight_spec(args):
+    """Spec of the dataset weights, the cache key is this and the image bytes"""
+    return {'func': 'nc.manual_weight', 'r': args.radius, 'minVer': bool(args.minify)}
+
+def make_weights(images, args, chunk=64, cache=None):
+    """
+    manual_weight of each of the (n, x, y) images, computed a chunk of images at a time
+    (only for the images missing from the cache, if given)
+    """
+    weights, spec = [], weight_spec(args)
+    for i in tqdm(range(0, len(images), chunk), desc='new weights'):
+        batch = np.asarray(images[i:i+chunk])
+        keys = [cache.key(img, spec) for img in batch] if cache is not None else [None] * len(batch)
+        out = [cache.get(key) for key in keys] if cache is not None else [None] * len(batch)
+        missing = [j for j, W in enumerate(out) if W is None]
+        if missing:
+            new = manual_weight(torch.as_tensor(batch[missing]).unsqueeze(1), r=args.radius, minVer=args.minify).numpy() # B,1,x,y
+            for j, W in zip(missing, new):
+                out[j] = W
+                if cache is not None:
+                    cache.put(keys[j], W)
+        weights.append(np.stack(out))
+    return np.concatenate(weights) if weights else np.empty(0)
+
 def data(full_path, weights_name, args):
     """ Generate a simple dataset (if it doesn't already exist) 
     path - example 'data/simple01/'
@@ -129,7 +186,8 @@ def data(full_path, weights_name, args):
     image size - (w,h)
     """
     img_size = args.img_size
-    images, answers, weights = load_dataset(full_path+'dataset', full_path+weights_name, args.total_images)
+    images, answers, weights = open_packed(full_path, weights_name)
+    cache = weight_cache(args)
 
     start = len(images)
     start_weights = len(weights)
@@ -139,12 +197,11 @@ def data(full_path, weights_name, args):
 
     # create all the missing weights (as the images may have been created with a different minify or radius)
     if start_weights < start:
-        for i_w in tqdm(range(start_weights, start), desc='new weights'):
-            name = images[i_w]
-            weights.append(manual_weight(name, r=args.radius, minVer=args.minify).squeeze(0))           
+        weights.append(make_weights(images[start_weights:start], args, cache=cache))
 
     # create all the (new) images to reach total images count (appends new ones)
     if start < args.total_images:
+        new_images, new_answers = [], []
         for i in tqdm(range(start, args.total_images), desc='new images, segs, weights'):
             # TODO: When creating dataset, enforce constraint of 50% white, 50% black to ensure nothing funny is happening
 
@@ -160,26 +217,18 @@ def data(full_path, weights_name, args):
             out = Image.fromarray(np.uint8(answer * 255), 'L')
 
             name = full_path+'images/'+"img"+str(i)+".png"
-            out.save(name, "PNG")
-
-            images.append(name)
-            answers.append(answer) 
-            if i >= start_weights:
-                weights.append(manual_weight(name, r=args.radius, minVer=args.minify).squeeze(0)) 
-                # squeeze(0) to remove batch dimension (but maintain channels or radius which could be 1)
-
-    if start_weights != args.total_images or start_weights < start:
-            with open(full_path+weights_name, 'wb') as fp:
-                pickle.dump(weights, fp)
-            print(f"made the {weights_name} file, {len(weights)-start_weights} new weights")
-
-    if start != args.total_images: # if there were new images to create, then save the new pickle
-        # write the new contents to disk
-        output = [images, answers]
-        with open(full_path+'dataset', 'wb') as fp:
-            pickle.dump(output, fp)
-        print(f"made the dataset file, {i - (start-1)} new images")
+            out.save(name, "PNG") # the png is only for viewing, the pixels are packed below
+
+            new_images.append(np.asarray(out))
+            new_answers.append(answer) 
 
+        # append the new images (then their weights, batched, skipping any that already have weights)
+        images.append(np.stack(new_images))
+        answers.append(np.stack(new_answers))
+        weights.append(make_weights(images[max(start, start_weights):], args, cache=cache))
+        print(f"added {len(new_images)} new images and {len(weights)-start_weights} new weights to {full_path}packed/")
+
+    if start < args.total_images: # if there were new images created, then plot some of them
         # plot one example of the image, segmentation and weights
         print('create batch-num.pngs')
         train_dataset = SimpleDatasets(args, transform=transforms.ToTensor())
@@ -195,44 +244,48 @@ def data(full_path, weights_name, args):
 class SimpleDatasets(Dataset):
     """ Simple white background, black rectangle dataset """
     
-    def __init__(self, args, transform=None):
+    def __init__(self, args, transform=None, return_index=False):
         """
         file (string): Path to the pickle that contains [img paths, output arrays]
         Creates the dataset if needed, and then loads it into class instance
+        return_index: samples are (img, target, index), so the model can key per sample state (e.g. warm starts) by index
         """
         self.network = args.network
         self.total_images = args.total_images
         self.size = args.img_size
         self.transform = transform
+        self.return_index = return_index
 
         full_path, weights_name = make_paths(args)
 
         # make the dataset (if needed)
         data(full_path, weights_name, args)
-        # load the dataset
-        self.images, self.segmentations,self.weights = load_dataset(full_path+'dataset', full_path+weights_name, self.total_images)
+        # open the packed dataset (memory-mapped, so records are only read from disk when indexed)
+        self.images, self.segmentations,self.weights = open_packed(full_path, weights_name)
             
     def __len__(self):
-        return len(self.images)
+        return min(len(self.images), self.total_images)
     
     def __getitem__(self, index):
         # 1. load image
-        img = cv2.imread(self.images[index], 0) # or switch to PIL.Image.open() and then img.load()?
+        img = self.images[index]
         if self.transform is not None:
             img = self.transform(img)
         
         # 2. load target (based on network)
         if self.network == 1: # weights
-            y_label = self.weights[index]
+            y_label = torch.from_numpy(self.weights[index])
         else: # simple01
             y_label = self.segmentations[index]
             if self.transform is not None: 
                 y_label = self.transform(y_label)
+        if self.return_index:
+            return (img, y_label, index)
         return (img, y_label)
     
     # TODO: actually use these helper functions
     def get_image(self, index):
-        image = cv2.imread(self.images[index], 0)
+        image = self.images[index]
         return self.transform(image) if self.transform is not None else image
 
     def get_segmentation(self, index):
@@ -240,23 +293,24 @@ class SimpleDatasets(Dataset):
         return self.transform(segmentation) if self.transform is not None else segmentation
 
     def get_weights(self, index):
-        return self.weights[index][None,:]
+        return torch.from_numpy(self.weights[index])[None,:]
 
 class CustomFolders(Dataset):
     """ Simple dataset from folders """
     
-    def __init__(self, args, transform=None):
+    def __init__(self, args, transform=None, return_index=False):
         """
         file (string): Path to the pickle that contains [img paths, output arrays]
         Creates the dataset if needed, and then loads it into class instance
+        return_index: samples are (img, target, index), as for SimpleDatasets
         """
         self.network = args.network
         self.total_images = args.total_images
         self.size = args.img_size
         self.transform = transform
+        self.return_index = return_index
 
-        img_path = args.img_path # TODO: add to argsparse, TODO: default to None
-        seg_path = args.seg_path # TODO: add to argsparse
+        img_path = args.img_path
 
         full_path, weights_name = make_paths(args, path = img_path)
 
@@ -270,6 +324,10 @@ class CustomFolders(Dataset):
 
         # load the dataset
         self.images, self.segmentations,self.weights = load_dataset(full_path+'dataset', full_path+weights_name, self.total_images)
+        # weights missing from the pickle are made (or shared) through the weights cache
+        self.cache = weight_cache(args)
+        self.spec = weight_spec(args)
+        self.radius, self.minify = args.radius, args.minify
             
     def __len__(self):
         return len(self.images)
@@ -282,11 +340,13 @@ class CustomFolders(Dataset):
         
         # 2. load target (based on network)
         if self.network == 1: # weights
-            y_label = self.weights[index]
+            y_label = self.get_weights(index)[0]
         else: # simple01
             y_label = self.segmentations[index]
             if self.transform is not None: 
                 y_label = self.transform(y_label)
+        if self.return_index:
+            return (img, y_label, index)
         return (img, y_label)
     
     # TODO: actually use these helper functions
@@ -299,7 +359,12 @@ class CustomFolders(Dataset):
         return self.transform(segmentation) if self.transform is not None else segmentation
 
     def get_weights(self, index):
-        return self.weights[index][None,:]
+        if index < len(self.weights):
+            return self.weights[index][None,:]
+        make = lambda img: manual_weight(torch.as_tensor(img)[None,None], r=self.radius, minVer=self.minify)[0].numpy()
+        img = cv2.imread(self.images[index], 0)
+        W = self.cache.get_or_compute(img, self.spec, make) if self.cache is not None else make(img)
+        return torch.from_numpy(W)[None,:]
 
 if __name__ == '__main__':
     from net_argparser import net_argparser
@@ -320,4 +385,23 @@ if __name__ == '__main__':
     train_dataset = SimpleDatasets(args, transform=transforms.ToTensor())
     for i in range(5):
         row = [train_dataset.get_image(i), train_dataset.get_segmentation(i), de_minW(train_dataset.get_weights(i))]
-        plot_multiple_images(i, row, dir='experiments/')
\ No newline at end of file
+        plot_multiple_images(i, row, dir='experiments/')
+    print('check CustomFolders samples, with and without return_index')
+    import tempfile
+    with tempfile.TemporaryDirectory() as folder:
+        paths, segmentations = [], []
+        for i in range(3):
+            img = np.full((8, 8), 255, np.uint8)
+            img[2:6, 2:6] = 0
+            paths.append(os.path.join(folder, f'{i}.png'))
+            Image.fromarray(img).save(paths[-1])
+            segmentations.append((img == 0).astype(np.float32))
+        with open(os.path.join(folder, 'dataset'), 'wb') as fp:
+            pickle.dump([paths, segmentations], fp)
+        args.network, args.img_path, args.total_images = 0, folder + '/', 3
+        for return_index in (False, True):
+            folders = CustomFolders(args, transform=transforms.ToTensor(), return_index=return_index)
+            sample = folders[1]
+            assert len(sample) == (3 if return_index else 2) and sample[0].shape == sample[1].shape == (1, 8, 8)
+            assert not return_index or sample[2] == 1
+        print('CustomFolders samples ok')
@@ -255,6 +255,7 @@ def experiment():
     W_zerods = [False,True]
     L_zerods = [False,True]
     indicies = [0, 1] # smallest and second smallest... should we avoid similar ones? or avoid near 0's?
+    nystrom_samples = 100 # landmark pixels of the Nystrom approximation of the global intensity weights
     
     e_funcs, e_funcs_text = get_eigfuncs()
     obj_funcs, const_funcs = get_objfuncs() # TODO: implement this
@@ -270,6 +271,20 @@ def experiment():
     save_plot_imgs(imgs, labels=imgs_text, output_path=save_dir,output_name=f'1images.png')
     
     for img, img_name in zip(imgs, imgs_text):
+        # Nystrom approximation of the normalized Laplacian eigenvectors of the global intensity weights, from only
+        # nystrom_samples columns of W (never the dense N x N matrix), in the same rows as the dense eigensolvers below
+        from nc_suite import nystrom_ncut, intensity_weight_matrix
+        w, v = nystrom_ncut(img, intensity_weight_matrix, samples=nystrom_samples)
+        data, plot_output = [], []
+        for index in indicies:
+            vec = v[:, index].reshape(size)
+            plot_output.append(vec)
+            vec = normalize_image(vec)
+            data.append(f'{img_name},{img.size},intensity_weight_matrix,0,W-False,L-False,nystrom({nystrom_samples}),{index},True,'
+                        f'{compute_kl_divergence(vec, truth)},{np.abs(vec - truth).sum()},{np.linalg.norm(vec - truth)},{np.min(w)},{np.max(w)}')
+        save_data(os.path.join(save_dir,'data_output.txt'), data+['\n\n'])
+        save_plot_imgs(plot_output, labels=[f'nystrom({nystrom_samples})\n{index}' for index in indicies], output_path=save_dir,output_name=f'{img_name},NYSTROM.png')
+
         weights, weights_text = get_weights(img, radii=radii)
         save_plot_imgs(weights, labels=weights_text, output_path=save_dir,output_name=f'{img_name},WEIGHTS.png')
         for weight, weight_name in zip(weights,weights_text):
@@ -13,6 +13,7 @@ from data import *
 from model_loops import test, train, validate
 from model import Net, WeightsNet
 from net_argparser import net_argparser
+import profiling
 
 # import torch.utils.tensorboard as tb
 import wandb # replacing tensorboard, fun to try out
@@ -52,6 +53,9 @@ def main():
     model = model.to(device=device)
     wandb.watch(model)
 
+    # Time the phases of the declarative nodes (no overhead unless enabled)
+    profiler = profiling.enable() if args.profile else None
+
     # TODO: add logging for images e.g. wandb.log({"examples" : [wandb.Image(im) for im in images_t]})
     # TODO: add table for images https://docs.wandb.ai/guides/integrations/pytorch
 
@@ -84,6 +88,9 @@ def main():
     if args.test:
         avg_acc, avg_loss = test(val_loader, model, criterion, device, args)
         print(f'Evaluation: avg acc - {avg_acc}, avg_loss - {avg_loss}')
+        if profiler:
+            print(profiler)
+            profiler.save(results + 'profile.json')
         return
 
     # Train the network (and test against the validation data)
@@ -109,6 +116,9 @@ def main():
                     "acc/val": v_acc,
                     "loss/train":t_loss,
                     "acc/train": t_acc})
+        if profiler: # totals over the epochs so far
+            wandb.log(profiler.wandb_dict())
+            profiler.save(results + 'profile.json')
         # if args.writer:
         #     args.writer.add_scalar("Loss/val", v_loss, epoch)
         #     args.writer.add_scalar("Acc/val", v_acc, epoch)
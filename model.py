@@ -3,7 +3,7 @@ import torch.nn as nn
 import wandb
 
 # local imports
-from nc import NormalizedCuts, de_minW
+from nc import NormalizedCuts, EigenvectorCache, de_minW
 from node import DeclarativeLayer
 
 class Net(nn.Module):
@@ -16,7 +16,12 @@ class Net(nn.Module):
         device = torch.device(f'cuda:{args.gpu}' if torch.cuda.is_available() else 'cpu')
         # the actual layers (nc is placed into dec layer to convert to general pytorch layer)
         self.weightsNet = WeightsNet(args).to(device)
-        self.nc = NormalizedCuts(eps=args.eps, gamma=args.gamma, bipart=args.bipart) # eps sets the absolute difference between objective solutions and 0
+        self.nc = NormalizedCuts(eps=args.eps, gamma=args.gamma, bipart=args.bipart, matrix_free=args.matrix_free, eig_solver=args.eig_solver, analytic_gradient=args.analytic_gradient,
+                                  symm_norm_L=args.symm_norm_L or args.eig_solver == 'nystrom', # nystrom approximates the normalized Laplacian only
+                                  multiscale_size=args.multiscale_size, multiscale_steps=args.multiscale_steps, nystrom_samples=args.nystrom_samples,
+                                  warm_start=EigenvectorCache(args.warm_start_mb) if args.warm_start_mb else None,
+                                  solve_dtype=getattr(torch, args.solve_dtype) if args.solve_dtype else None, refine=args.refine,
+                                  max_backward_memory=int(args.max_backward_mb * 2**20) if args.max_backward_mb else None, k=args.k) # eps sets the absolute difference between objective solutions and 0
         self.decl = DeclarativeLayer(self.nc).to(device) # converts the NC into a pytorch layer (forward/backward instead of solve/gradient)
         
 
@@ -28,7 +33,9 @@ class Net(nn.Module):
         self.n_channels = args.n_channels
         self.n_classes = args.n_classes
 
-    def forward(self, x):
+    def forward(self, x, index=None):
+        """index: dataset indices of the batch (SimpleDatasets with return_index), to warm start the NC eigensolves"""
+        self.nc.sample_index = index
         x = self.weightsNet(x) # make the affinity matrix (or something else that works with)
 
         if not self.minify:
@@ -72,7 +79,8 @@ class WeightsNet(nn.Module):
 
         self.last_size = self.last_dim # either its last_dim * last_dim
         if args.minify:
-            args.last_size = args.radius # or if minified its just radius x dim
+            self.last_size = args.radius # or if minified its just radius x dim
+        self.densify = args.eig_solver != 'sparse' # the sparse NC solver works on the minified band directly
 
         self.layers = nn.ModuleList()
 
@@ -90,7 +98,7 @@ class WeightsNet(nn.Module):
 
         # combine the 32x32 * last_size into the correct output size (full matrix or not...)
         x = x.view(x.size(0), self.last_size, self.last_dim)
-        if self.net_no == 0: # Passes into NC node by converting to full
+        if self.net_no == 0 and self.densify: # Passes into NC node by converting to full
             x = de_minW(x)
             # TODO: multiple by transpose to make symmetric
         return x
@@ -108,6 +116,7 @@ class PostNC(nn.Module):
     def __init__(self, args):
         super(PostNC, self).__init__()
         self.img_size = args.img_size
+        self.k = args.k # NC eigenvectors in, as channels
 
         # TODO: add a channels field for forward(...), but currently only training B/W images
         # TODO: add args for these (not worried until everything works flawlessly)
@@ -116,16 +125,16 @@ class PostNC(nn.Module):
         self.padding = 1
 
         self.layers = nn.ModuleList()
-        for k in range(len(args.net_size_post)-1):
-            self.layers.append(self.conv_block(c_in=args.net_size_post[k], c_out=args.net_size_post[k+1], 
+        net_size = [args.k] + args.net_size_post[1:] # the first layer takes the k NC eigenvectors
+        for i in range(len(net_size)-1):
+            self.layers.append(self.conv_block(c_in=net_size[i], c_out=net_size[i+1], 
                                 kernel_size=self.kernel_size, stride=self.stride, padding=self.padding))
 
         # out channles of 1 for original input size (assuming consistent kernels, stride and padding values)
-        self.lastcnn = nn.Conv2d(in_channels=args.net_size_post[-1], out_channels=1, kernel_size=self.kernel_size, stride=self.stride, padding=self.padding)
+        self.lastcnn = nn.Conv2d(in_channels=net_size[-1], out_channels=1, kernel_size=self.kernel_size, stride=self.stride, padding=self.padding)
 
     def forward(self, x):
-        # TODO: future model with support for multiple cuts will not hardcore channel number as 1?
-        x = x.view(x.size(0), 1, self.img_size[0], self.img_size[1]) # convert from NC node into this
+        x = x.view(x.size(0), self.k, self.img_size[0], self.img_size[1]) # convert from NC node into this (k eigenvectors as channels)
         for layer in self.layers:
             x = layer(x)
         x = self.lastcnn(x)
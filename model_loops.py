@@ -17,11 +17,11 @@ def test(val_loader, model, criterion, device, args):
     with torch.no_grad():
         avg_acc, avg_loss = 0,0
         i = 0
-        for input_batch, target_batch in tqdm(val_loader, desc=avg_acc, ascii=True):
+        for input_batch, target_batch, *index in tqdm(val_loader, desc=avg_acc, ascii=True): # index if the dataset returns it
             i += 1
             input_batch, target_batch = input_batch.to(device), target_batch.to(device)
 
-            output = model(input_batch)
+            output = model(input_batch, *index)
             val_loss = criterion(output, target_batch)
 
             test_output = (output > 0.5).float()
@@ -47,10 +47,10 @@ def validate(val_loader, model, device, criterion, scheduler):
     model.eval()
     with torch.no_grad():
         val_accuracy, val_loss = 0,0
-        for input_batch, target_batch in val_loader:
+        for input_batch, target_batch, *index in val_loader:
             input_batch, target_batch = input_batch.to(device), target_batch.to(device)
 
-            output = model(input_batch)
+            output = model(input_batch, *index)
             val_loss += criterion(output, target_batch)
             scheduler.step(val_loss) # Reduce LR on plateu
 
@@ -63,9 +63,9 @@ def validate(val_loader, model, device, criterion, scheduler):
 def train(train_loader, model, device, criterion, optimizer):
     model.train()
     train_accuracy, train_loss = 0,0
-    for input_batch, target_batch in tqdm(train_loader, ascii=True):
+    for input_batch, target_batch, *index in tqdm(train_loader, ascii=True): # index if the dataset returns it
         input_batch, target_batch = input_batch.to(device), target_batch.to(device)
-        output = model(input_batch)
+        output = model(input_batch, *index)
         loss = criterion(output, target_batch)
         # Compute gradient and do optimizer step
         optimizer.zero_grad()
@@ -146,7 +146,7 @@ if __name__ == '__main__':
     # NOTE: FOR ME TOMORROW, CLONE_DDN MADE TO ADD SCIKIT-LEARN OR W/E FOR ACCCURACY METRIC. WILL PROBABLY IMRPOVE MY LIFE
     # TODO: CONVERT DATASET TO 50% WHITE 50% BLACK, I THINK THIS WILL GENUINELY HELP, BUT MOSTLY ABOVE IS BETTER!
 
-    # for input_batch, target_batch in tqdm(train_loader, ascii=True):
+    # for input_batch, target_batch, *index in tqdm(train_loader, ascii=True): # index if the dataset returns it
     #     output = model(input_batch)
     #     train_loss = criterion(output, target_batch)
     #     # convert to binary classification outputs?
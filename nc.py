@@ -4,15 +4,89 @@ import matplotlib.pyplot as plt
 
 # for testing different eigensolvers..
 from functools import partial
+from collections import OrderedDict
 import scipy
+import scipy.sparse
 from scipy import linalg
+from scipy.sparse.linalg import eigsh
 
 # local imports
 from node import *
+from profiling import profiled, phase
 
 # NOTE: for all einsums, b/bc could be replaced with an ellipse ...
 
-def partition(eigenvectors):
+def partition(eigenvectors, W=None, threshold='mean'):
+    """
+    Bipartitions of a batch of eigenvectors, thresholded for all samples at once (no loop over the batch)
+
+    Arguments:
+        eigenvectors: (b, x, y) Torch tensor (or any (..., x, y) batch)
+
+        W: (b, N, N) Torch tensor or minVer style band (N = x * y), the weights of the cut, needed for threshold='ncut'
+
+        threshold: 'mean' (of each eigenvector), 'median', 'zero' or 'ncut' (Shi & Malik: the split of
+            each eigenvector with the lowest normalized cut of W, see ncut_thresholds)
+
+    Return value:
+        bipartitions: (b, x, y) Torch tensor of 0/1 (in the dtype of the eigenvectors),
+            with the pixel of the largest |eigenvector| in the 1 segment (so the sign of the eigenvector doesn't matter)
+    """
+    x, y = eigenvectors.shape[-2:]
+    vec = eigenvectors.flatten(-2) # ...,N
+    if threshold == 'mean':
+        t = vec.mean(-1, keepdim=True)
+    elif threshold == 'median':
+        t = vec.median(-1, keepdim=True).values
+    elif threshold == 'zero':
+        t = vec.new_zeros(vec.shape[:-1] + (1,))
+    elif threshold == 'ncut':
+        if W is None:
+            raise ValueError("threshold='ncut' needs the weights W")
+        t = ncut_thresholds(vec, W)[0].unsqueeze(-1)
+    else:
+        raise ValueError(f"threshold must be one of 'mean', 'median', 'zero' or 'ncut', not {threshold}")
+    bipartition = vec > t
+    seed = bipartition.gather(-1, vec.abs().argmax(-1, keepdim=True)) # segment of the largest |eigenvector|
+    bipartition = bipartition == seed
+    return bipartition.reshape(vec.shape[:-1] + (x, y)).to(eigenvectors.dtype)
+
+def ncut_thresholds(eigenvectors, W):
+    """
+    The Shi & Malik threshold of each eigenvector: of the N - 1 splits of its sorted values, the one with
+    the lowest Ncut(S, T) = cut(S, T) / assoc(S, V) + cut(S, T) / assoc(T, V) of the (symmetric) weights W.
+    All splits are evaluated at once from W permuted into the sorted order: assoc(S, V) is the cumulative sum
+    of the degrees, and cut(S, T) = assoc(S, V) - assoc(S, S), where each pixel added to S adds its weight to
+    the pixels already in S twice, plus its self weight (O(N^2) per sample).
+
+    Arguments:
+        eigenvectors: (b, N) Torch tensor (or (b, ..., N), e.g. the (b, k, N) of k-way cuts)
+
+        W: (b, N, N) Torch tensor or minVer style band
+
+    Return value:
+        (thresholds, ncuts): ((b,), (b,)) tuple of Torch tensors,
+            the eigenvector values splitting each sample (S = values <= threshold) and the Ncut of the splits
+    """
+    W = de_minW(W)
+    N = W.shape[-1]
+    values, order = eigenvectors.to(W.dtype).sort(-1)
+    shape = values.shape[:-1] + (N, N)
+    W = W.view(W.shape[:1] + (1,) * (values.dim() - 2) + (N, N)).expand(shape) # over any extra (e.g. k) dims
+    W_sorted = W.gather(-2, order.unsqueeze(-1).expand(shape)).gather(-1, order.unsqueeze(-2).expand(shape))
+    lower = torch.ones(N, N, dtype=torch.bool, device=W.device).tril(-1).to(W.dtype) # shared by the batch
+    assoc_SS = (2 * torch.einsum('...ij,ij->...i', W_sorted, lower) + W_sorted.diagonal(dim1=-2, dim2=-1)).cumsum(-1)[..., :-1] # S = the first i+1 sorted
+    assoc_SV = W_sorted.sum(-1).cumsum(-1)
+    assoc_TV = assoc_SV[..., -1:] - assoc_SV[..., :-1]
+    assoc_SV = assoc_SV[..., :-1]
+    cut = assoc_SV - assoc_SS
+    ncut = cut / assoc_SV + cut / assoc_TV
+    ncut = torch.where((assoc_SV > 0) & (assoc_TV > 0), ncut, torch.full_like(ncut, float('inf'))) # empty associations
+    ncut, i = ncut.min(-1)
+    thresholds = (values.gather(-1, i.unsqueeze(-1)) + values.gather(-1, i.unsqueeze(-1) + 1)).squeeze(-1) / 2
+    return thresholds, ncut
+
+def old_partition(eigenvectors):
     """
     eigenvectors : (b, x, y)
     for dim = (x,y)
@@ -36,13 +110,41 @@ def partition(eigenvectors):
         if bipartition[seed] != 1:
             eigenvec = eigenvec * -1
             bipartition = torch.logical_not(bipartition)
-        bipartition = bipartition.reshape(x, y).type(torch.double)
+        bipartition = bipartition.reshape(x, y).to(eigenvectors.dtype)
         
         output.append(bipartition)
     # output.
     return torch.stack(output)
 
 def manual_weight(name, r=1, minVer=False):
+    """
+    I = Image name (or a (B,C,x,y) batch of images)
+    r = radius for connections (defaults to 4-way connection with r=1)
+
+    W[u][v] = 1 if |u-v| <= r and I[u] == I[v] (for the flattened pixel indices u, v), else 0.
+    Each of the r diagonals is a comparison of the images with themselves shifted by the offset,
+    for the whole batch at once, which gives the minVer band directly (see old_manual_weight for the loop).
+    The full weights are only made (with de_minW) if not minVer.
+    """
+    if type(name) == str: 
+        I = torch.as_tensor(plt.imread(name))
+        B = 1
+        x,y = I.shape
+    else: 
+        I = torch.as_tensor(name)
+        B,C,x,y = I.shape
+
+    N = x*y
+    r = min(N//2, r) # ensure the r value doesn't exceed the axes of the outputs
+    I = I.flatten()[:B*N].reshape(B, N) # pixel u of image b is I[u + b*N] (single channel)
+
+    offsets = torch.arange(1, r + 1).unsqueeze(-1) # symmetric, so only the upper tri diagonals
+    neighbours = torch.arange(N) + offsets # r x N
+    valid = neighbours < N # the padding at the end of each diagonal is 0
+    out = ((I.unsqueeze(1) == I[:, neighbours.clamp(max=N-1)]) & valid).float() # B x r x N
+    return out if minVer else de_minW(out)
+
+def old_manual_weight(name, r=1, minVer=False):
     """
     I = Image name
     r = radius for connections (defaults to 4-way connection with r=1)
@@ -103,6 +205,28 @@ def manual_weight(name, r=1, minVer=False):
 def de_minW(out):
     """
     Returns the reconstructed weight matrix from a smaller version.
+
+    All diagonals of the whole batch are written with a single indexed assignment per triangle
+    (see old_de_minW for the per diagonal loop), keeping the dtype and device of out.
+    """
+    B,r,N = out.shape
+    if r == N: # if already square, then don't bother
+        return out
+
+    offsets = torch.arange(1, r + 1, device=out.device).unsqueeze(-1).expand(r, N)
+    rows = torch.arange(N, device=out.device).expand(r, N)
+    keep = rows < N - offsets # [:N-i] trims the padding at the end of the i'th diagonal
+    rows, cols = rows[keep], (rows + offsets)[keep]
+
+    reconst = torch.diag_embed(out.new_ones(B, N)) # the main diagonal of ones
+    values = out[:, keep] # B x nnz, in the same (diagonal, position) order as rows and cols
+    reconst[:, rows, cols] = values # upper diagonals
+    reconst[:, cols, rows] = values # lower diagonals (symmetric)
+    return reconst
+
+def old_de_minW(out):
+    """
+    Returns the reconstructed weight matrix from a smaller version.
     """
 
     # Currently this works on a [r, N] matrix
@@ -128,9 +252,186 @@ def de_minW(out):
                 reconst[b] = torch.add(reconst[b], temp) # add the lower diagonal (symmetric)
     return reconst
 
+def is_band(A):
+    """
+    True if A is a minVer style (b, r, N) band of diagonals rather than a full (b, N, N) weight matrix
+    """
+    return A.shape[-2] != A.shape[-1]
+
+def band_matvec(out, x):
+    """
+    Returns de_minW(out) @ x without forming the (b, N, N) weight matrix, in O(rN).
+
+    Arguments:
+        out: (b, r, N) minVer style band (the padding at the end of each diagonal is ignored, as in de_minW)
+        x: (b, N) or (b, N, k) vectors
+    """
+    squeeze = x.dim() == 2
+    if squeeze:
+        x = x.unsqueeze(-1)
+    r, N = out.shape[-2:]
+    Wx = x # the main diagonal of ones
+    for i in range(1, r + 1):
+        diagonal = out[:, i-1, :N-i].unsqueeze(-1)
+        Wx = Wx + torch.nn.functional.pad(diagonal * x[:, i:], (0, 0, 0, i)) # upper diagonal
+        Wx = Wx + torch.nn.functional.pad(diagonal * x[:, :N-i], (0, 0, i, 0)) # lower diagonal (symmetric)
+    return Wx.squeeze(-1) if squeeze else Wx
+
+def band_to_scipy(out):
+    """
+    Returns the (N, N) scipy.sparse csr weight matrix of a single (r, N) minVer style band (numpy array)
+    """
+    r, N = out.shape
+    upper = [out[i-1, :N-i] for i in range(1, r + 1)]
+    offsets = [0] + list(range(1, r + 1)) + list(range(-1, -r - 1, -1))
+    return scipy.sparse.diags([np.ones(N)] + upper + upper, offsets, format='csr')
+
+def to_band(A):
+    """
+    Returns the minVer style (b, r, N) band of full (b, N, N) weights if A == de_minW(band) exactly (symmetric, a main
+    diagonal of ones and zero beyond r diagonals, as de_minW makes them), otherwise None (or if the band is no smaller)
+    """
+    N = A.shape[-1]
+    if is_band(A) or not torch.all(torch.diagonal(A, 0, -2, -1) == 1):
+        return None
+    offsets = (A != 0).any(0).nonzero() # nonzeros of the whole batch
+    r = int((offsets[:, 1] - offsets[:, 0]).abs().max())
+    if r == 0 or r >= N // 2:
+        return None
+    band = A.new_zeros(A.shape[0], r, N)
+    for i in range(1, r + 1):
+        upper = torch.diagonal(A, i, -2, -1)
+        if not torch.equal(upper, torch.diagonal(A, -i, -2, -1)):
+            return None
+        band[:, i-1, :N-i] = upper
+    return band
+
+def degree(A):
+    """
+    Returns the (b, N) degree vector (column sums) of full weights or a minVer style band
+    """
+    if is_band(A):
+        return band_matvec(A, torch.ones(A.shape[0], A.shape[-1], dtype=A.dtype, device=A.device))
+    return torch.einsum('bij->bj', A)
+
+def aggregation_prolongation(A, shape):
+    """
+    Interpolation P (b, N, Nc) from a coarse grid of every other pixel in each direction of shape (X, Y) images to all
+    the pixels, weighted by the affinities A (b, N, N): each pixel interpolates from the coarse pixels it is connected
+    to in proportion to its weights to them (as in weighted aggregation, Sharon, Brandt & Basri 2000), so it is not
+    averaged across an edge of the image, and from the coarse pixel of its 2x2 block if connected to none.
+    The rows of P sum to 1, so constant vectors are interpolated exactly.
+
+    Returns P and the (ceil(X/2), ceil(Y/2)) shape of the coarse grid
+    """
+    b, N, _ = A.shape
+    X, Y = shape
+    x, y = torch.meshgrid(torch.arange(X, device=A.device), torch.arange(Y, device=A.device), indexing='ij')
+    coarse = ((x % 2 == 0) & (y % 2 == 0)).flatten().nonzero()[:, 0]
+    Nc = len(coarse)
+    P = A[:, :, coarse].clone()
+    P[:, coarse] = 0
+    P[:, coarse, torch.arange(Nc, device=A.device)] = 1 # the coarse pixels keep their value
+    total = P.sum(-1, keepdim=True)
+    block = torch.zeros(N, Nc, dtype=A.dtype, device=A.device)
+    block[torch.arange(N, device=A.device), ((x // 2) * ((Y + 1) // 2) + y // 2).flatten()] = 1
+    P = torch.where(total > 0, P / total.clamp_min(torch.finfo(A.dtype).tiny), block)
+    return P, ((X + 1) // 2, (Y + 1) // 2)
+
+def generalized_eigh(L, M, k):
+    """
+    Smallest k eigenpairs of the (b, N, N) symmetric-definite pencils L z = lambda M z, through the Cholesky factor of M.
+    Returns (w, z): ((b, k), (b, N, k)), with M-orthonormal z
+    """
+    C = torch.linalg.cholesky(M)
+    S = torch.linalg.solve_triangular(C, torch.linalg.solve_triangular(C, L, upper=False).mT, upper=False).mT # C^-1 L C^-T
+    w, u = torch.linalg.eigh(S)
+    return w[:, :k], torch.linalg.solve_triangular(C.mT, u[..., :k], upper=True)
+
+def nystrom_eigenvectors(C, landmarks, k=1, rcond=1e-10):
+    """
+    Nystrom approximation of the k+1 smallest eigenpairs of the symmetrically normalized Laplacian
+    I - D^-0.5 W D^-0.5 from only the columns C = W[:, landmarks] of the weights, in O(N m^2) time and O(N m) memory
+    for m landmarks (Fowlkes, Belongie, Chung & Malik 2004, with the one shot orthogonalisation). With the landmark
+    block A = W[S, S] and B = W[S, rest], the degrees are approximated by [A1 + B1; B^T 1 + B^T A^-1 B 1], A and B are
+    normalized by them, and the eigenvectors of Q = A + A^-0.5 B B^T A^-0.5 extend to all the pixels as
+    [A; B^T] A^-0.5 U Lambda^-0.5. Eigenvalues of A below rcond * its largest (e.g. the negative ones of a weight that
+    is not positive semi-definite) are left out of the inverses.
+
+    Arguments:
+        C: (b, N, m) Torch tensor,
+            batch of the columns of the weights at the landmarks
+
+        landmarks: (m,) Torch tensor,
+            indices of the landmark pixels (distinct)
+
+    Return value:
+        (w, v): ((b, k+1), (b, N, k+1)) tuple of Torch tensors,
+            approximate eigenvalues in ascending order and the corresponding unit eigenvectors (pixels in their order)
+    """
+    b, N, m = C.shape
+    rest = torch.ones(N, dtype=torch.bool, device=C.device)
+    rest[landmarks] = False
+    rest = rest.nonzero()[:, 0]
+    A, B = C[:, landmarks], C[:, rest].mT
+    pinv = lambda M, p: (lambda w, u: u @ torch.diag_embed(torch.where(w > rcond * w[:, -1:], w, torch.inf).pow(p)) @ u.mT)(*torch.linalg.eigh(M))
+    b1 = B.sum(-1)
+    d_a = A.sum(-1) + b1
+    d_b = B.sum(-2) + torch.einsum('bmn,bm->bn', B, (pinv(A, -1) @ b1.unsqueeze(-1)).squeeze(-1))
+    s_a = d_a.clamp_min(torch.finfo(C.dtype).tiny).rsqrt()
+    s_b = d_b.clamp_min(torch.finfo(C.dtype).tiny).rsqrt()
+    A = s_a.unsqueeze(-1) * A * s_a.unsqueeze(-2)
+    B = s_a.unsqueeze(-1) * B * s_b.unsqueeze(-2)
+    A_isqrt = pinv(A, -0.5)
+    AB = A_isqrt @ B
+    lam, U = torch.linalg.eigh(A + AB @ AB.mT)
+    lam, U = lam.flip(-1)[:, :k+1], U.flip(-1)[..., :k+1] # largest of the normalized weights, smallest of the Laplacian
+    scale = U * torch.where(lam > 0, lam, torch.inf).rsqrt().unsqueeze(-2)
+    v = torch.empty((b, N, k+1), dtype=C.dtype, device=C.device)
+    v[:, landmarks] = A @ (A_isqrt @ scale)
+    v[:, rest] = AB.mT @ scale
+    return 1 - lam, v / v.norm(dim=-2, keepdim=True)
+
 def check_symmetric(a, rtol=1e-05, atol=1e-08): # defaults of allclose
     return torch.allclose(a, a.transpose(-2,-1), rtol, atol)
 
+class EigenvectorCache:
+    """
+    The last eigenvectors solved for each training sample (keyed by dataset index), used to warm start
+    the next epoch's eigensolve of the same sample, as the learned weights only change slightly between epochs.
+
+    Entries are the (N, k+1) smallest eigenvectors in float32 on the cpu, the least recently used
+    are evicted once the entries exceed max_mb.
+    """
+    def __init__(self, max_mb=256):
+        self.max_bytes = max_mb * 2**20
+        self.entries = OrderedDict() # index -> (N, k+1) tensor, least recently used first
+        self.nbytes = 0
+        self.hits, self.misses = 0, 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, index, shape):
+        """The cached eigenvectors of sample index, or None (also if cached for a different (N, k+1) shape)"""
+        v = self.entries.get(index)
+        if v is None or v.shape != shape:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(index)
+        self.hits += 1
+        return v
+
+    def put(self, index, v):
+        """Stores the (N, k+1) eigenvectors v of sample index, then evicts down to max_mb"""
+        v = v.detach().to('cpu', torch.float32, copy=True)
+        if index in self.entries:
+            self.nbytes -= self.entries.pop(index).nbytes
+        self.entries[index] = v
+        self.nbytes += v.nbytes
+        while self.nbytes > self.max_bytes and self.entries:
+            self.nbytes -= self.entries.popitem(last=False)[1].nbytes
+
 class NormalizedCuts(AbstractDeclarativeNode): # AbstractDeclarativeNode vs EqConstDeclarativeNode
     """
     A declarative node to embed Normalized Cuts into a Neural Network
@@ -138,11 +439,34 @@ class NormalizedCuts(AbstractDeclarativeNode): # AbstractDeclarativeNode vs EqCo
     Normalized Cuts and Image Segmentation https://people.eecs.berkeley.edu/~malik/papers/SM-ncut.pdf
     Shi, J., & Malik, J. (2000)
     """
-    def __init__(self, chunk_size=None, eps=1e-8, gamma=None, experiment=None, bipart=False, symm_norm_L=False):
-        super().__init__(chunk_size=chunk_size, eps=eps, gamma=gamma) # input is divided into chunks of at most chunk_size
+    def __init__(self, chunk_size=None, eps=1e-8, gamma=None, experiment=None, bipart=False, symm_norm_L=False, vectorize=True, matrix_free=None, analytic_gradient=True, eig_solver='scipy', warm_start=None, solve_dtype=None, refine=0, max_backward_memory=None, k=1, multiscale_size=16, multiscale_steps=10, nystrom_samples=100, rows_per_pass=64):
+        super().__init__(chunk_size=chunk_size, eps=eps, gamma=gamma, vectorize=vectorize, matrix_free=matrix_free, max_backward_memory=max_backward_memory, rows_per_pass=rows_per_pass) # input is divided into chunks of at most chunk_size (or to fit max_backward_memory bytes)
         self.experiment = experiment
         self.bipart = bipart
         self.symm_norm_L = symm_norm_L
+        self.analytic_gradient = analytic_gradient # closed form eigenvector derivative (False = generic gradient of the objective)
+        self.eig_solver = eig_solver # 'scipy' (per sample func), 'eigh' (batched torch.linalg.eigh), 'lobpcg' (batched, two smallest eigenpairs only), 'sparse' (scipy.sparse, keeps minVer bands banded), 'multiscale' (batched, coarse to fine) or 'nystrom' (batched, low rank from landmark columns)
+        self.multiscale_size = multiscale_size # 'multiscale': the eigenproblem is coarsened until the image side is at most this, then solved directly
+        self.multiscale_steps = multiscale_steps # 'multiscale': lobpcg iterations refining the interpolated eigenvectors at each intermediate level (the finest iterates until converged)
+        if eig_solver == 'nystrom' and not symm_norm_L:
+            raise ValueError("eig_solver='nystrom' approximates the symmetrically normalized Laplacian, it needs symm_norm_L=True")
+        self.nystrom_samples = nystrom_samples # 'nystrom': number of landmark pixels (the solve costs O(N m^2) instead of O(N^3))
+        self.solve_dtype = solve_dtype # dtype of the eigensolve and the backward linear solve (None = dtype of A, 'lobpcg' and 'sparse' iterate in float64 regardless), outputs are in the dtype of A
+        self.refine = refine # float64 iterative refinement steps of the Fiedler vector and of the backward linear solve
+        if k > 1 and not analytic_gradient:
+            raise ValueError('k > 1 eigenvectors need the analytic_gradient (the generic gradient is of the single cut objective)')
+        if analytic_gradient and matrix_free is not None:
+            warnings.warn(f"matrix_free='{matrix_free}' is ignored by the analytic gradient, which solves the bordered system directly "
+                "(or by MINRES with eig_solver='sparse'), use analytic_gradient=False for the matrix-free generic gradient")
+        if analytic_gradient and max_backward_memory is not None:
+            warnings.warn("max_backward_memory only bounds the batched passes of jacobian() with the analytic gradient, gradient() "
+                "ignores it (its memory is one b x N x N bordered system), use analytic_gradient=False for the chunked generic gradient")
+        self.k = k # number of eigenvectors output, the 2nd to (k+1)th smallest (k > 1 outputs them as (b, k, x, y) channels)
+        if warm_start is not None and eig_solver != 'lobpcg':
+            raise ValueError(f"warm_start needs the iterative eig_solver='lobpcg', not {eig_solver}")
+        self.warm_start = warm_start # EigenvectorCache seeding lobpcg with each sample's last eigenvectors (or None)
+        self.sample_index = None # dataset indices of the batch being solved (set by the model), keys of warm_start
+        self.eig_stats = {'solves': 0, 'warm': 0, 'iterations': 0} # batched eigensolves, warm started samples and solver iterations
         
     def objective(self, x, y):
         """
@@ -159,7 +483,13 @@ class NormalizedCuts(AbstractDeclarativeNode): # AbstractDeclarativeNode vs EqCo
             objectives: (b, x) Torch tensor,
                 batch of objective function evaluations
         """
-        x = de_minW(x) # check if needs to be converted from minVer style
+        if is_band(x): # y^T * (D-W) * y = y^T * D * y - y^T * W * y, without expanding the band
+            y = y.flatten(-2)
+            d = degree(x).to(y.dtype)
+            yDy = torch.einsum('bi,bi->b', d * y, y)
+            yWy = torch.einsum('bi,bi->b', band_matvec(x.to(y.dtype), y), y)
+            return ((yDy - yWy) / yDy).unsqueeze(-1)
+
         y = y.flatten(-2) # converts to the vector with shape = (b, 1, N) 
         b, N = y.shape
         y = y.reshape(b,1,N) # convert to a col vector
@@ -218,7 +548,7 @@ class NormalizedCuts(AbstractDeclarativeNode): # AbstractDeclarativeNode vs EqCo
         y = y.reshape(b,1,N) # does the same as extending and tranposing
         # y = torch.transpose(y, 1, 2)
 
-        d = x.sum(1, dtype=y.dtype) # row sum
+        d = degree(x).to(y.dtype) # row sum (works on minVer style bands too)
         D = torch.diag_embed(d)
         ONE = torch.ones((b,N,1), dtype=y.dtype)
         
@@ -242,7 +572,8 @@ class NormalizedCuts(AbstractDeclarativeNode): # AbstractDeclarativeNode vs EqCo
         # # return the constraint calculation, squeezed to output size
         # return torch.einsum('bIK,bKJ->bIJ', torch.einsum('bIK,bKJ->bIJ',y, D), ONE).squeeze(-2)
 
-    def solve(self, A, func=partial(linalg.eigh, check_finite=False, subset_by_index=[0,1], driver='evr')):
+    @profiled('nc.solve')
+    def solve(self, A, func=None):
         # expected=None
 
         """ 
@@ -252,6 +583,16 @@ class NormalizedCuts(AbstractDeclarativeNode): # AbstractDeclarativeNode vs EqCo
             A: (b, N, N) Torch tensor,
                 batch of affinity/weight tensors (N = x * y from orignal x,y images)
 
+            func: eigensolver applied to each sample on the cpu, only used by eig_solver='scipy'
+                (default scipy.linalg.eigh of the k+1 smallest eigenpairs).
+                The 'eigh', 'lobpcg' and 'multiscale' backends solve the whole batch on the device of A instead,
+                'nystrom' approximately from nystrom_samples columns of A (nystrom_eigenvectors),
+                and 'sparse' solves each sample with scipy.sparse without expanding a minVer style band.
+
+        Return value:
+            (y, ctx): y the (b, x, y) second smallest eigenvectors, or the (b, k, x, y) 2nd to (k+1)th smallest
+                for k > 1 (all from the one partial eigendecomposition), and ctx {'eigenvalues': (b,) or (b, k)}
+
         TODO: pass a parameter to avoid hardcoded output dimensions
         """        
         # Implementation notes:
@@ -260,37 +601,58 @@ class NormalizedCuts(AbstractDeclarativeNode): # AbstractDeclarativeNode vs EqCo
         # - inf in D_inv_sqrt don't matter as other functions used seem to handle it fine, previously avoided by only inverting the diagonal
 
         A = A.detach() # TODO : verify if this breaks anything
-
-        A = de_minW(A) # check if needs to be converted from minVer style
+        if func is None:
+            func = partial(linalg.eigh, check_finite=False, subset_by_index=[0, self.k], driver='evr')
+
+        if self.eig_solver == 'sparse': # O(rN) memory for minVer style bands
+            b, N = A.shape[0], A.shape[-1]
+            out_size = int(np.sqrt(N)) # NOTE: assumes it is square..
+            w, v = self.sparse_eigensolve(A)
+            output, eigenvalues = self._output(torch.tensor(v), torch.tensor(w), (b, out_size, out_size))
+            return output.to(A.device, A.dtype).requires_grad_(True), {'eigenvalues': eigenvalues.to(A.device, A.dtype)}
+
+        A_in = A # residuals of the refinement are computed from the input (a minVer style band stays banded)
+        with phase('nc.de_minW'):
+            A = de_minW(A).to(self.solve_dtype or A.dtype) # check if needs to be converted from minVer style
         b,x,y = A.shape
         out_size = int(np.sqrt(x)) # NOTE: assumes it is square..
         output_size = (b,out_size,out_size)
 
-        # can also replace bc with ...
-        d = torch.einsum('bij->bj', A) # eqv to A.sum(0) --- d vector
-        D = torch.diag_embed(d) # D = matrix with d on diagonal
-        D_inv_sqrt = torch.diag_embed(d.pow(-0.5)) # previously had pow inside diag
-
-        L = D-A # Laplacian matrix
-
-        if self.symm_norm_L:
-            # The symmetrically normalized laplacian can be calculated as D^-0.5 * L * D^-0.5 or eqv. I - D^-0.5 * A * D^-0.5 
-            L_norm = torch.einsum('...ij,...jk->...ik', torch.einsum('...ij,...jk->...ik', D_inv_sqrt , L) , D_inv_sqrt)
-            # L_norm = L_norm.to(A.device)
-        else:
-            L_norm = L
-
-        output = []
-        for i in range(b):
-            # Solve using the specified eigenvector method
-            y = func(L_norm.cpu()[i])
-            # Take solution out of eigenvalue, eigenvector pair (if needed)
-            if isinstance(y,tuple):
-                (w,v) = y # TODO: verify this makes sense for all options (and they aren't in reverse order or include trivial answer..)
-                y = v[:,1,None] # N,1 (Add an additional :, at start if also working on batches)
-            output.append(y)
+        L_norm = self.laplacian(A) if self.eig_solver != 'nystrom' else None # only the landmark columns are used
+
+        if self.eig_solver != 'scipy':
+            index = self.sample_index if self.warm_start is not None else None
+            X = self.warm_start_vectors(index, b, x, A.device) if index is not None else None
+            if self.eig_solver == 'multiscale':
+                w, v = self.multiscale_eigensolve(A, L_norm)
+            elif self.eig_solver == 'nystrom':
+                landmarks = torch.randperm(x, generator=torch.Generator().manual_seed(0))[:self.nystrom_samples].to(A.device) # seeded for reproducible outputs
+                with phase('nc.eigensolve'):
+                    w, v = nystrom_eigenvectors(A[..., landmarks], landmarks, self.k)
+            else:
+                w, v = self.batch_eigensolve(L_norm, X=X)
+            if index is not None:
+                for i, v_i in zip(index.tolist(), v):
+                    self.warm_start.put(i, v_i)
+            output, eigenvalues = v[..., 1:], w[:, 1:] # without the trivial eigenvector
+            if self.refine:
+                output, eigenvalues = self.refine_eigenpairs(A_in, A, output)
+            output, eigenvalues = self._output(output, eigenvalues, output_size)
+            return output.to(A_in.dtype).requires_grad_(True), {'eigenvalues': eigenvalues}
+
+        output, eigenvalues = [], []
+        with phase('nc.eigensolve'):
+            for i in range(b):
+                # Solve using the specified eigenvector method
+                y = func(L_norm.cpu()[i])
+                # Take solution out of eigenvalue, eigenvector pair (if needed)
+                if isinstance(y,tuple):
+                    (w,v) = y # TODO: verify this makes sense for all options (and they aren't in reverse order or include trivial answer..)
+                    y = v[:,1:self.k+1] # N,k (Add an additional :, at start if also working on batches)
+                    eigenvalues.append(w[1:self.k+1])
+                output.append(y)
         output = np.asarray(output)
-        output = output.reshape(output_size)
+        output = output.reshape(b, x, -1) # b,N,k
         
         
         # DNN NOTE: Detach inputs from graph, attach only the output (or if using optimisation to solve you can with torch.enable_grad() ( ... optim ))
@@ -312,8 +674,501 @@ class NormalizedCuts(AbstractDeclarativeNode): # AbstractDeclarativeNode vs EqCo
         #if output[0][0][0] > 0:
         #    output *= -1
             
-        output = torch.tensor(output)
-        return output.to(A.device).requires_grad_(True), None
+        output = torch.tensor(output).to(A.device)
+
+        # eigenvalue of each output, reused by gradient (which recomputes it if func only returns eigenvectors)
+        eigenvalues = torch.tensor(np.asarray(eigenvalues)).to(A.device) if len(eigenvalues) == b else None
+        if self.refine:
+            output, eigenvalues = self.refine_eigenpairs(A_in, A, output)
+        output, eigenvalues = self._output(output, eigenvalues, output_size)
+        ctx = {'eigenvalues': eigenvalues} if eigenvalues is not None else None
+        return output.to(A_in.dtype).requires_grad_(True), ctx
+
+    def _output(self, v, w, output_size):
+        """
+        The (b, N, k) eigenvectors v and (b, k) eigenvalues w (or None) as the solve outputs,
+        ((b, x, y), (b,)) if k == 1 or ((b, k, x, y), (b, k)) otherwise
+        """
+        if self.k == 1:
+            return v[..., 0].reshape(output_size), None if w is None else w[:, 0]
+        b, x, y = output_size
+        return v.mT.reshape(b, self.k, x, y), w
+
+    @profiled('nc.refine')
+    def refine_eigenpairs(self, A, A_solve, y):
+        """
+        Iterative refinement in float64 of the Fiedler vectors y solved in a lower precision: refine Newton steps
+        [M - lambda*I, y; y^T, 0] [dy; mu] = [-(M*y - lambda*y); 0], with the bordered matrix factorized once in
+        the solve dtype and only the residuals (and the Rayleigh quotients lambda) in float64.
+        Each of the k eigenvectors is refined on its own (one factorization each).
+
+        Arguments:
+            A: (b, r, N) or (b, N, N) Torch tensor,
+                batch of minVer style bands or full weights, as input to solve (the residuals are computed from these)
+
+            A_solve: (b, N, N) Torch tensor,
+                the full weights in the solve dtype
+
+            y: (b, N, k) Torch tensor,
+                batch of unit eigenvectors
+
+        Return value:
+            (y, eigenvalues): ((b, N, k), (b, k)) tuple of float64 Torch tensors
+        """
+        N = y.shape[1]
+        A_64 = A.double()
+        d = degree(A_64)
+        ys, eigenvalues = [], []
+        for j in range(y.shape[-1]):
+            K = self._factor_linear_system(self._bordered_system(A_solve, y[..., j].to(A_solve.dtype), None), cholesky=False)
+            y_j = y[..., j].double()
+            for _ in range(self.refine):
+                My = self.laplacian_matvec(A_64, y_j, d)
+                lam = torch.einsum('bi,bi->b', y_j, My)
+                r = My - lam.unsqueeze(-1) * y_j
+                rhs = torch.cat((-r, r.new_zeros(r.shape[0], 1)), dim=-1).unsqueeze(-1).to(A_solve.dtype)
+                y_j = y_j + self._solve_factored(K, rhs)[:, :N, 0].double()
+                y_j = y_j / y_j.norm(dim=-1, keepdim=True)
+            ys.append(y_j)
+            eigenvalues.append(torch.einsum('bi,bi->b', y_j, self.laplacian_matvec(A_64, y_j, d)))
+        return torch.stack(ys, dim=-1), torch.stack(eigenvalues, dim=-1)
+
+    def warm_start_vectors(self, index, b, N, device):
+        """
+        Starting (b, N, k+1) subspace for lobpcg: the cached eigenvectors of each sample in warm_start,
+        and the seeded random vectors of a cold start for the samples not cached (yet).
+        """
+        X = torch.randn((b, N, self.k + 1), generator=torch.Generator().manual_seed(0), dtype=torch.double)
+        for j, i in enumerate(index.tolist()):
+            v = self.warm_start.get(i, X.shape[1:])
+            if v is not None:
+                X[j] = v
+                self.eig_stats['warm'] += 1
+        return X.to(device)
+
+    @profiled('nc.eigensolve')
+    def batch_eigensolve(self, L, X=None):
+        """
+        Smallest k+1 eigenpairs of a batch of symmetric matrices, computed on the device of L
+        without a loop over the batch.
+
+        Arguments:
+            L: (b, N, N) Torch tensor,
+                batch of Laplacians
+
+            X: (b, N, k+1) Torch tensor or None,
+                starting subspace for 'lobpcg' (e.g. the previous eigenvectors of the same samples),
+                seeded random vectors if None. The solver iterations are added to eig_stats.
+
+        Return value:
+            (w, v): ((b, k+1), (b, N, k+1)) tuple of Torch tensors,
+                eigenvalues in ascending order and the corresponding eigenvectors
+        """
+        if self.eig_solver == 'eigh': # full spectrum
+            w, v = torch.linalg.eigh(L)
+            return w[:, :self.k+1], v[..., :self.k+1]
+        elif self.eig_solver == 'lobpcg': # partial spectrum, seeded for reproducible outputs
+            # in double as the Fiedler value is often ~1e-4 of ||L||, below what float32 resolves,
+            # and with more than the default 20 iterations as the gap to the third eigenvalue is small
+            if X is None:
+                X = torch.randn(L.shape[:-1] + (self.k + 1,), generator=torch.Generator().manual_seed(0), dtype=torch.double).to(L.device)
+            return self._lobpcg(L, X)
+        raise ValueError(f"eig_solver must be one of 'scipy', 'eigh', 'lobpcg', 'sparse', 'multiscale' or 'nystrom', not {self.eig_solver}")
+
+    def _lobpcg(self, L, X, niter=200, B=None):
+        """
+        Smallest k+1 eigenpairs of L (of L z = lambda B z if B is given) by lobpcg in float64 from the (b, N, k+1)
+        starting vectors X, counted in eig_stats
+        """
+        steps = [0]
+        def tracker(worker):
+            steps[0] = worker.ivars['istep']
+        w, v = torch.lobpcg(L.double(), k=self.k+1, B=None if B is None else B.double(), X=X.double(), largest=False, niter=niter, tracker=tracker)
+        self.eig_stats['solves'] += 1
+        self.eig_stats['iterations'] += steps[0]
+        return w.to(L.dtype), v.to(L.dtype)
+
+    @profiled('nc.eigensolve')
+    def multiscale_eigensolve(self, A, L=None):
+        """
+        Smallest k+1 eigenpairs of laplacian(A), coarse to fine. The eigenproblem is the generalised
+        (D - A) z = lambda M z (M = D if symm_norm_L, for y = D^0.5 z, otherwise M = I), which is projected
+        (P^T (D - A) P, P^T M P, P from aggregation_prolongation) onto coarser grids until the image side is at most
+        multiscale_size. That level is solved directly (generalized_eigh), and the eigenvectors are interpolated
+        (z = P z) to each finer level as the starting vectors of multiscale_steps lobpcg iterations, and of lobpcg
+        until converged (as eig_solver='lobpcg') at the finest.
+
+        Arguments:
+            A: (b, N, N) Torch tensor,
+                batch of affinity/weight tensors of square images
+
+            L: (b, N, N) Torch tensor or None,
+                laplacian(A) if already computed
+
+        Return value:
+            (w, v): ((b, k+1), (b, N, k+1)) tuple of Torch tensors, as batch_eigensolve
+        """
+        L = self.laplacian(A) if L is None else L
+        side = int(np.sqrt(A.shape[-1])) # NOTE: assumes it is square..
+        d = degree(A)
+        A_l, L_l, M_l, shape = A, torch.diag_embed(d) - A, torch.diag_embed(d) if self.symm_norm_L else None, (side, side)
+        levels = [] # (L, M, P) of each finer level, M None for the identity
+        while max(shape) > self.multiscale_size:
+            P, shape = aggregation_prolongation(A_l, shape)
+            levels.append((L_l, M_l, P))
+            A_l, L_l = P.mT @ A_l @ P, P.mT @ L_l @ P
+            M_l = P.mT @ P if M_l is None else P.mT @ M_l @ P
+        if not levels: # already coarse
+            w, v = torch.linalg.eigh(L)
+            return w[:, :self.k+1], v[..., :self.k+1]
+        w, z = generalized_eigh(L_l, M_l, self.k + 1)
+        for i in range(len(levels) - 1, 0, -1):
+            L_l, M_l, P = levels[i]
+            w, z = self._lobpcg(L_l, P @ z, niter=self.multiscale_steps, B=M_l)
+        z = levels[0][2] @ z
+        return self._lobpcg(L, z * d.sqrt().unsqueeze(-1) if self.symm_norm_L else z)
+
+    @profiled('nc.eigensolve')
+    def sparse_eigensolve(self, A, sigma=-1e-6):
+        """
+        2nd to (k+1)th smallest eigenpairs of the Laplacian of each sample, by shift-invert Lanczos
+        (scipy.sparse.linalg.eigsh) on a scipy.sparse Laplacian built directly from the band.
+
+        Arguments:
+            A: (b, r, N) or (b, N, N) Torch tensor,
+                batch of minVer style bands (or full weights, of which only the nonzeros are kept)
+
+            sigma: shift below the spectrum, so the eigenvalues nearest to it are the two smallest
+                (the Laplacian is positive semi-definite) and L - sigma*I is non-singular to factorise
+
+        Return value:
+            (w, v): ((b, k), (b, N, k)) tuple of numpy arrays,
+                eigenvalues in ascending order and the corresponding unit eigenvectors
+        """
+        rng = np.random.default_rng(0) # reproducible starting vectors
+        w, v = [], []
+        for a in A.cpu().double().numpy():
+            W = band_to_scipy(a) if is_band(a) else scipy.sparse.csr_matrix(a)
+            d = np.asarray(W.sum(0)).ravel()
+            L = scipy.sparse.diags(d) - W
+            if self.symm_norm_L:
+                D_inv_sqrt = scipy.sparse.diags(d ** -0.5)
+                L = D_inv_sqrt @ L @ D_inv_sqrt
+            wi, vi = eigsh(L.tocsc(), k=self.k+1, sigma=sigma, which='LM', v0=rng.standard_normal(len(d)))
+            i = np.argsort(wi)[1:]
+            w.append(wi[i])
+            v.append(vi[:, i])
+        return np.asarray(w), np.stack(v)
+
+    @profiled('nc.laplacian')
+    def laplacian(self, A):
+        """
+        The Laplacian whose second smallest eigenvector is the solution,
+        L = D - A or the symmetrically normalized D^-0.5 * (D - A) * D^-0.5 if symm_norm_L
+
+        Arguments:
+            A: (b, N, N) Torch tensor,
+                batch of affinity/weight tensors (or minVer style)
+
+        Return value:
+            L: (b, N, N) Torch tensor,
+                batch of Laplacians
+        """
+        A = de_minW(A) # check if needs to be converted from minVer style
+        d = torch.einsum('bij->bj', A) # eqv to A.sum(0) --- d vector
+        L = torch.diag_embed(d) - A # Laplacian matrix, D = matrix with d on diagonal
+
+        if self.symm_norm_L:
+            # The symmetrically normalized laplacian can be calculated as D^-0.5 * L * D^-0.5 or eqv. I - D^-0.5 * A * D^-0.5 
+            # scaling rows and columns directly avoids the two dense matrix products with diag(d^-0.5)
+            d_inv_sqrt = d.pow(-0.5)
+            L = d_inv_sqrt.unsqueeze(-1) * L * d_inv_sqrt.unsqueeze(-2)
+        return L
+
+    def laplacian_matvec(self, A, x, d=None):
+        """
+        Returns laplacian(A) @ x without forming the Laplacian (or expanding a minVer style band)
+
+        Arguments:
+            A: (b, r, N) or (b, N, N) Torch tensor,
+                batch of minVer style bands or full affinity/weight tensors
+
+            x: (b, N) Torch tensor,
+                batch of vectors
+
+            d: (b, N) Torch tensor or None,
+                degree(A) if already computed (e.g. for repeated products)
+        """
+        d = degree(A) if d is None else d
+        if self.symm_norm_L:
+            x = x * d.pow(-0.5)
+        Ax = band_matvec(A, x) if is_band(A) else torch.einsum('bij,bj->bi', A, x)
+        Lx = d * x - Ax
+        if self.symm_norm_L:
+            Lx = Lx * d.pow(-0.5)
+        return Lx
+
+    @profiled('nc.backward_context')
+    def backward_context(self, A, y=None, ctx=None):
+        """
+        Saves the minVer style band of a full A that is one (e.g. from de_minW in WeightsNet with minify) instead of
+        the b x N x N weights until the backward pass, which rebuilds A from the band with de_minW.
+        y and the eigenvalues (in ctx) are saved by DeclarativeFunction anyway.
+        """
+        band = to_band(A)
+        if band is None:
+            return (A,), None
+        return (band,), lambda band: (de_minW(band),)
+
+    @profiled('nc.gradient')
+    def gradient(self, *xs, y=None, v=None, ctx=None):
+        """
+        Analytic vector--Jacobian product of the second smallest eigenvector y of the Laplacian M = laplacian(A).
+
+        For a simple eigenvalue lambda with unit eigenvector y, dy = (lambda*I - M)^+ dM y, where ^+ is the
+        pseudo-inverse on the complement of y (the (lambda_k - lambda_j)^-1 formula). So the gradient wrt M is u y^T with
+            u = (lambda*I - M)^+ (I - y y^T) v
+        which is a single bordered linear solve of (M - lambda*I) restricted to the complement of y.
+        The gradient wrt A then follows from one backward pass through the Laplacian construction,
+        instead of the O(N) backward passes of the generic fYY and fXY Jacobians.
+
+        With eig_solver='sparse' the bordered solve is replaced by MINRES on the complement of y, and the
+        backward pass by one through laplacian_matvec, so a minVer style band is never expanded.
+
+        The bordered system is solved in solve_dtype, then improved by refine steps of float64 iterative refinement
+        (in float32 alone the small eigengap costs most of the gradient's accuracy, see benchmark.py precision).
+
+        Set analytic_gradient=False to use the generic AbstractDeclarativeNode.gradient of the objective instead.
+
+        For k > 1 eigenvectors the gradient wrt M is the sum of u_j y_j^T over the eigenvectors, with one bordered
+        solve (of M - lambda_j*I) each. This assumes simple eigenvalues, so it grows large as eigenvalues of the k+1
+        smallest come close.
+
+        Arguments:
+            xs: ((b, N, N),) tuple of Torch tensors,
+                batch of affinity/weight tensors (or minVer style)
+
+            y: (b, x, y) (or (b, k, x, y)) Torch tensor or None,
+                batch of solutions (unit eigenvectors) from solve
+
+            v: (b, x, y) (or (b, k, x, y)) Torch tensor or None,
+                batch of gradients of the loss function with respect to y
+
+            ctx: dictionary from solve, the 'eigenvalues' (b,) (or (b, k)) are recomputed from y if not present
+
+        Return value:
+            gradients: ((b, N, N),) tuple of Torch tensors,
+                batch of gradients of the loss function with respect to A
+        """
+        if not self.analytic_gradient:
+            return super().gradient(*xs, y=y, v=v, ctx=ctx)
+
+        A, = xs
+        if not (isinstance(A, torch.Tensor) and A.requires_grad):
+            return (None,)
+        if y is None:
+            y, ctx = torch.no_grad()(self.solve)(A)
+        if v is None:
+            v = torch.ones_like(y)
+
+        b = A.shape[0]
+        if self.eig_solver == 'sparse':
+            y, v = y.reshape(b, self.k, -1), v.reshape(b, self.k, -1)
+            return (sum(self._sparse_gradient(A, y[:, j], v[:, j], self._eigenpair_ctx(ctx, j)) for j in range(self.k)),)
+
+        with torch.enable_grad():
+            A = A.detach().requires_grad_(True)
+            A_full = de_minW(A) # bxNxN (A itself if not minVer style)
+        N = A_full.shape[-1]
+        y = y.detach().reshape(b, self.k, N).to(A_full.dtype)
+        v = v.detach().reshape(b, self.k, N).to(A_full.dtype)
+
+        # Solve (M - lambda*I) u = -(I - y y^T) v subject to y^T u = 0 as the bordered system (for each eigenvector)
+        us = []
+        for j in range(self.k):
+            y_j, v_j, ctx_j = y[:, j], v[:, j], self._eigenpair_ctx(ctx, j)
+            Pv = v_j - torch.einsum('bi,bi->b', y_j, v_j).unsqueeze(-1) * y_j
+            with phase('nc.bordered_solve'):
+                A_solve = A_full.detach().to(self.solve_dtype or A_full.dtype)
+                K = self._bordered_system(A_solve, y_j.to(A_solve.dtype), ctx_j)
+                del A_solve
+                rhs = torch.cat((-Pv, Pv.new_zeros(b, 1)), dim=-1).unsqueeze(-1).to(K.dtype) # bx(N+1)x1
+                if self.refine:
+                    u = self._refined_solve(K, rhs, A.detach(), y_j, ctx_j)
+                else:
+                    u = self._solve_factored(self._factor_linear_system(K, cholesky=False), rhs)[:, :N, 0] # bxN
+                del K # only one b x N x N buffer at a time from here
+            us.append(u.to(A_full.dtype))
+
+        # Backpropagate the gradient wrt M (sum of u_j y_j^T) through the Laplacian construction (and de_minW)
+        gradient = self._laplacian_vjp(A_full.detach(), torch.stack(us, dim=-1), y.mT)
+        if is_band(A):
+            gradient, = torch.autograd.grad(A_full, A, grad_outputs=gradient)
+        return (gradient,)
+
+    def _eigenpair_ctx(self, ctx, j):
+        """The ctx of solve for the j-th of the k eigenvectors alone (its (b,) eigenvalues)"""
+        if self.k == 1 or ctx is None or 'eigenvalues' not in ctx:
+            return ctx
+        return {**ctx, 'eigenvalues': ctx['eigenvalues'][:, j]}
+
+    def _bordered_system(self, A, y, ctx):
+        """
+        The bordered matrix [M - lambda*I, y; y^T, 0] of the analytic gradient (M = laplacian(A)), which is non-singular
+        for a simple eigenvalue lambda, so [u; mu] = K^-1 [-(I - y y^T) v; 0] is the solution with y^T u = 0.
+        It is singular for a repeated lambda (e.g. a disconnected graph), so it is factorized with
+        _factor_linear_system, which takes the pseudo-inverse (least squares u) of only those samples.
+        M is written into K in place, rather than formed separately and copied.
+        """
+        A = de_minW(A)
+        b, N, _ = A.shape
+        d = degree(A)
+        if ctx is not None and 'eigenvalues' in ctx:
+            lam = ctx['eigenvalues'].to(A.dtype) # b
+        else: # Rayleigh quotient of the unit eigenvector
+            lam = torch.einsum('bi,bi->b', y, self.laplacian_matvec(A, y, d))
+        K = A.new_zeros(b, N + 1, N + 1)
+        M = K[:, :N, :N]
+        M.copy_(A).neg_()
+        if self.symm_norm_L: # D^-0.5 (D - A) D^-0.5 = I - D^-0.5 A D^-0.5
+            d_inv_sqrt = d.pow(-0.5)
+            M.mul_(d_inv_sqrt.unsqueeze(-1)).mul_(d_inv_sqrt.unsqueeze(-2))
+            M.diagonal(dim1=-2, dim2=-1).add_(1 - lam.unsqueeze(-1))
+        else:
+            M.diagonal(dim1=-2, dim2=-1).add_(d - lam.unsqueeze(-1))
+        K[:, :N, N] = y
+        K[:, N, :N] = y
+        return K
+
+    @profiled('nc.refine')
+    def _refined_solve(self, K, rhs, A, y, ctx):
+        """
+        u of the bordered system K [u; mu] = rhs (from _bordered_system), factorized once in the dtype of K and
+        then improved by refine steps of iterative refinement, with the residuals computed in float64 from A
+        (full weights or a minVer style band) rather than from K
+        """
+        N, dtype = K.shape[-1] - 1, K.dtype
+        K = self._factor_linear_system(K, cholesky=False)
+        x = self._solve_factored(K, rhs).double()
+        A, y, rhs = A.double(), y.double(), rhs.double()
+        d = degree(A)
+        if ctx is not None and 'eigenvalues' in ctx:
+            lam = ctx['eigenvalues'].double()
+        else:
+            lam = torch.einsum('bi,bi->b', y, self.laplacian_matvec(A, y, d))
+        for _ in range(self.refine):
+            u, mu = x[:, :N, 0], x[:, N:, 0]
+            Kx = torch.cat((self.laplacian_matvec(A, u, d) - lam.unsqueeze(-1) * u + mu * y, torch.einsum('bi,bi->b', y, u).unsqueeze(-1)), dim=-1)
+            x = x + self._solve_factored(K, (rhs - Kx.unsqueeze(-1)).to(dtype)).double()
+        return x[:, :N, 0]
+
+    @profiled('nc.laplacian_vjp')
+    def _laplacian_vjp(self, A, u, y):
+        """
+        Gradient wrt full A (b, N, N) of u^T laplacian(A) y, i.e. u y^T backpropagated through the Laplacian, in closed
+        form with a single b x N x N allocation. As D holds the column sums of A, for L = D - A it is 1 (u*y)^T - u y^T,
+        and for L = S (D - A) S with S = D^-0.5 it is 1 c^T - (s*u) (s*y)^T, c = s^3 * (u * A(s*y) + y * A^T(s*u)) / 2.
+        u and y are (b, N, k), for the sum over the k columns (of the k eigenvectors).
+        """
+        if self.symm_norm_L:
+            s = degree(A).pow(-0.5).unsqueeze(-1)
+            us, ys = u * s, y * s
+            c = 0.5 * s.pow(3) * (u * torch.einsum('bij,bjk->bik', A, ys) + y * torch.einsum('bij,bik->bjk', A, us))
+            u, y = us, ys
+        else:
+            c = u * y
+        return torch.baddbmm(c.sum(-1).unsqueeze(-2).expand(A.shape), u, y.mT, alpha=-1)
+
+    @profiled('nc.jacobian')
+    def jacobian(self, *xs, y=None, ctx=None, chunk_size=None):
+        """
+        Jacobian of the second smallest eigenvector y wrt A, the analytic gradient for every output at once:
+        the bordered system is factorized once and solved for all N right-hand sides -(I - y y^T), then the
+        gradients wrt M (u_k y^T) are backpropagated through the Laplacian construction in batched passes
+        of chunk_size outputs (None = all N, or as many as fit max_backward_memory, bounds the memory of the backward
+        pass to that many b x N x N).
+
+        Set analytic_gradient=False for the generic AbstractDeclarativeNode.jacobian of the objective,
+        eig_solver='sparse' (and k > 1 eigenvectors) computes one gradient per output instead.
+
+        Return value:
+            jacobians: ((b, x, y, N, N),) tuple of Torch tensors,
+                batch of Jacobians of y with respect to A (or (b, x, y, r, N) for minVer style A)
+        """
+        if not self.analytic_gradient:
+            return self._jacobian_factored(*xs, y=y, ctx=ctx)
+        if self.eig_solver == 'sparse' or self.k > 1:
+            return self._jacobian_from_gradients(*xs, y=y, ctx=ctx)
+
+        A, = xs
+        if not (isinstance(A, torch.Tensor) and A.requires_grad):
+            return (None,)
+        if y is None:
+            y, ctx = torch.no_grad()(self.solve)(A)
+
+        with torch.enable_grad():
+            A = A.detach().requires_grad_(True)
+            M = self.laplacian(A) # bxNxN
+        b, N, _ = M.shape
+        y_shape = y.shape
+        y = y.detach().reshape(b, N).to(M.dtype)
+
+        # Column k of U is u for v = e_k
+        K = self._bordered_system(A.detach(), y, ctx)
+        P = torch.eye(N, dtype=M.dtype, device=M.device) - y.unsqueeze(-1) * y.unsqueeze(-2) # bxNxN
+        rhs = torch.cat((-P, P.new_zeros(b, 1, N)), dim=1) # bx(N+1)xN
+        U = self._solve_factored(self._factor_linear_system(K, cholesky=False), rhs)[:, :N, :] # bxNxN
+
+        jacobian = []
+        if chunk_size is None and self.max_backward_memory is not None: # about 3 b x N x N per output in the batched pass
+            chunk_size = max(1, self.max_backward_memory // (3 * b * N * N * M.element_size()))
+        chunk_size = N if chunk_size is None else chunk_size
+        for k in range(0, N, chunk_size):
+            grad_outputs = U[:, :, k:k+chunk_size].permute(2, 0, 1).unsqueeze(-1) * y.unsqueeze(-2) # kxbxNxN
+            J, = torch.autograd.grad(M, A, grad_outputs=grad_outputs, retain_graph=True, is_grads_batched=True)
+            jacobian.append(J.transpose(0, 1)) # bxkx...
+        return (torch.cat(jacobian, dim=1).reshape(y_shape + A.shape[1:]),)
+
+    @profiled('nc.sparse_gradient')
+    def _sparse_gradient(self, A, y, v, ctx):
+        """
+        The analytic gradient of gradient(), using only products with the Laplacian (O(rN) for bands),
+        except for the samples where MINRES does not converge, which are solved densely
+        """
+        b = A.shape[0]
+        y = y.detach().reshape(b, -1).double() # in double as MINRES converges to matrix_free_tol
+        v = v.detach().reshape(b, -1).double()
+        A_y = A.detach().double()
+
+        if ctx is not None and 'eigenvalues' in ctx:
+            lam = ctx['eigenvalues'].double() # b
+        else: # Rayleigh quotient of the unit eigenvector
+            lam = torch.einsum('bi,bi->b', y, self.laplacian_matvec(A_y, y))
+
+        # (M - lambda*I) u = -(I - y y^T) v is singular along y but consistent, so the minimum-norm
+        # MINRES solution of the projected system is the u orthogonal to y
+        d = degree(A_y)
+        P = lambda x: x - torch.einsum('bi,bi->b', y, x).unsqueeze(-1) * y
+        K = lambda x: P(self.laplacian_matvec(A_y, P(x), d) - lam.unsqueeze(-1) * P(x))
+        u, converged = self._minres(K, -P(v), return_converged=True)
+
+        # A repeated (or nearly) lambda, e.g. of a disconnected graph, makes the system inconsistent and MINRES diverge:
+        # those samples are solved from the dense bordered system instead (least squares if it is singular)
+        if not converged.all():
+            failed = (~converged).nonzero().squeeze(-1)
+            warnings.warn(f"MINRES of the sparse gradient did not converge for samples {failed.tolist()} (repeated eigenvalue?), "
+                "solving their bordered systems densely")
+            N = y.shape[-1]
+            K_failed = self._bordered_system(A_y[failed], y[failed], {'eigenvalues': lam[failed]})
+            rhs = torch.cat((-P(v)[failed], v.new_zeros(len(failed), 1)), dim=-1).unsqueeze(-1)
+            u[failed] = self._solve_factored(self._factor_linear_system(K_failed, cholesky=False), rhs)[:, :N, 0]
+
+        # u^T M y has gradient u y^T wrt M
+        with torch.enable_grad():
+            A = A.detach().requires_grad_(True)
+            f = torch.einsum('bi,bi->', u, self.laplacian_matvec(A.double(), y))
+        gradient, = torch.autograd.grad(f, A)
+        return gradient
 
     def old_solve(self, A):
         """ 
@@ -419,6 +1274,20 @@ if __name__ == "__main__":
     print(full_A[0][0])
     print(f'is symmetric: {str(check_symmetric(full_A))}')
 
+    print("\nCheck the vectorized de_minW against the loop (values and gradients)")
+    A = torch.rand(3,4,25, requires_grad=True)
+    G = torch.randn(3,25,25)
+    W_new, W_old = de_minW(A), old_de_minW(A)
+    g_new, = torch.autograd.grad(W_new, A, G)
+    g_old, = torch.autograd.grad(W_old, A, G)
+    print(f'de_minW consistent: {str(torch.equal(W_new, W_old))}, gradients: {str(torch.allclose(g_new, g_old))}')
+
+    print("\nCheck the vectorized manual_weight against the loop")
+    A = torch.randint(0, 2, (3,1,5,5)).float()
+    for r in (1, 4, 30): # r is clamped to N//2
+        print(f'manual_weight consistent (r={r}): {str(torch.equal(manual_weight(A, r, True), old_manual_weight(A, min(r, 12), True)))}, '
+            f'full: {str(torch.equal(manual_weight(A, r, False), old_manual_weight(A, r, False)))}')
+
     print("\nCheck manual_weight and deMinW provide consistent output")
     A = torch.randn(2,2,3,3)
     W_1 = manual_weight(A, 1, False)
@@ -426,6 +1295,180 @@ if __name__ == "__main__":
     W_3 = de_minW(W_2)
     print(f'conversion to/from consistent: {str(torch.allclose(W_1, W_3))}')
 
+    print("\nCheck the sparse (banded) path against the dense one")
+    band = torch.rand(2,4,36, dtype=torch.double)
+    W = de_minW(band).double()
+    x = torch.randn(2,36, dtype=torch.double)
+    print(f'band matvec consistent: {str(torch.allclose(band_matvec(band, x), torch.einsum("bij,bj->bi", W, x)))}')
+    for symm_norm_L in (False, True):
+        node = NormalizedCuts(symm_norm_L=symm_norm_L)
+        sparse_node = NormalizedCuts(symm_norm_L=symm_norm_L, eig_solver='sparse')
+        y, ctx = node.solve(W)
+        y_sparse, ctx_sparse = sparse_node.solve(band)
+        y_sparse = y_sparse * torch.einsum('bij,bij->b', y, y_sparse).sign().view(-1,1,1) # fix the (arbitrary) sign
+        print(f'sparse solve consistent (symm_norm_L={symm_norm_L}): {str(torch.allclose(y, y_sparse, atol=1e-8))}')
+        v = torch.randn(y.shape, dtype=y.dtype)
+        g_dense, = node.gradient(W.requires_grad_(True), y=y, v=v, ctx=ctx)
+        g_sparse, = sparse_node.gradient(band.requires_grad_(True), y=y_sparse, v=v, ctx=ctx_sparse)
+        g_band = torch.zeros_like(band) # chain rule through de_minW: each band entry sets W[u,u+i] and W[u+i,u]
+        for i in range(1, 5):
+            g_band[:, i-1, :36-i] = torch.diagonal(g_dense, i, -2, -1) + torch.diagonal(g_dense, -i, -2, -1)
+        print(f'sparse gradient consistent (symm_norm_L={symm_norm_L}): {str(torch.allclose(g_sparse, g_band, atol=1e-6))}')
+
+    print("\nCheck the lean backward context (the band of de_minW weights) against saving the inputs")
+    band = torch.rand(2,4,36, dtype=torch.double, requires_grad=True)
+    v = torch.randn(2,6,6, dtype=torch.double)
+    class SaveInputs(NormalizedCuts):
+        def backward_context(self, *xs, y=None, ctx=None):
+            return xs, None
+    y = DeclarativeLayer(NormalizedCuts())(de_minW(band))
+    saves_band = y.grad_fn.saved_tensors[1].shape == band.shape
+    g_lean, = torch.autograd.grad(y, band, v)
+    g_inputs, = torch.autograd.grad(DeclarativeLayer(SaveInputs())(de_minW(band)), band, v)
+    print(f'saves the band: {str(saves_band)}, gradients consistent: {str(torch.allclose(g_lean, g_inputs))}')
+
+    print("\nCheck the factored Jacobians against one gradient per output")
+    A = torch.rand(2,3,16, dtype=torch.double, requires_grad=True) # minVer style
+    for analytic_gradient in (True, False):
+        node = NormalizedCuts(analytic_gradient=analytic_gradient, gamma=None if analytic_gradient else 1.0)
+        y, ctx = node.solve(A)
+        J, = node.jacobian(A, y=y, ctx=ctx, chunk_size=5) if analytic_gradient else node.jacobian(A, y=y, ctx=ctx)
+        J_loop, = node._jacobian_from_gradients(A, y=y, ctx=ctx)
+        print(f'jacobian consistent (analytic_gradient={analytic_gradient}): {str(torch.allclose(J, J_loop))}')
+
+    print("\nCheck the analytic gradient against finite differences and the generic gradient")
+    for symm_norm_L in (False, True):
+        node = NormalizedCuts(symm_norm_L=symm_norm_L)
+        layer = DeclarativeLayer(node)
+        P = torch.rand(2,9,9, dtype=torch.double, requires_grad=True)
+        def cut(P): # symmetric input, and fix the (arbitrary) sign of the eigenvector
+            y = layer(P + P.mT)
+            return y * y.detach()[:, :1, :1].sign()
+        print(f'gradcheck (symm_norm_L={symm_norm_L}): {torch.autograd.gradcheck(cut, (P,), eps=1e-6, atol=1e-5)}')
+
+        # the generic gradient of the Rayleigh quotient of the same Laplacian (which y minimises) should agree,
+        # after projecting v onto the complement of y (y is unit length) and comparing the symmetric parts
+        class RayleighQuotient(NormalizedCuts):
+            def objective(self, x, y):
+                y = y.flatten(-2)
+                return torch.einsum('bi,bij,bj->b', y, self.laplacian(x), y) / (y * y).sum(-1)
+        generic = RayleighQuotient(symm_norm_L=symm_norm_L, analytic_gradient=False, matrix_free='minres', eps=1e-6)
+        generic.matrix_free_tol = 1e-12
+        A = torch.rand(2,16,16, dtype=torch.double)
+        A = (A + A.mT).requires_grad_(True)
+        y, ctx = node.solve(A)
+        v = torch.randn(y.shape, dtype=y.dtype)
+        v_perp = v - torch.einsum('bij,bij->b', y.detach(), v).view(-1,1,1) * y.detach()
+        g_analytic, = node.gradient(A, y=y, v=v, ctx=ctx)
+        g_generic, = generic.gradient(A, y=y.detach().requires_grad_(True), v=v_perp)
+        sym = lambda g: g + g.mT
+        print(f'analytic vs generic consistent (symm_norm_L={symm_norm_L}): {str(torch.allclose(sym(g_analytic), sym(g_generic), atol=1e-8))}')
+
+    print('\nCheck the analytic gradient of a disconnected graph (repeated zero eigenvalue, singular bordered system)')
+    A = torch.rand(3, 16, 16, dtype=torch.double)
+    A = A + A.mT
+    A[2, :, 12:], A[2, 12:, :] = 0, 0 # four isolated pixels
+    for refine in (0, 2):
+        node = NormalizedCuts(refine=refine)
+        y, ctx = node.solve(A)
+        v = torch.randn(y.shape, dtype=y.dtype)
+        g, = node.gradient(A.requires_grad_(True), y=y, v=v, ctx=ctx)
+        g_connected, = node.gradient(A[:2], y=y[:2], v=v[:2], ctx={'eigenvalues': ctx['eigenvalues'][:2]})
+        J, = node.jacobian(A, y=y, ctx=ctx)
+        print(f'finite (refine={refine}): {bool(torch.isfinite(g).all() and torch.isfinite(J).all())}, '
+            f'connected samples unchanged: {torch.allclose(g[:2], g_connected)}, solver paths: {node.solver_stats}')
+    A = A.detach()
+    band = torch.rand(3,4,36, dtype=torch.double)
+    for p in (30, 31, 32): # isolated pixels of the last sample (band[:, i-1, u] is W[u,u+i])
+        for i in range(1, 5):
+            band[2, i-1, p], band[2, i-1, p-i] = 0, 0
+    W = de_minW(band).double()
+    y, ctx = NormalizedCuts().solve(W)
+    v = torch.randn(y.shape, dtype=y.dtype)
+    g_dense, = NormalizedCuts().gradient(W.requires_grad_(True), y=y, v=v, ctx=ctx)
+    g_sparse, = NormalizedCuts(eig_solver='sparse').gradient(band.requires_grad_(True), y=y, v=v, ctx=ctx) # warns for sample 2
+    g_band = torch.zeros_like(band) # chain rule through de_minW, as for the sparse path above
+    for i in range(1, 5):
+        g_band[:, i-1, :36-i] = torch.diagonal(g_dense, i, -2, -1) + torch.diagonal(g_dense, -i, -2, -1)
+    print(f'sparse gradient falls back to the dense solve: {torch.allclose(g_sparse, g_band, atol=1e-6)}')
+    band, W = band.detach(), W.detach()
+
+    print('\nCheck warm started lobpcg solves against cold starts, and the eigenvector cache eviction')
+    A = torch.rand(4, 64, 64, dtype=torch.double)
+    A = A @ A.mT
+    cold, warm = NormalizedCuts(eig_solver='lobpcg'), NormalizedCuts(eig_solver='lobpcg', warm_start=EigenvectorCache(max_mb=1))
+    warm.sample_index = torch.arange(4)
+    warm.solve(A)
+    warm.eig_stats['iterations'] = 0
+    A = A * (1 + 1e-3 * torch.rand_like(A))
+    A = A + A.mT
+    y_cold, _ = cold.solve(A)
+    y_warm, _ = warm.solve(A)
+    print(f'warm start consistent: {torch.allclose(torch.einsum("bij,bij->b", y_cold, y_warm).abs(), torch.ones(4, dtype=torch.double))}, '
+          f'lobpcg iterations cold {cold.eig_stats["iterations"]} warm {warm.eig_stats["iterations"]}')
+    cache = EigenvectorCache(max_mb=1) # 1MB holds 8 of these entries
+    for i in range(10):
+        cache.put(i, torch.rand(2**14, 2))
+    print(f'evicted to within max_mb: {cache.nbytes <= cache.max_bytes}, least recently used evicted: {cache.get(0, (2**14, 2)) is None and cache.get(9, (2**14, 2)) is not None}')
+
+    print('\nCheck the k-way solve (eigenvectors 2 to k+1 from one eigendecomposition) and its gradient')
+    A = torch.rand(2, 36, 36, dtype=torch.double)
+    A = A @ A.mT
+    w, v = torch.linalg.eigh(NormalizedCuts().laplacian(A))
+    for eig_solver in ('scipy', 'eigh', 'lobpcg', 'sparse'):
+        y, ctx = NormalizedCuts(eig_solver=eig_solver, k=3).solve(A)
+        cos = torch.einsum('bkn,bnk->bk', y.flatten(-2), v[..., 1:4]).abs()
+        print(f'{eig_solver} output {tuple(y.shape)}, eigenvectors consistent: {torch.allclose(cos, torch.ones_like(cos))}, '
+              f'eigenvalues consistent: {torch.allclose(ctx["eigenvalues"], w[:, 1:4])}')
+    for symm_norm_L in (False, True):
+        layer = DeclarativeLayer(NormalizedCuts(symm_norm_L=symm_norm_L, k=3))
+        P = torch.rand(2,9,9, dtype=torch.double, requires_grad=True)
+        def cuts(P): # fix the (arbitrary) sign of each eigenvector
+            y = layer(P + P.mT)
+            return y * y.detach()[..., :1, :1].sign()
+        print(f'gradcheck (k=3, symm_norm_L={symm_norm_L}): {torch.autograd.gradcheck(cuts, (P,), eps=1e-6, atol=1e-5)}')
+
+    print('\nCheck the batched partition against the loop, and the ncut thresholds against every split')
+    e = torch.randn(16,8,8, dtype=torch.double)
+    print(f'partition consistent: {torch.equal(partition(e), old_partition(e))}')
+    A = torch.rand(3,36,36, dtype=torch.double)
+    A = A @ A.mT
+    y, _ = NormalizedCuts().solve(A)
+    thresholds, ncuts = ncut_thresholds(y.flatten(-2), A)
+    best = []
+    for v, W in zip(y.flatten(-2), A):
+        S = v.unsqueeze(0) <= v.sort().values[:-1].unsqueeze(-1) # every split
+        cut = torch.einsum('si,ij,sj->s', S.double(), W, (~S).double())
+        best.append((cut / (S.double() @ W).sum(-1) + cut / ((~S).double() @ W).sum(-1)).min())
+    print(f'ncut thresholds optimal: {torch.allclose(ncuts, torch.stack(best))}, sign invariant: {torch.equal(partition(y, A, "ncut"), partition(-y, A, "ncut"))}')
+
+    print('\nCheck the multiscale (coarse to fine) solve against eigh on a 32x32 image grid')
+    size = 32
+    I = torch.rand(2, size, size, generator=torch.Generator().manual_seed(0), dtype=torch.double) * 0.2
+    I[:, 8:20, 5:24] += 1 # a rectangle
+    I = I.reshape(2, -1)
+    X = torch.stack(torch.meshgrid(torch.arange(size), torch.arange(size), indexing='ij'), dim=-1).reshape(-1, 2).double()
+    dist = torch.cdist(X, X) ** 2
+    A = torch.exp(-(I.unsqueeze(-1) - I.unsqueeze(-2)) ** 2 / 0.1) * torch.exp(-dist / 4) * (dist <= 9)
+    for symm_norm_L in (False, True):
+        for k in (1, 2):
+            y, ctx = NormalizedCuts(eig_solver='eigh', symm_norm_L=symm_norm_L, k=k).solve(A)
+            y_ms, ctx_ms = NormalizedCuts(eig_solver='multiscale', symm_norm_L=symm_norm_L, k=k).solve(A)
+            cos = torch.einsum('bkn,bkn->bk', y.reshape(2, k, -1), y_ms.reshape(2, k, -1)).abs()
+            print(f'multiscale (symm_norm_L={symm_norm_L}, k={k}) eigenvectors consistent: {torch.allclose(cos, torch.ones_like(cos))}, '
+                  f'eigenvalues consistent: {torch.allclose(ctx["eigenvalues"], ctx_ms["eigenvalues"])}')
+
+    print('\nCheck the Nystrom solve (a global affinity of the 32x32 image grid) approaches eigh with more landmarks')
+    A = torch.exp(-(I.unsqueeze(-1) - I.unsqueeze(-2)) ** 2 / 0.1) * torch.exp(-dist / 200) # every pixel pair
+    y, ctx = NormalizedCuts(eig_solver='eigh', symm_norm_L=True).solve(A)
+    errors = []
+    for samples in (50, 200, 800):
+        y_n, ctx_n = NormalizedCuts(eig_solver='nystrom', symm_norm_L=True, nystrom_samples=samples).solve(A)
+        errors.append((1 - torch.einsum('bij,bij->b', y, y_n).abs()).max().item())
+    y_n, ctx_n = NormalizedCuts(eig_solver='nystrom', symm_norm_L=True, nystrom_samples=size*size).solve(A)
+    print(f'1-|cos| with 50, 200, 800 landmarks: {", ".join(f"{e:.1e}" for e in errors)}, '
+          f'all landmarks exact: {torch.allclose(torch.einsum("bij,bij->b", y, y_n).abs(), torch.ones(2, dtype=torch.double)) and torch.allclose(ctx["eigenvalues"], ctx_n["eigenvalues"])}')
+
     # 1. Confirm the node can calculate a first derivative (eg. does pytorch complain about anything?)
     print("\nstandard tests")
     A = torch.randn(32,1024,1024, requires_grad=True, device=device) # real 32x32 image input
@@ -1,48 +1,193 @@
 import numpy as np
 import matplotlib.pyplot as plt
 
+import scipy.linalg
+import scipy.sparse
 from scipy.sparse import linalg
 import networkx as nx
+import torch
 
 import math
+import warnings
+
+# Vectorised neighbourhood engine for the weight functions below (see og_nc_suite for the original loops).
+# pixel_pairs enumerates the (p, q) pixel pairs a weight function visits and the W entries it writes them to,
+# the pair terms (colour_diff, texture_diff, pixel_dist, ...) are computed for all the pairs at once,
+# and assemble_weights writes them into a dense (or sparse) W. Images can be numpy arrays or torch tensors.
+
+def _xp(a):
+    """The array module (numpy or torch) of a"""
+    return torch if isinstance(a, torch.Tensor) else np
+
+def _as(img, a):
+    """The numpy array a as the array type (and device) of img"""
+    return torch.as_tensor(a, device=img.device) if isinstance(img, torch.Tensor) else a
+
+def _pixels(img, p):
+    """img at the (2, M) pixel coordinates p"""
+    p = _as(img, p)
+    return img[p[0], p[1]]
+
+def pixel_pairs(shape, radius, family='box'):
+    """Enumerates the pixel pairs (p, q) of a neighbourhood of radius r in an image,
+    in the order of the original loops, and the entries of W that each is written to.
+
+    Args:
+        shape (tuple): (X, Y) image shape
+        radius (int): radius of the neighbourhood
+        family (str, optional): Which neighbourhood (and quirks) of the original loops. Defaults to 'box'.
+
+        'box'        q in [x-r, x+r) x [y-r, y+r), written to (x*X + qx, y*Y + qy)   (generic_weight, weight_tot, weight_int_broken, weight_dist)
+        'box2'       q = p + d for d in [max(0, x-r), min(X-x, x+r)) x ..., written to (y*Y + x, qx*Y + qy),
+                     with r <= X//2                                                   (weight_int_broken2)
+        'flat'       flattened indices u <= v <= u+r, u < N-1, within euclidean distance r, written to (u, v),
+                     with r <= N//2                                                   (weight_int, manual_weights_*)
+        'flat_upper' as 'flat' without the distance check                            (manual_weights_abs_upper)
+        'grid'       the pixels below and to the right, written to (u, v)             (final_weight_test)
+        'disc'       q within euclidean distance < r, written to (u, v)              (weights_2)
+
+    Returns:
+        p, q (Array): (2, M) pixel coordinates of each pair
+        rows, cols (Array): (M,) indices of the W entry of each pair
+        size (tuple): shape of W
+    """
+    X, Y = shape[:2]
+    N = X*Y
+    if family == 'box' or family == 'box2':
+        if family == 'box':
+            x, y, a, b = np.meshgrid(np.arange(X), np.arange(Y), np.arange(-radius, radius), np.arange(-radius, radius), indexing='ij')
+            qx, qy = x + a, y + b
+            keep = (qx >= 0) & (qx < X) & (qy >= 0) & (qy < Y)
+        else:
+            radius = min(X // 2, radius)
+            x, y, a, b = np.meshgrid(np.arange(X), np.arange(Y), np.arange(2*radius), np.arange(2*radius), indexing='ij')
+            dx, dy = np.maximum(0, x - radius) + a, np.maximum(0, y - radius) + b # the ranges start at max(0, x-r)
+            keep = (dx < X - x) & (dx < x + radius) & (dy < Y - y) & (dy < y + radius)
+            qx, qy = x + dx, y + dy
+        p, q = np.stack((x[keep], y[keep])), np.stack((qx[keep], qy[keep]))
+        if family == 'box':
+            return p, q, p[0]*X + q[0], p[1]*Y + q[1], (X*X, Y*Y)
+        return p, q, p[1]*Y + p[0], q[0]*Y + q[1], (X*X, Y*Y)
+    elif family == 'flat' or family == 'flat_upper':
+        radius = min(N // 2, radius)
+        u, v = np.meshgrid(np.arange(N-1), np.arange(radius+1), indexing='ij')
+        v = u + v
+        p, q = np.stack((u // X, u % Y)), np.stack((v // X, v % Y))
+        keep = v < N
+        if family == 'flat':
+            keep &= ((p - q)**2).sum(0) <= radius**2
+        return p[:, keep], q[:, keep], u[keep], v[keep], (N, N)
+    elif family == 'grid':
+        i, j = np.meshgrid(np.arange(X), np.arange(Y), indexing='ij')
+        below, right = i + 1 < X, j + 1 < Y
+        p = np.concatenate((np.stack((i[below], j[below])), np.stack((i[right], j[right]))), axis=1)
+        q = np.concatenate((np.stack((i[below] + 1, j[below])), np.stack((i[right], j[right] + 1))), axis=1)
+        return p, q, p[0]*Y + p[1], q[0]*Y + q[1], (N, N)
+    elif family == 'disc':
+        x, y, a, b = np.meshgrid(np.arange(X), np.arange(Y), np.arange(-radius, radius+1), np.arange(-radius, radius+1), indexing='ij')
+        qx, qy = x + a, y + b
+        keep = (qx >= 0) & (qx < X) & (qy >= 0) & (qy < Y) & (a**2 + b**2 < radius**2)
+        p, q = np.stack((x[keep], y[keep])), np.stack((qx[keep], qy[keep]))
+        return p, q, p[0]*Y + p[1], q[0]*Y + q[1], (N, N)
+    raise ValueError(f"family must be one of 'box', 'box2', 'flat', 'flat_upper', 'grid' or 'disc', not {family}")
+
+def assemble_weights(values, rows, cols, size, symmetric=False, sparse=False):
+    """Writes the values of the pixel pairs into W at (rows, cols) (and (cols, rows) if symmetric)
+
+    Args:
+        values (Array): (M,) numpy or torch values
+        rows, cols (Array): (M,) indices from pixel_pairs
+        size (tuple): shape of W
+        symmetric (bool, optional): also write W[cols, rows]. Defaults to False.
+        sparse (bool, optional): return a scipy.sparse csr matrix (or a torch sparse COO tensor). Defaults to False.
+
+    Returns:
+        Array: W, float64 weights matrix
+    """
+    xp = _xp(values)
+    rows, cols = _as(values, rows), _as(values, cols)
+    if symmetric: # the diagonal only once
+        off = rows != cols
+        rows, cols, values = xp.concatenate((rows, cols[off])), xp.concatenate((cols, rows[off])), xp.concatenate((values, values[off]))
+    if sparse:
+        if xp is torch:
+            return torch.sparse_coo_tensor(torch.stack((rows, cols)), values.double(), size, check_invariants=False).coalesce()
+        return scipy.sparse.csr_matrix((values.astype(np.float64), (rows, cols)), shape=size)
+    if xp is torch:
+        W = torch.zeros(size, dtype=torch.float64, device=values.device)
+        W[rows, cols] = values.double()
+    else:
+        W = np.zeros(size)
+        W[rows, cols] = values
+    return W
+
+def pixel_dist(p, q):
+    """Euclidean distance between (arrays of) pixel coordinates p and q"""
+    return np.sqrt(((np.asarray(p) - np.asarray(q))**2).sum(0))
+
+def _exp(a):
+    return _xp(a).exp(a)
 
 def test_cost(a,b, sigma):
-    cost = 100 * math.exp(- pow(a - b, 2) / (2 * pow(sigma, 2))) # TODO check if needs to be abs of (a-b)
+    cost = 100 * _exp(- pow(a - b, 2) / (2 * pow(sigma, 2))) # TODO check if needs to be abs of (a-b)
     # TODO: version with *= 1/dist(a,b) type of thing
     # like in https://www.csd.uwo.ca/~yboykov/Papers/ijcv06.pdf
     return cost
 
-def final_weight_test(img, r, sigma, cost=test_cost):
+def final_weight_test(img, r, sigma, cost=test_cost, sparse=False):
     # following from https://github.com/julie-jiang/image-segmentation/blob/master/imagesegmentation.py
-    X,Y = img.shape
-    N = X*X
-    W = np.zeros((N, N))
-    
-    for i in range(X):
-        for j in range(Y):
-            x = i * Y + j
-            if i + 1 < X: # pixel below # TODO: understand what these ifs are doing?
-                y = (i + 1) * Y + j
-                W[x][y] = W[y][x] = cost(img[i][j], img[i + 1][j], sigma)
-            if j + 1 < Y: # pixel to the right
-                y = i * Y + j + 1
-                W[x][y] = W[y][x] = cost(img[i][j], img[i][j + 1], sigma)
-    return W
+    # 4-way connections (the pixel below and to the right), cost must work on arrays
+    p, q, rows, cols, size = pixel_pairs(img.shape, r, 'grid')
+    return assemble_weights(cost(_pixels(img, p), _pixels(img, q), sigma), rows, cols, size, symmetric=True, sparse=sparse)
 
 def colour_diff(image, pixel1, pixel2):
+    # pixels are (x,y) coordinates, or (2, M) arrays of them
     # # Extract the color values of the two pixels
     # two approaches for colour vs black and white
     if len(image.shape) == 2:
-        intensity1 = image[pixel1[0], pixel1[1]]
-        intensity2 = image[pixel2[0], pixel2[1]]
-        return np.abs(intensity1 - intensity2)
+        intensity1 = _pixels(image, pixel1)
+        intensity2 = _pixels(image, pixel2)
+        return abs(intensity1 - intensity2)
     else:
-        color1 = image[pixel1[0], pixel1[1], :]
-        color2 = image[pixel2[0], pixel2[1], :]
-        return np.sqrt(np.sum((color1 - color2)**2))
+        color1 = _pixels(image, pixel1)
+        color2 = _pixels(image, pixel2)
+        return ((color1 - color2)**2).sum(-1)**0.5
 
-def texture_diff(image, pixel1, pixel2, neighborhood_size):
+def texture_diff(image, pixel1, pixel2, neighborhood_size, chunk=2**22):
+    # pixels are (x,y) coordinates, or (2, M) arrays of them
     # was previously using some stuff from skimage.feature, but no more
+    if np.ndim(pixel1[0]) == 0:
+        return _texture_diff(image, pixel1, pixel2, neighborhood_size)
+
+    # vectorised over the pairs whose neighbourhoods are both inside the image (same shape, no wrapping),
+    # the rest (clipped or wrapped by the slicing, which can fail to broadcast) go through the scalar version
+    n = neighborhood_size
+    X, Y = image.shape[:2]
+    p, q = np.asarray(pixel1), np.asarray(pixel2)
+    inside = lambda a: (a[0] >= n) & (a[0] + n < X) & (a[1] >= n) & (a[1] + n < Y)
+    interior = inside(p) & inside(q)
+
+    out = _as(image, np.zeros(p.shape[1]))
+    if interior.any():
+        k = 2*n + 1
+        if isinstance(image, torch.Tensor): # x, y, (channels,) k, k windows
+            windows = image.unfold(0, k, 1).unfold(1, k, 1)
+        else:
+            windows = np.lib.stride_tricks.sliding_window_view(image, (k, k), axis=(0, 1))
+        index = np.flatnonzero(interior)
+        step = max(1, chunk // (k * k * (image.shape[2] if len(image.shape) == 3 else 1))) # pairs per chunk of the window differences
+        for start in range(0, len(index), step):
+            i = index[start:start + step]
+            w1, w2 = _pixels(windows, p[:, i] - n), _pixels(windows, q[:, i] - n)
+            if len(image.shape) == 2:  # Grayscale
+                out[i] = abs(w1 - w2).mean((-2, -1))
+            else:  # Colour
+                out[i] = (((w1 - w2)**2).sum((-2, -1))**0.5).mean(-1)
+    for i in np.flatnonzero(~interior):
+        out[i] = _texture_diff(image, p[:, i], q[:, i], n)
+    return out
+
+def _texture_diff(image, pixel1, pixel2, neighborhood_size):
     # Extract the neighborhood around the first pixel
     x1, y1 = pixel1
     neighborhood1 = image[x1-neighborhood_size:x1+neighborhood_size+1,
@@ -53,298 +198,134 @@ def texture_diff(image, pixel1, pixel2, neighborhood_size):
                               y2-neighborhood_size:y2+neighborhood_size+1]
     # Calculate the texture difference
     if len(image.shape) == 2:  # Grayscale
-        texture_diff = np.abs(neighborhood1 - neighborhood2).mean()
+        texture_diff = abs(neighborhood1 - neighborhood2).mean()
     else:  # Colour
-        texture_diff = np.sqrt(np.sum((neighborhood1 - neighborhood2)**2, axis=(0,1))).mean()
+        texture_diff = (((neighborhood1 - neighborhood2)**2).sum((0,1))**0.5).mean()
     return texture_diff
 
-def generic_weight(img, radius, func, sigmaI, sigmaX):
+def generic_weight(img, radius, func, sigmaI, sigmaX, sparse=False):
     """Generic function for weighting, takes a func which computes difference measure
 
     Args:
         img (Array): img to compute all weights for
         radius (int): The radius of neighbourhood to compute weights for
         func (function): Used to compute the different between two pixels, 
-                        use partial for additional params
+                        use partial for additional params. Called once with (2, M) arrays of all the pixel pairs
         sigmaI (float): weighting of the function
         sigmaX (float): weighting of spatial location
+        sparse (bool, optional): return a sparse W (see assemble_weights). Defaults to False.
 
     Returns:
         Array: W, weights matrix. shape: (X**2, Y**2)
     """
-    X,Y = img.shape
-    W = np.zeros((X*X, Y*Y))
-    for x in range(X):
-        for y in range(Y):
-            for dx in range(max(0,x-radius), min(X,x+radius)):
-                for dy in range(max(0,y-radius), min(Y,y+radius)):
-                    # W = compare (x,y) with (d,y)
-                    W[x*X + dx][y*Y + dy] = np.exp(-np.abs(func(img, (x,y),(dx,dy)))/sigmaI) # function to weight them
-                    W[x*X + dx][y*Y + dy] *= np.exp(-np.abs(math.dist((x,y),(dx,dy)))/sigmaX) # distance
-                    continue
-    return W
+    p, q, rows, cols, size = pixel_pairs(img.shape, radius, 'box')
+    values = _exp(-abs(func(img, p, q))/sigmaI) # function to weight them
+    values = values * _as(img, np.exp(-pixel_dist(p, q)/sigmaX)) # distance
+    return assemble_weights(values, rows, cols, size, sparse=sparse)
 
-def generic_weight_noexp(img, radius, func, sigmaX):
+def generic_weight_noexp(img, radius, func, sigmaX, sparse=False):
     # Same as above, without the np.exp part of it for the weighting function :)
-    X,Y = img.shape
-    W = np.zeros((X*X, Y*Y))
-    for x in range(X):
-        for y in range(Y):
-            for dx in range(max(0,x-radius), min(X,x+radius)):
-                for dy in range(max(0,y-radius), min(Y,y+radius)):
-                    # W = compare (x,y) with (d,y)
-                    W[x*X + dx][y*Y + dy] = func(img, (x,y),(dx,dy)) # function to weight them
-                    W[x*X + dx][y*Y + dy] *= np.exp(-np.abs(math.dist((x,y),(dx,dy)))/sigmaX) # distance
-                    continue
-    return W
+    p, q, rows, cols, size = pixel_pairs(img.shape, radius, 'box')
+    values = func(img, p, q) * _as(img, np.exp(-pixel_dist(p, q)/sigmaX))
+    return assemble_weights(values, rows, cols, size, sparse=sparse)
 
-def generic_weight_rawfunc(img, radius, func):
+def generic_weight_rawfunc(img, radius, func, sparse=False):
     # Same as above, without the np.exp part of it for the weighting function :)
-    X,Y = img.shape
-    W = np.zeros((X*X, Y*Y))
-    for x in range(X):
-        for y in range(Y):
-            for dx in range(max(0,x-radius), min(X,x+radius)):
-                for dy in range(max(0,y-radius), min(Y,y+radius)):
-                    # W = compare (x,y) with (d,y)
-                    W[x*X + dx][y*Y + dy] = func(img, (x,y),(dx,dy)) # function to weight them
-                    continue
-    return W
+    p, q, rows, cols, size = pixel_pairs(img.shape, radius, 'box')
+    return assemble_weights(func(img, p, q), rows, cols, size, sparse=sparse)
 
-def weight_tot(img, radius, sigmaI, sigmaX):
+def weight_tot(img, radius, sigmaI, sigmaX, sparse=False):
     # TODO: fix this relative to the new weight_int
-    X,Y = img.shape
-    W = np.zeros((X*X, Y*Y))
-    for x in range(X):
-        for y in range(Y):
-            for dx in range(max(0,x-radius), min(X,x+radius)):
-                for dy in range(max(0,y-radius), min(Y,y+radius)):
-                    # W = compare (x,y) with (d,y)
-                    W[x*X + dx][y*Y + dy] = np.exp(-np.abs(img[x][y]-img[dx][dy])/sigmaI) # intensity
-                    W[x*X + dx][y*Y + dy] *= np.exp(-np.abs(math.dist((x,y),(dx,dy)))/sigmaX) # distance
-                    continue
-    return W
-
-def weight_int_broken(img, radius, sigmaI):
-    X,Y = img.shape
-    W = np.zeros((X*X, Y*Y))
-    for x in range(X):
-        for y in range(Y):
-            for dx in range(max(0,x-radius), min(X,x+radius)):
-                for dy in range(max(0,y-radius), min(Y,y+radius)):
-                    W[x*X + dx][y*Y + dy] = np.exp(-np.abs(img[x][y]-img[dx][dy])/sigmaI) # intensity
-                    continue
-    return W
-
-def weight_int_broken2(img, radius, sigmaI):
-    X,Y = img.shape
-    W = np.zeros((X*X, Y*Y))
-    
-    radius = min(X // 2, radius)
-    
-    for x in range(X):
-        for y in range(Y):
-            for dx in range(max(0,x-radius), min(X-x,x+radius)):
-                for dy in range(max(0,y-radius), min(Y-y,y+radius)):
-                    u,v = x + dx, y + dy
-                    W[y*Y+x][u*Y + v] = np.exp(-np.abs(img[x][y]-img[u][v])/sigmaI) # intensity
-                    continue
-    return W
-
-def weight_int(img, radius, sigmaI=0.1):
-    X,Y = img.shape
-    N = X*X
-    W = np.zeros((N, N))
-    
-    radius = min(N // 2, radius)
-    
-    I = img.flatten()
-    for u in range(N-1): # could use step size of r to improve speed?
-        end = min(u+radius+1, N) # upper triangle, only traverse as far as needed
-        for v in range(u,end): # end is exclusive bound
-            x1,y1 = u // X, u % Y
-            x2,y2 = v // X, v % Y
-            coord1 = np.array([x1,y1])
-            coord2 = np.array([x2,y2])
-            if np.linalg.norm(coord1-coord2) > radius: # how far of a connection to add
-                continue
-            else:
-                W[u][v] = W[v][u] = np.exp(-np.abs(img[x1][y1]-img[x2][y2])/sigmaI) # intensity
-    return W
-
-def weight_dist(img, radius, sigmaX):
+    p, q, rows, cols, size = pixel_pairs(img.shape, radius, 'box')
+    values = _exp(-abs(_pixels(img, p) - _pixels(img, q))/sigmaI) # intensity
+    values = values * _as(img, np.exp(-pixel_dist(p, q)/sigmaX)) # distance
+    return assemble_weights(values, rows, cols, size, sparse=sparse)
+
+def weight_int_broken(img, radius, sigmaI, sparse=False):
+    p, q, rows, cols, size = pixel_pairs(img.shape, radius, 'box')
+    values = _exp(-abs(_pixels(img, p) - _pixels(img, q))/sigmaI) # intensity
+    return assemble_weights(values, rows, cols, size, sparse=sparse)
+
+def weight_int_broken2(img, radius, sigmaI, sparse=False):
+    p, q, rows, cols, size = pixel_pairs(img.shape, radius, 'box2')
+    values = _exp(-abs(_pixels(img, p) - _pixels(img, q))/sigmaI) # intensity
+    return assemble_weights(values, rows, cols, size, sparse=sparse)
+
+def weight_int(img, radius, sigmaI=0.1, sparse=False):
+    p, q, rows, cols, size = pixel_pairs(img.shape, radius, 'flat')
+    values = _exp(-abs(_pixels(img, p) - _pixels(img, q))/sigmaI) # intensity
+    return assemble_weights(values, rows, cols, size, symmetric=True, sparse=sparse)
+
+def weight_dist(img, radius, sigmaX, sparse=False):
     # TODO: fix this relative to the new weight_int
-    X,Y = img.shape
-    W = np.zeros((X*X, Y*Y))
-    for x in range(X):
-        for y in range(Y):
-            for dx in range(max(0,x-radius), min(X,x+radius)):
-                for dy in range(max(0,y-radius), min(Y,y+radius)):
-                    W[x*X + dx][y*Y + dy] = np.exp(-np.abs(math.dist((x,y),(dx,dy)))/sigmaX) # distance
-                    continue
-    return W
+    p, q, rows, cols, size = pixel_pairs(img.shape, radius, 'box')
+    return assemble_weights(_as(img, np.exp(-pixel_dist(p, q)/sigmaX)), rows, cols, size, sparse=sparse) # distance
 
 def within_percentage(x,y,percentage):
     diff = abs(x-y)
-    thresh = (percentage/100) * max(x,y)
+    thresh = (percentage/100) * _xp(x).maximum(x,y)
     return diff <= thresh
 
-def manual_weights_binary(img, r=300, percentage=40):
+def manual_weights_binary(img, r=300, percentage=40, sparse=False):
     # assumes grayscale
-    X,Y = img.shape
-    N = X*Y
-    W = np.zeros((N,N))
-
-    r = min(N//2, r) # ensure the r value doesn't exceed the axes of the outputs
-
-    I = img.flatten()
-    for u in range(N-1): # could use step size of r to improve speed?
-        end = min(u+r+1, N) # upper triangle, only traverse as far as needed
-        for v in range(u,end):
-            coord1 = np.array([u // X, u % Y])
-            coord2 = np.array([v // X, v % Y])
-            if np.linalg.norm(coord1-coord2) > r: # 4-way connection
-                continue
-            else:
-                W[u][v] = W[v][u] = within_percentage(I[u],I[v],percentage)
-                # W[u][v] = W[v][u] = not I[u] == I[v] # Symmetric (0 if same, 1 if different)
-    return W
-
-def manual_weights_binary2(img, r=300, percentage=40):
-    X, Y = img.shape
-    N = X * Y
-    r = min(N // 2, r)
-
-    I = img.flatten()
-    indices = np.arange(N)
-
-    coord1 = np.array([indices // X, indices % Y]).T
-    coord2 = coord1.reshape((1, N, 2))
-
-    distances = np.linalg.norm(coord1 - coord2, axis=2)
-    within_radius = distances <= r
-
-    W = np.zeros((N, N))
-    # W[np.logical_not(within_radius)] = 0.0
-
-    for u in range(N-1):
-        end = min(u + r + 1, N)
-        for v in range(u + 1, end):
-            if within_radius[u, v]:
-                W[u, v] = W[v, u] = within_percentage(I[u], I[v], percentage)
-
-def manual_weights_abs(img, r=300):
+    p, q, rows, cols, size = pixel_pairs(img.shape, r, 'flat') # r-way connection
+    values = within_percentage(_pixels(img, p), _pixels(img, q), percentage)
+    # W[u][v] = W[v][u] = not I[u] == I[v] # Symmetric (0 if same, 1 if different)
+    return assemble_weights(values, rows, cols, size, symmetric=True, sparse=sparse)
+
+def manual_weights_binary2(img, r=300, percentage=40, sparse=False):
+    # as manual_weights_binary without the diagonal
+    p, q, rows, cols, size = pixel_pairs(img.shape, r, 'flat')
+    off = rows != cols
+    values = within_percentage(_pixels(img, p[:, off]), _pixels(img, q[:, off]), percentage)
+    return assemble_weights(values, rows[off], cols[off], size, symmetric=True, sparse=sparse)
+
+def manual_weights_abs(img, r=300, sparse=False):
     # assumes grayscale
-    X,Y = img.shape
-    N = X*Y
-    W = np.zeros((N,N))
+    p, q, rows, cols, size = pixel_pairs(img.shape, r, 'flat') # r-way connection
+    values = abs(_pixels(img, p) - _pixels(img, q))
+    return assemble_weights(values, rows, cols, size, symmetric=True, sparse=sparse)
 
-    r = min(N//2, r) # ensure the r value doesn't exceed the axes of the outputs
+def manual_weight_abs2(img, r=300, sparse=False):
+    return manual_weights_abs(img, r, sparse=sparse)
 
-    I = img.flatten()
-    for u in range(N-1): # could use step size of r to improve speed?
-        end = min(u+r+1, N) # upper triangle, only traverse as far as needed
-        for v in range(u,end): # end is exclusive bound
-            coord1 = np.array([u // X, u % Y])
-            coord2 = np.array([v // X, v % Y])
-            if np.linalg.norm(coord1-coord2) > r: # r-way connection
-                continue
-            else:
-                W[u][v] = W[v][u] = np.abs(I[u] - I[v]) # Symmetric
-    return W
+def manual_weights_abs_upper(img, r=300, sparse=False):
+    p, q, rows, cols, size = pixel_pairs(img.shape, r, 'flat_upper')
+    values = abs(_pixels(img, p) - _pixels(img, q))
+    return assemble_weights(values, rows, cols, size, sparse=sparse) # Upper only
 
-def manual_weight_abs2(img, r=300):
-    X,Y = img.shape
-    N = X*Y
-    W = np.zeros((N,N))
+# The global weights below can also be computed for only some columns (columns = pixel indices, W[:, columns]),
+# the N x m block a Nystrom approximation (nystrom_ncut) needs instead of the full N x N matrix.
 
-    r = min(N//2, r) # ensure the r value doesn't exceed the axes of the outputs
-
-    I = img.flatten()
-    for u in range(N-1): # could use step size of r to improve speed?
-        end = min(u+r+1, N) # upper triangle, only traverse as far as needed
-        for v in range(u,end): # end is exclusive bound
-            coord1 = np.array([u // X, u % Y])
-            coord2 = np.array([v // X, v % Y])
-            if np.linalg.norm(coord1-coord2) > r: # r-way connection
-                continue
-            else:
-                W[u][v] = W[v][u] = np.abs(I[u] - I[v]) # Symmetric
-    return W
-
-def manual_weights_abs_upper(img, r=300):
-    N = img.shape[0] * img.shape[1]
-    W = np.zeros((N,N))
-
-    r = min(N//2, r) # ensure the r value doesn't exceed the axes of the outputs
-
-    I = img.flatten()
-    for u in range(N-1): # could use step size of r to improve speed?
-        end = min(u+r+1, N) # upper triangle, only traverse as far as needed
-        for v in range(u,end):
-            if np.linalg.norm(u-v) > r: # 4-way connection
-                continue
-            W[u][v] = np.abs(I[u] - I[v]) # Upper only
-    return W
-
-def intensity_weight_matrix(img, r=None): # blank arg R to match syntax of others with minimal code changes
-  weight = np.abs(np.float32(img.flatten()[:, np.newaxis]) - np.float32(img.flatten()[np.newaxis, :]))
+def intensity_weight_matrix(img, r=None, columns=None): # blank arg R to match syntax of others with minimal code changes
+  flat = img.flatten()
+  weight = np.abs(np.float32(flat[:, np.newaxis]) - np.float32((flat if columns is None else flat[columns])[np.newaxis, :]))
   W = np.exp(-weight/10)*255
   return W
 
-def positional_weight_matrix(img): 
+def positional_weight_matrix(img, columns=None):
   m,n = img.shape                                                                                                     
   X, y = np.meshgrid(np.arange(m), np.arange(n))                                                                 
   X = X.flatten()
   Y = y.flatten()
+  cols = slice(None) if columns is None else columns
 
-  distance = np.sqrt((X[:, np.newaxis] - X[np.newaxis, :])**2 + (Y[:, np.newaxis] - Y[np.newaxis, :])**2)
+  distance = np.sqrt((X[:, np.newaxis] - X[np.newaxis, cols])**2 + (Y[:, np.newaxis] - Y[np.newaxis, cols])**2)
   W = np.exp(-distance/5)
   W =W*(W>0.58)
   return W
 
-def intens_posit_wm(img):
+def intens_posit_wm(img, columns=None):
     """
     No ratio intens and positonal version
     """
-    return intensity_weight_matrix(img) * positional_weight_matrix(img)
+    return intensity_weight_matrix(img, columns=columns) * positional_weight_matrix(img, columns=columns)
 
-def weights_2(img, r=2, sigma_I=0.2, sigma_X=1):
-    channel = 1
-    n_row, n_col = img.shape
-    
-    N = n_row*n_col
-    W = np.zeros((N,N))
-    
-    for row_count, row in enumerate(img):
-        for col_count, v in enumerate(row):
-            index = row_count * n_col + col_count
-
-            search_w = r * 2 + 1
-            start_row = row_count - r
-            start_col = col_count - r
-
-            for d_row in range(search_w):
-                for d_col in range(search_w):
-                    new_row = start_row + d_row
-                    new_col = start_col + d_col
-                    dst = (new_row - row_count) ** 2 + (new_col - col_count) ** 2
-                    if 0 <= new_col < n_col and 0 <= new_row < n_row:
-                        if dst >= r ** 2:
-                            continue
-
-                        cur_index = int(new_row * n_col + new_col)
-
-                        F = img[row_count, col_count] - img[new_row, new_col]
-                        if channel == 3:
-                            F_diff = F[0]**2 + F[1]**2 + F[2]**2  
-                        else:
-                            F_diff = np.abs(F) #**2
-
-                        w = np.exp(-((F_diff / (sigma_I ** 2)) + (dst / (sigma_X ** 2))))
-                        W[index, cur_index] = w
-
-    return W
+def weights_2(img, r=2, sigma_I=0.2, sigma_X=1, sparse=False):
+    p, q, rows, cols, size = pixel_pairs(img.shape, r, 'disc')
+    F_diff = abs(_pixels(img, p) - _pixels(img, q)) # single channel, **2 and summed over the channels for colour
+    dst = _as(img, ((p - q)**2).sum(0))
+    return assemble_weights(_exp(-((F_diff / (sigma_I ** 2)) + (dst / (sigma_X ** 2)))), rows, cols, size, sparse=sparse)
 
 def add_headers(
     fig,
@@ -458,12 +439,9 @@ def argmin2(array):
     return min_idx2
 
 def cut_cost(cut, W):
-    total_weight = 0
-    for i in range(len(cut)):
-        for j in range(len(cut)): # should be square
-            if cut[i] != cut[j]:
-                total_weight += W[i][j] # assumes all weights are non-negative
-    return total_weight
+    """Sum of the weights between the nodes in cut and the rest, in both directions (each W[i][j] with cut[i] != cut[j])"""
+    cut = np.asarray(cut, dtype=bool)
+    return W[cut][:, ~cut].sum() + W[~cut][:, cut].sum() # assumes all weights are non-negative
 
 def ncut_cost(cut, D, W):
     cut = np.array(cut)
@@ -477,47 +455,255 @@ def ncut_cost(cut, D, W):
 
     return (cc / assoc_a) + (cc / assoc_b)
 
-def get_min_ncut(ev, d, w, num_cuts):
-    mcut = np.inf
-    mn = ev.min()
-    mx = ev.max()
+def _degrees(D):
+    """The (..., N) diagonal of a (..., N, N) degree matrix (dense or scipy.sparse), or D if already the degrees"""
+    if scipy.sparse.issparse(D):
+        return D.diagonal()
+    D = np.asarray(D)
+    return np.diagonal(D, axis1=-2, axis2=-1).copy() if D.ndim > 1 and D.shape[-1] == D.shape[-2] else D
 
-    # If all values in `ev` are equal, it implies that the graph can't be
-    # further sub-divided. In this case the bi-partition is the the graph
-    # itself and an empty set.
-    min_mask = np.zeros_like(ev, dtype=bool)
-    if np.allclose(mn, mx):
-        return min_mask, mcut
+def _edges(W):
+    """
+    (image, row, col, weight) tensors of the nonzero weights of W, a (N, N) or (b, N, N) array or tensor,
+    or a scipy.sparse matrix (or a list of b of any of these)
+    """
+    if not isinstance(W, (list, tuple)):
+        if scipy.sparse.issparse(W) or W.ndim == 2:
+            W = [W]
+        else: # dense batch, all images at once
+            W = torch.as_tensor(W)
+            image, u, v = W.nonzero(as_tuple=True)
+            return image, u, v, W[image, u, v].double()
+    edges = []
+    for i, w in enumerate(W):
+        w = scipy.sparse.coo_matrix(w.cpu().numpy() if isinstance(w, torch.Tensor) else w)
+        edges.append((np.full(w.nnz, i), w.row, w.col, w.data))
+    return tuple(torch.from_numpy(np.concatenate(e).astype(t)) for e, t in zip(zip(*edges), ('int64', 'int64', 'int64', 'float64')))
+
+def ncut_sweep(ev, W, thresholds=None, side='right', degrees=None):
+    """
+    Threshold sweep of the normalized cut Ncut(S, T) = cut(S, T) / assoc(S, V) + cut(S, T) / assoc(T, V), where S
+    holds the values of an eigenvector below a threshold and T the rest, for all the thresholds of a batch at once.
+
+    Each eigenvector is sorted once. As the threshold passes a node, assoc(S, V) grows by the node's degree and
+    assoc(S, S) by its weights to the nodes already in S. So every weight is added at the sorted position of its
+    later node, and cumulative sums give all the splits: O(N log N + nnz) per image, with no loop over the thresholds
+    or the images (cut(S, T) = assoc(S, V) - assoc(S, S)).
+
+    Arguments:
+        ev: (N,) or (b, N) array or tensor,
+            eigenvector(s), one per image
 
-    # Refer Shi & Malik 2001, Section 3.1.3, Page 892
-    # Perform evenly spaced n-cuts and determine the optimal one.
-    for t in np.linspace(mn, mx, num_cuts, endpoint=False):
-        mask = ev > t
-        cost = ncut_cost(mask, d, w)
-        if cost < mcut:
-            min_mask = mask
-            mcut = cost
+        W: (N, N) or (b, N, N) array or tensor, or scipy.sparse matrix (or list of b),
+            the (symmetric) weights
 
-    return min_mask, mcut
+        thresholds: (T,) or (b, T) array or None,
+            thresholds of each image, or None for every split (S = the c lowest values, c = 0..N)
 
-def solve_ncut(D,W):
-    d2 = D.copy()
-    d2 = np.reciprocal(np.sqrt(d2.data, where=d2>0), where=d2>0) # avoid nans and infs using where - using out=d2.data may be more efficient?
+        side: 'right' puts values equal to a threshold in S (S = ev <= t), 'left' in T (S = ev < t)
 
-    A = d2 * (D - W) * d2
+        degrees: (N,) or (b, N) array or None,
+            assoc(i, V) of each node, the row sums of W if None
 
-    m = W.shape[0]
+    Return value:
+        ncut: (b, T) (or (b, N+1)) float64 tensor,
+            inf where S or T has no association (e.g. is empty)
+    """
+    ev = torch.as_tensor(ev, dtype=torch.float64)
+    ev = ev.reshape(-1, ev.shape[-1])
+    b, N = ev.shape
+    image, u, v, w = _edges(W)
+    if b > 1 and not isinstance(W, (list, tuple)) and (scipy.sparse.issparse(W) or W.ndim == 2): # one W shared by the batch, its edges in every image
+        image = torch.arange(b).repeat_interleave(len(w))
+        u, v, w = u.repeat(b), v.repeat(b), w.repeat(b)
+    values, order = ev.sort(-1)
+    rank = torch.empty_like(order).scatter_(-1, order, torch.arange(N).expand(b, N))
+
+    if degrees is None:
+        d = torch.zeros(b, N, dtype=torch.float64).index_put_((image, u), w, accumulate=True)
+    else:
+        d = torch.as_tensor(degrees, dtype=torch.float64).reshape(-1, N).expand(b, N)
+    zero = torch.zeros(b, 1, dtype=torch.float64)
+    assoc_SV = torch.cat((zero, d.gather(-1, order).cumsum(-1)), dim=-1) # the c lowest in S, c = 0..N
+    later = torch.maximum(rank[image, u], rank[image, v]) # the weight is within S from c = later + 1
+    assoc_SS = torch.zeros(b, N + 1, dtype=torch.float64).index_put_((image, later + 1), w, accumulate=True).cumsum(-1)
+    assoc_TV = assoc_SV[:, -1:] - assoc_SV
+    cut = assoc_SV - assoc_SS
+    ncut = torch.where((assoc_SV > 0) & (assoc_TV > 0), cut / assoc_SV + cut / assoc_TV, torch.full_like(cut, np.inf))
+    if thresholds is None:
+        return ncut
+    thresholds = torch.as_tensor(thresholds, dtype=torch.float64)
+    thresholds = thresholds.reshape(-1, thresholds.shape[-1]).expand(b, -1).contiguous()
+    return ncut.gather(-1, torch.searchsorted(values, thresholds, side=side))
 
+def get_min_ncut(ev, d, w, num_cuts):
+    """
+    The mask (ev > t) of the lowest ncut of num_cuts evenly spaced thresholds t (Shi & Malik 2001, Section 3.1.3, Page 892)
+    and its cost (ncut_cost's, which counts the cut in both directions), from one ncut_sweep.
+    ev can be a (b, N) batch (of one W, or of (b, N, N) / a list of b W and D), for (b, N) masks and (b,) costs.
+    """
+    batched = np.ndim(ev) == 2
+    ev = np.atleast_2d(ev)
+    mn = ev.min(-1, keepdims=True)
+    mx = ev.max(-1, keepdims=True)
+    thresholds = np.arange(num_cuts) * ((mx - mn) / num_cuts) + mn # np.linspace(mn, mx, num_cuts, endpoint=False)
+    degrees = np.stack([_degrees(di) for di in d]) if isinstance(d, (list, tuple)) else _degrees(d)
+    cost = 2 * ncut_sweep(ev, w, thresholds, side='right', degrees=degrees).numpy() # ev <= t in S
+    i = cost.argmin(-1)
+    mcut = cost[np.arange(len(ev)), i]
+    min_mask = ev > np.take_along_axis(thresholds, i[:, None], -1)
+
+    # If all values in `ev` are equal, it implies that the graph can't be
+    # further sub-divided. In this case the bi-partition is the the graph
+    # itself and an empty set (as when no threshold has a finite cost).
+    none = np.isclose(mn[:, 0], mx[:, 0]) | np.isinf(mcut)
+    min_mask[none], mcut[none] = False, np.inf
+    return (min_mask, mcut) if batched else (min_mask[0], mcut[0])
+
+def _normalized_laplacian(D, W):
+    """
+    A = D^-1/2 (D - W) D^-1/2 as a scipy.sparse csr matrix (dense or sparse D and W, 0 rows for isolated nodes),
+    and its null vector D^1/2 1 (normalised)
+    """
+    d = _degrees(D).astype('float64')
+    d2 = np.reciprocal(np.sqrt(d, where=d > 0, out=np.zeros_like(d)), where=d > 0, out=np.zeros_like(d)) # avoid nans and infs
+    L = scipy.sparse.diags(d) - scipy.sparse.csr_matrix(W)
+    A = (scipy.sparse.diags(d2) @ L @ scipy.sparse.diags(d2)).tocsr()
+    null = np.sqrt(d)
+    return A, null / np.linalg.norm(null)
+
+def _preconditioner(A, kind, shift=1e-6):
+    """Approximate inverse of the (positive definite) A + shift*I as a LinearOperator: 'ilu' (incomplete LU) or None"""
+    if kind is None:
+        return None
+    if kind != 'ilu':
+        raise ValueError(f'unknown preconditioner {kind}')
+    N = A.shape[0]
+    ilu = linalg.spilu((A + shift * scipy.sparse.identity(N)).tocsc(), drop_tol=1e-4, fill_factor=10)
+    return linalg.LinearOperator((N, N), ilu.solve)
+
+def _aggregation_prolongation(W, shape):
+    """
+    Sparse interpolation P (N, Nc) from every other pixel in each direction of a shape (X, Y) image grid, each pixel
+    weighted by its weights W to the coarse pixels (or from the coarse pixel of its 2x2 block if connected to none),
+    as nc.aggregation_prolongation. Returns P and the (ceil(X/2), ceil(Y/2)) coarse shape
+    """
+    X, Y = shape
+    N = X * Y
+    x, y = np.divmod(np.arange(N), Y)
+    is_coarse = (x % 2 == 0) & (y % 2 == 0)
+    coarse = np.flatnonzero(is_coarse)
+    Nc = len(coarse)
+    P = scipy.sparse.diags((~is_coarse).astype('float64')) @ scipy.sparse.csr_matrix(W)[:, coarse] \
+        + scipy.sparse.csr_matrix((np.ones(Nc), (coarse, np.arange(Nc))), shape=(N, Nc))
+    total = np.asarray(P.sum(axis=1)).ravel()
+    orphan = np.flatnonzero(total == 0)
+    block = (x // 2) * ((Y + 1) // 2) + y // 2
+    P = scipy.sparse.diags(np.divide(1, total, where=total > 0, out=np.zeros(N))) @ P \
+        + scipy.sparse.csr_matrix((np.ones(len(orphan)), (orphan, block[orphan])), shape=(N, Nc))
+    return P.tocsr(), ((X + 1) // 2, (Y + 1) // 2)
+
+def _multiscale_start(D, W, shape=None, multiscale_size=16, multiscale_steps=10):
+    """
+    Approximate second eigenvector of A = D^-1/2 (D - W) D^-1/2, coarse to fine (as NormalizedCuts(eig_solver='multiscale')):
+    (D - W) z = lambda D z is projected onto coarser grids (_aggregation_prolongation) until the image side (of a
+    default square shape) is at most multiscale_size, solved there with a dense generalised eigh, and z is interpolated
+    back with multiscale_steps LOBPCG iterations at each intermediate level. Returns D^1/2 z (normalised)
+    """
+    d = _degrees(D).astype('float64')
+    m = len(d)
+    shape = shape or (math.isqrt(m), m // math.isqrt(m))
+    W_l = scipy.sparse.csr_matrix(W)
+    L_l, M_l = (scipy.sparse.diags(d) - W_l).tocsr(), scipy.sparse.diags(d).tocsr()
+    prolongations = []
+    while max(shape) > multiscale_size:
+        P, shape = _aggregation_prolongation(W_l, shape)
+        prolongations.append((L_l, M_l, P))
+        W_l, L_l, M_l = (P.T @ W_l @ P).tocsr(), (P.T @ L_l @ P).tocsr(), (P.T @ M_l @ P).tocsr()
+    z = scipy.linalg.eigh(L_l.toarray(), M_l.toarray(), subset_by_index=[1, 1])[1][:, 0]
+    for i in range(len(prolongations) - 1, 0, -1):
+        L_l, M_l, P = prolongations[i]
+        z = P @ z
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore') # stopped after multiscale_steps, short of the tolerance
+            z = linalg.lobpcg(L_l, z[:, None], B=M_l, Y=np.ones((len(z), 1)), maxiter=multiscale_steps, largest=False)[1][:, 0]
+    if prolongations:
+        z = prolongations[0][2] @ z
+    y = np.sqrt(d) * z
+    return y / np.linalg.norm(y)
+
+def solve_ncut(D, W, mode='eigsh', tol=None, maxiter=None, preconditioner='ilu', sigma=-1e-6, shape=None,
+               multiscale_size=16, multiscale_steps=10, return_info=False):
+    """
+    The eigenvector of the second smallest eigenvalue of A = D^-1/2 (D - W) D^-1/2 (Shi & Malik 2001), for dense or
+    sparse D and W. Every mode returns that one eigenvector. The faster modes deflate the constant null vector
+    D^1/2 1 of A explicitly, so only one eigenpair is iterated.
+
+    mode:
+        'eigsh' (default): ARPACK smallest magnitude without shift-invert, for min(100, m-2) eigenpairs (the original
+            call, slow to converge)
+        'shift_invert': Lanczos on (A - sigma I)^-1 (one sparse LU), projected orthogonal to the null vector
+        'lobpcg': LOBPCG constrained orthogonal to the null vector, preconditioned by preconditioner
+            ('ilu', an incomplete LU of the slightly shifted A, or None), for less memory than the LU
+        'multiscale': 'lobpcg' started from the coarse to fine _multiscale_start, for a shape (X, Y) image grid
+            (default square), instead of a random vector
+
+    With return_info, also returns {'eigenvalue', 'iterations'}: the LOBPCG iterations, or the Lanczos steps
+    (operator applications) of ARPACK.
+    """
+    A, null = _normalized_laplacian(D, W)
+    m = A.shape[0]
     random_state = np.random.default_rng(0)
-    v0 = random_state.random(A.shape[0])
-    vals, vectors = linalg.eigsh(A, which='SM', v0=v0, # if it is sparse this converges quickly, otherwise it doesn't really
-                                        k=min(100, m - 2))
+    v0 = random_state.random(m)
+    steps = [0]
+    def counted(matvec):
+        def apply(x):
+            steps[0] += 1
+            return matvec(x)
+        return apply
+
+    if mode in ('lobpcg', 'multiscale'):
+        if mode == 'multiscale':
+            v0 = _multiscale_start(D, W, shape, multiscale_size, multiscale_steps)
+        M = _preconditioner(A, preconditioner)
+        vals, vectors, history = linalg.lobpcg(A, v0[:, None], M=M, Y=null[:, None], tol=tol or 1e-8, maxiter=maxiter or 500,
+            largest=False, retResidualNormsHistory=True)
+        val, ev, iterations = vals[0], vectors[:, 0], len(history)
+    elif mode == 'shift_invert':
+        lu = linalg.splu((A - sigma * scipy.sparse.identity(m)).tocsc())
+        project = lambda x: x - null * (null @ x)
+        OP = linalg.LinearOperator((m, m), counted(lambda x: project(lu.solve(project(np.ravel(x))))))
+        vals, vectors = linalg.eigsh(OP, k=1, which='LA', v0=project(v0), tol=tol or 0, maxiter=maxiter)
+        val, ev, iterations = sigma + 1 / vals[0], vectors[:, 0], steps[0]
+    elif mode == 'eigsh':
+        OP = linalg.LinearOperator((m, m), counted(lambda x: A @ np.ravel(x)))
+        vals, vectors = linalg.eigsh(OP, which='SM', v0=v0, # if it is sparse this converges quickly, otherwise it doesn't really
+                                            k=min(100, m - 2), tol=tol or 0, maxiter=maxiter)
+        vals, vectors = np.real(vals), np.real(vectors)
+        index2 = argmin2(vals)
+        val, ev, iterations = vals[index2], vectors[:, index2], steps[0]
+    else:
+        raise ValueError(f'unknown mode {mode}')
 
-    vals, vectors = np.real(vals), np.real(vectors)
-    index2 = argmin2(vals)
-    ev = vectors[:, index2]
-        
-    return ev
+    return (ev, {'eigenvalue': float(val), 'iterations': iterations}) if return_info else ev
+
+
+def nystrom_ncut(img, weight=intens_posit_wm, samples=100, k=1, seed=0):
+    """
+    Approximate smallest k+1 eigenpairs of the normalized Laplacian D^-1/2 (D - W) D^-1/2 of a global weight (a
+    function of img and columns, e.g. intensity_weight_matrix or intens_posit_wm), from only the columns of W at
+    samples random landmark pixels (nc.nystrom_eigenvectors): O(N samples) memory and O(N samples^2) time instead of
+    the O(N^2) dense W and O(N^3) eigensolve.
+
+    Returns (w, v): the (k+1,) eigenvalues in ascending order (the first ~0) and the (N, k+1) unit eigenvectors as
+    columns, like the eigensolvers of the experiments (v[:, 1] approximates solve_ncut(D, W))
+    """
+    from nc import nystrom_eigenvectors
+    N = np.size(img)
+    landmarks = np.sort(np.random.default_rng(seed).choice(N, size=min(samples, N), replace=False))
+    C = torch.from_numpy(np.asarray(weight(img, columns=landmarks), dtype='float64'))
+    w, v = nystrom_eigenvectors(C.unsqueeze(0), torch.from_numpy(landmarks), k)
+    return w[0].numpy(), v[0].numpy()
 
 
 def _deterministic_vector_sign_flip(u):
@@ -545,33 +731,26 @@ def _deterministic_vector_sign_flip(u):
     u *= signs[:, np.newaxis]
     return u
 
-def partition_by_step(input, D, W):
-    step = 50
-    pos = input.copy()
-    max_value = pos.max()
-    min_value = pos.min()
+def partition_by_step(input, D, W, step=50, shape=None):
+    """
+    Segments the eigenvector input (N,) at the lowest ncut of its step - 1 evenly spaced thresholds (from one
+    ncut_sweep), as a (shape, default square) uint8 image of 0 below the threshold and 255 at or above it.
+    input can be a (b, N) batch (with a (b, N, N) or list of b W and D), for (b, *shape) images.
+    """
+    pos = np.atleast_2d(input)
+    max_value = pos.max(-1, keepdims=True)
+    min_value = pos.min(-1, keepdims=True)
     setp = (max_value - min_value) / step
-    dict = {}
-    for i in range(1, step):
-        partition = (min_value + i * setp)
-        temp_pos = pos < partition
-
+    thresholds = min_value + np.arange(1, step) * setp
+    degrees = np.stack([_degrees(di) for di in D]) if isinstance(D, (list, tuple)) else _degrees(D)
+    ncut = ncut_sweep(pos, W, thresholds, side='left', degrees=degrees).numpy() # pos < t in S
+    min_partition = np.take_along_axis(thresholds, ncut.argmin(-1)[:, None], -1)
+    pos = np.where(pos >= min_partition, 255, 0)
 
-        k = (np.sum(W[temp_pos])) / (np.sum(D))
-        b = k / (1 - k)
+    side = int(np.sqrt(pos.shape[-1]))
+    pos = pos.reshape((len(pos),) + (shape or (side, side)))
 
-        y = temp_pos.astype('float64') * 2 - b * (temp_pos == False).astype('float64') * 2
-
-        ncut = (y @ (D - W) @ y.T) / (y @ D @ y.T)
-        dict[i] = ncut
-
-    min_partition = min_value + min(dict, key=dict.get) * setp
-    pos[pos >= min_partition] = 255
-    pos[pos < min_partition] = 0
-
-    pos = pos.reshape((28, 28))
-
-    return pos.astype('uint8')
+    return (pos if np.ndim(input) == 2 else pos[0]).astype('uint8')
 
 def partition_by_zero(input):
     input = input.reshape((28,28)).astype('float64')   
@@ -583,4 +762,95 @@ def partition_by_avg(input):
     return partition_by_zero(input - np.average(input))
 
 def partition_by_avg_nocut(input):
-    return input - np.average(input)
\ No newline at end of file
+    return input - np.average(input)
+
+if __name__ == "__main__":
+    # regression checks of the vectorised weight functions against the original loops (og_nc_suite),
+    # for every big_helper.get_weights choice
+    import time
+    import og_nc_suite
+    from big_helper import get_weights
+
+    rng = np.random.default_rng(0)
+    img = rng.random((12, 12))
+    img[3:9, 2:7] += 1 # a rectangle, so there are some exactly equal intensities
+
+    for radius in (1, 3):
+        for choice in range(19):
+            kwargs = dict(choice=choice, radius=radius, sigmaI=0.1, sigmaX=1)
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore') # empty texture neighbourhoods at the borders
+                try:
+                    start = time.perf_counter()
+                    W_og = get_weights(img, suite=og_nc_suite, **kwargs)
+                    t_og = time.perf_counter() - start
+                except ValueError as e_og:
+                    W_og = e_og
+                try:
+                    start = time.perf_counter()
+                    W = get_weights(img, **kwargs)
+                    t = time.perf_counter() - start
+                except ValueError as e:
+                    W = e
+            if isinstance(W_og, ValueError): # the texture choices fail to broadcast clipped border neighbourhoods in both
+                print(f'r={radius} choice {choice:>2}: both raise ValueError: {isinstance(W, ValueError)}')
+                continue
+            W_torch = get_weights(torch.from_numpy(img), **kwargs) if choice not in (2, 4, 5) else W # 2, 4, 5 are numpy only
+            print(f'r={radius} choice {choice:>2}: equal {str(np.allclose(W, W_og, rtol=1e-12, atol=0, equal_nan=True)):>5}, '
+                f'torch equal {str(np.allclose(np.asarray(W_torch), W_og, rtol=1e-12, atol=0, equal_nan=True)):>5} '
+                f'({t_og/t:.0f}x faster)')
+
+    print('\ntexture_diff (interior pairs vectorised) against the scalar version')
+    img = rng.random((16, 16))
+    p, q, _, _, _ = pixel_pairs(img.shape, 3, 'box')
+    looped, keep = [], []
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        for a, b in zip(p.T, q.T): # only the pairs the original can compute
+            try:
+                looped.append(og_nc_suite.texture_diff(img, tuple(a), tuple(b), 2))
+                keep.append(True)
+            except ValueError:
+                keep.append(False)
+        vectorised = texture_diff(img, p[:, keep], q[:, keep], neighborhood_size=2)
+    print(f'equal ({sum(keep)} pairs): {np.allclose(vectorised, looped, rtol=1e-12, atol=0, equal_nan=True)}, '
+        f'torch: {np.allclose(texture_diff(torch.from_numpy(img), p[:, keep], q[:, keep], 2).numpy(), looped, rtol=1e-12, atol=0, equal_nan=True)}')
+
+    print('\nsparse output matches dense')
+    W_sparse = weights_2(img, r=3, sparse=True)
+    print(f'scipy: {np.array_equal(W_sparse.toarray(), weights_2(img, r=3))}, '
+        f'torch: {np.array_equal(weights_2(torch.from_numpy(img), r=3, sparse=True).to_dense().numpy(), weights_2(img, r=3))}')
+
+    print('\nncut threshold sweeps against the looped originals (28x28 image)')
+    img = rng.random((28, 28))
+    img[5:20, 8:18] += 1
+    W = weights_2(img, r=3)
+    D = D_matrix(W)
+    ev = np.linalg.eigh(D - W)[1][:, 1]
+    start = time.perf_counter()
+    mask_og, mcut_og = og_nc_suite.get_min_ncut(ev, D, W, 10)
+    t_og = time.perf_counter() - start
+    start = time.perf_counter()
+    mask, mcut = get_min_ncut(ev, D, W, 10)
+    t = time.perf_counter() - start
+    mask_sparse, mcut_sparse = get_min_ncut(ev, D, weights_2(img, r=3, sparse=True), 10)
+    print(f'get_min_ncut equal: {np.array_equal(mask, mask_og) and np.isclose(mcut, mcut_og)}, '
+        f'sparse W: {np.array_equal(mask_sparse, mask_og) and np.isclose(mcut_sparse, mcut_og)} ({t_og/t:.0f}x faster)')
+    print(f'partition_by_step equal: {np.array_equal(partition_by_step(ev, D, W), og_nc_suite.partition_by_step(ev, D, W))}')
+    evs = np.stack([ev, -ev, np.roll(ev, 7)])
+    masks, mcuts = get_min_ncut(evs, D, W, 10)
+    print(f'batched equal: {all(np.array_equal(m, get_min_ncut(e, D, W, 10)[0]) for m, e in zip(masks, evs))}, '
+        f'{all(np.array_equal(p, og_nc_suite.partition_by_step(e, D, W)) for p, e in zip(partition_by_step(evs, D, W), evs))}')
+
+    print('\nsolve_ncut modes against the dense eigh of the normalized Laplacian (28x28 image)')
+    d = W.sum(axis=0)
+    fiedler = np.linalg.eigh((D - W) / np.sqrt(np.outer(d, d)))[1][:, 1]
+    W_sparse, D_sparse = scipy.sparse.csr_matrix(W), scipy.sparse.diags(d)
+    for mode in ('shift_invert', 'lobpcg', 'multiscale', 'eigsh'):
+        start = time.perf_counter()
+        ev, info = solve_ncut(D_sparse, W_sparse, mode=mode, return_info=True)
+        t = time.perf_counter() - start
+        print(f'{mode:>12}: 1-|cos| {1 - abs(ev @ fiedler):.1e}, {info["iterations"]:>5} iterations, {t:.3f}s, '
+            f'dense D and W equal: {np.allclose(abs(solve_ncut(D, W, mode=mode) @ ev), 1)}')
+    ev = solve_ncut(D_sparse, W_sparse)
+    print(f'default mode (eigsh) returns one eigenvector like the original: {ev.shape == og_nc_suite.solve_ncut(D, W).shape == (len(d),)}')
@@ -34,7 +34,8 @@ def net_argparser(ipynb=False):
     # currently no options to use
     parser.add_argument('--optim', '-o', metavar='OPT', type=str, default='sgd', dest='optim', help='optimiser to use')
     parser.add_argument('--shuffle', type=bool, default=True, help='shuffle batches')
-    parser.add_argument('--dataset', type=str, default='simple01', help='dataset to use: simple01')
+    parser.add_argument('--dataset', type=str, default='simple01', help='dataset to use: simple01, folders (CustomFolders of --img-path)')
+    parser.add_argument('--img-path', type=str, default=None, dest='img_path', help='folders: directory with the dataset pickle of [image paths, segmentations]')
 
     parser.add_argument('--start-epoch', default=0, type=int, metavar='N', help='manual epoch number (useful on restarts)')
     parser.add_argument('--test', action='store_true', help='Whether to test/evaluate or train')
@@ -45,14 +46,35 @@ def net_argparser(ipynb=False):
     parser.add_argument('--minify', type=str2bool, nargs='?', const=True, default=False, help='minify the weights mode (for the PreNC portion)')
     parser.add_argument('--radius', '-r', default=5, type=int, help='radius value for expected weights (only relevant for minified version)')
 
+    parser.add_argument('--weight-cache', type=str, default='data/weight-cache/', dest='weight_cache', help="directory of the weights cache shared by the datasets and experiments ('' to disable)")
+    parser.add_argument('--weight-cache-mb', type=int, default=1024, dest='weight_cache_mb', help='size limit of the weights cache in MB (least recently used entries are evicted)')
+
     parser.add_argument('--img-size', '-size', nargs=2, metavar=('x','y'), type=int, default=(32,32), help='img sizes to work with')
 
     # TODO : add option to switch between eqconst
+    parser.add_argument('--bipart', type=str2bool, nargs='?', const=True, default=False, help='threshold the NC output into a bipartition')
+    parser.add_argument('--post-net', type=str2bool, nargs='?', const=True, default=True, dest='post_net', help='pass the NC output through the PostNC convolutions')
+    parser.add_argument('--n-channels', type=int, default=1, dest='n_channels', help='number of input image channels')
+    parser.add_argument('--n-classes', type=int, default=1, dest='n_classes', help='number of output classes')
+
     parser.add_argument('--eqconst', default=True, type=bool, help='equality constrained or non equality constrained')
  
     # TODO: test gamma term
     parser.add_argument('--gamma', '-g', type=float, default=None, help='gamma term, adds constant to H to allow cholesky decomp')
     parser.add_argument('--eps', type=float, default=1e-12, help='eps term, the max allowed difference from 0 for fY of objective')
+    parser.add_argument('--eig-solver', type=str, default='scipy', choices=['scipy', 'eigh', 'lobpcg', 'sparse', 'multiscale', 'nystrom'], dest='eig_solver', help='NC eigensolver: scipy (per sample on cpu), eigh (batched), lobpcg (batched, two smallest eigenpairs), sparse (scipy.sparse, keeps minified weights banded), multiscale (batched, coarse to fine) or nystrom (batched, from --nystrom-samples landmark columns, approximate for dense global weights, implies --symm-norm-L)')
+    parser.add_argument('--symm-norm-L', action='store_true', dest='symm_norm_L', help='NC uses the symmetrically normalized Laplacian D^-0.5 (D - W) D^-0.5')
+    parser.add_argument('--multiscale-size', type=int, default=16, dest='multiscale_size', help='multiscale: side of the coarsest level')
+    parser.add_argument('--multiscale-steps', type=int, default=10, dest='multiscale_steps', help='multiscale: lobpcg iterations at each intermediate level (the finest iterates until converged)')
+    parser.add_argument('--nystrom-samples', type=int, default=100, dest='nystrom_samples', help='nystrom: number of landmark pixels (columns of W) sampled per image')
+    parser.add_argument('--k-way', '-k', type=int, default=1, dest='k', help='number of NC eigenvectors (2nd to k+1th smallest, from one eigendecomposition) passed to PostNC as channels (replaces the first of --net-size-post)')
+    parser.add_argument('--solve-dtype', type=str, default=None, choices=['float32', 'float64'], dest='solve_dtype', help='dtype of the NC eigensolve and backward linear solve (default: the network dtype), outputs stay in the network dtype')
+    parser.add_argument('--refine', type=int, default=0, help='float64 iterative refinement steps of the NC eigenvector and backward linear solve (e.g. 2 with --solve-dtype float32)')
+    parser.add_argument('--max-backward-mb', type=float, default=None, dest='max_backward_mb', help='memory budget in MB for the derivatives of the generic NC backward pass (--no-analytic-gradient), picks the chunk sizes (default: unbounded)')
+    parser.add_argument('--warm-start-mb', type=int, default=0, dest='warm_start_mb', help='warm start the lobpcg eigensolves from each sample\'s eigenvectors of the last epoch, cached up to this many MB (0 to disable)')
+    parser.add_argument('--analytic-gradient', action=argparse.BooleanOptionalAction, default=True, dest='analytic_gradient', help='NC backward pass by the closed form eigenvector derivative (--no-analytic-gradient for the generic gradient of the objective, which --matrix-free and --max-backward-mb apply to)')
+    parser.add_argument('--matrix-free', type=str, default=None, choices=['cg', 'minres'], dest='matrix_free', help='solve the generic backward pass (--no-analytic-gradient) with Hessian-vector products instead of the dense fYY, fXY')
+    parser.add_argument('--profile', action='store_true', help='time the phases of the declarative nodes (calls, time, peak memory), logged to wandb and saved to profile.json in the run directory')
 
 
     if ipynb:
@@ -7,6 +7,7 @@
 import torch
 from torch.autograd import grad
 import warnings
+from profiling import profiled, phase
 
 class AbstractNode:
     """Minimal interface for generic data processing node
@@ -36,6 +37,15 @@ class AbstractNode:
         raise NotImplementedError()
         return None
 
+    def backward_context(self, *xs, y=None, ctx=None):
+        """Returns the tensors to save for the backward pass instead of the
+        inputs xs (e.g. a compact form such as a band or a degree vector), and
+        a function rebuilding the inputs for gradient from those tensors
+        (checkpoint-style), or None if the tensors are the inputs themselves.
+        y and ctx (saved anyway) do not need to be returned.
+        """
+        return xs, None
+
     def _expand_as_batch(self, x):
         """Helper function to replicate tensor along a new batch dimension
         without allocating new memory.
@@ -56,13 +66,24 @@ class AbstractDeclarativeNode(AbstractNode):
     where x is given (as a vector) and f is a scalar-valued function.
     Derived classes must implement the `objective` and `solve` functions.
     """
-    def __init__(self, eps=1e-12, gamma=None, chunk_size=None):
+    def __init__(self, eps=1e-12, gamma=None, chunk_size=None, vectorize=True,
+        matrix_free=None, matrix_free_tol=1e-8, matrix_free_max_iter=None,
+        max_backward_memory=None, rows_per_pass=64):
         """Create a declarative node
         """
         super().__init__()
         self.eps = eps # tolerance to check if optimality conditions satisfied
         self.gamma = gamma # damping factor: H <-- H + gamma * I
         self.chunk_size = chunk_size # input is divided into chunks of at most chunk_size (None = infinity)
+        self.rows_per_pass = rows_per_pass # Jacobian rows per batched backward pass (None = all m), each holds about the saved graph of fY
+        self.max_backward_memory = max_backward_memory # bytes for the derivatives of the backward pass (None = unbounded), picks the chunk sizes (overrides chunk_size and rows_per_pass)
+        self._planned_rows = None # rows per batched backward pass picked from max_backward_memory
+        self._chunk_buffers = 1 # bxmxchunk_size buffers of the fXY chunks held at a time by gradient
+        self.vectorize = vectorize # compute Jacobians with batched backward passes of rows_per_pass rows (False = loop over outputs)
+        self.matrix_free = matrix_free # iterative solver for H u = -v using Hessian-vector products: None (dense fYY and fXY), 'cg' or 'minres'
+        self.matrix_free_tol = matrix_free_tol # relative residual tolerance of the iterative solver
+        self.matrix_free_max_iter = matrix_free_max_iter # maximum iterations of the iterative solver (None = 10 m)
+        self.solver_stats = {'cholesky': 0, 'lu': 0, 'pinv': 0} # samples solved by each path of _factor_linear_system
 
     def objective(self, *xs, y):
         """Evaluates the objective function on a given input-output pair.
@@ -85,6 +106,7 @@ class AbstractDeclarativeNode(AbstractNode):
         # Todo: LBFGS fall-back solver
         return None, None
 
+    @profiled('node.gradient')
     def gradient(self, *xs, y=None, v=None, ctx=None):
         """Computes the vector--Jacobian product, that is, the gradient of the
         loss function with respect to the problem parameters. The returned
@@ -111,6 +133,9 @@ class AbstractDeclarativeNode(AbstractNode):
                 problem parameters;
                 strictly, returns the vector--Jacobian products J_Y(x,y) * y'(x)
         """
+        if self.matrix_free is not None:
+            return self._gradient_matrix_free(*xs, y=y, v=v, ctx=ctx)
+
         xs, xs_split, xs_sizes, y, v, ctx = self._gradient_init(xs, y, v, ctx)
 
         fY, fYY, fXY = self._get_objective_derivatives(xs, y)
@@ -141,19 +166,165 @@ class AbstractDeclarativeNode(AbstractNode):
                 gradient = []
                 for Bi in fXY(x_split):
                     gradient.append(torch.einsum('bmc,bm->bc', (Bi, u)))
+                    del Bi # before the next chunk is computed
                 gradient = torch.cat(gradient, dim=-1) # bxn
                 gradients.append(gradient.reshape(x_size))
             else:
                 gradients.append(None)
         return tuple(gradients)
 
+    @torch.enable_grad()
+    @profiled('node.gradient_matrix_free')
+    def _gradient_matrix_free(self, *xs, y=None, v=None, ctx=None):
+        """Computes the vector--Jacobian product without forming fYY or fXY.
+        Solves H u = -v iteratively using only Hessian-vector products (each
+        one a backward pass through fY), then computes the gradient as a
+        single vector--Jacobian product of fY with u, ie fXY^T u.
+        Memory is O(m + n) on top of the objective's graph, rather than the
+        O(m^2 + m n) needed to store fYY and fXY.
+        """
+        xs, xs_split, xs_sizes, y, v, ctx = self._gradient_init(xs, y, v, ctx)
+
+        # Evaluate objective function and its partial derivative wrt y:
+        f = self.objective(*xs, y=y) # b
+        fY = grad(f, y, grad_outputs=torch.ones_like(f), create_graph=True)[0]
+        fY = fY.reshape(self.b, -1) # bxm
+
+        if not self._check_optimality_cond(fY):
+            warnings.warn(
+                "Non-zero objective function gradient at y:\n{}".format(
+                    fY.detach().squeeze().cpu().numpy()))
+
+        def hessian_vector_product(u): # bxm -> bxm
+            Hu = grad(fY, y, grad_outputs=u, retain_graph=True,
+                allow_unused=True)[0] if fY.requires_grad else None
+            Hu = torch.zeros_like(u) if Hu is None else Hu.reshape(self.b, -1)
+            if self.gamma is not None:
+                Hu = Hu + self.gamma * u
+            return Hu
+
+        # Solve u = -H^-1 v:
+        v = v.reshape(self.b, -1).to(fY.dtype) # bxm
+        if self.matrix_free == 'cg':
+            u = self._conjugate_gradient(hessian_vector_product, -1.0 * v)
+        elif self.matrix_free == 'minres':
+            u = self._minres(hessian_vector_product, -1.0 * v)
+        else:
+            raise ValueError("matrix_free must be None, 'cg' or 'minres', "
+                "not {}".format(self.matrix_free))
+
+        # Compute fXY^T u for all inputs with a single backward pass:
+        xs_grad = [x for x in xs
+            if isinstance(x, torch.Tensor) and x.requires_grad]
+        gradients = grad(fY, xs_grad, grad_outputs=u, allow_unused=True
+            ) if fY.requires_grad else [None] * len(xs_grad)
+        gradients = iter(gradients)
+        return tuple(self._fill_zeros(next(gradients), x)
+            if isinstance(x, torch.Tensor) and x.requires_grad else None
+            for x in xs)
+
+    def _fill_zeros(self, gradient, x):
+        """Replaces a None gradient (x not in graph) with zeros"""
+        return torch.zeros_like(x) if gradient is None else gradient.detach()
+
+    def _conjugate_gradient(self, A, B):
+        """Solves the batch of linear systems A(X) = B by conjugate gradient,
+        where A is a function computing the product of a batch of symmetric
+        positive definite matrices with X (b, m). Iterates until every batch
+        element has relative residual below matrix_free_tol.
+        """
+        max_iter = self.matrix_free_max_iter or 10 * B.size(-1)
+        tol = self.matrix_free_tol * B.norm(dim=-1) # b
+        X = torch.zeros_like(B)
+        R = B.clone() # residual
+        P = R.clone() # search direction
+        rr = (R * R).sum(-1) # b
+        for _ in range(max_iter):
+            if (rr.sqrt() <= tol).all():
+                break
+            AP = A(P)
+            pAp = (P * AP).sum(-1)
+            alpha = torch.where(pAp != 0, rr / pAp, torch.zeros_like(rr))
+            X = X + alpha.unsqueeze(-1) * P
+            R = R - alpha.unsqueeze(-1) * AP
+            rr_new = (R * R).sum(-1)
+            beta = torch.where(rr != 0, rr_new / rr, torch.zeros_like(rr))
+            P = R + beta.unsqueeze(-1) * P
+            rr = rr_new
+        else:
+            warnings.warn("Conjugate gradient did not converge in {} "
+                "iterations, residual norms:\n{}".format(max_iter,
+                rr.sqrt().detach().cpu().numpy()))
+        return X
+
+    def _minres(self, A, B, return_converged=False):
+        """Solves the batch of linear systems A(X) = B by MINRES, where A is a
+        function computing the product of a batch of symmetric (possibly
+        indefinite or singular) matrices with X (b, m). For singular but
+        consistent systems, returns the minimum-norm solution.
+        Iterates until every batch element has relative residual below
+        matrix_free_tol.
+        With return_converged, also returns the (b,) mask of the converged
+        batch elements, and leaves the warning to the caller.
+        """
+        max_iter = self.matrix_free_max_iter or 10 * B.size(-1)
+        safe_div = lambda a, b: torch.where(b != 0, a / b, torch.zeros_like(a))
+        beta1 = B.norm(dim=-1) # b
+        tol = self.matrix_free_tol * beta1
+        X = torch.zeros_like(B)
+        V_old = torch.zeros_like(B) # Lanczos vectors
+        V = safe_div(B, beta1.unsqueeze(-1))
+        W_old, W_older = torch.zeros_like(B), torch.zeros_like(B) # search directions
+        beta = torch.zeros_like(beta1)
+        eta = beta1.clone()
+        c_old, c = torch.ones_like(beta1), torch.ones_like(beta1) # Givens rotations
+        s_old, s = torch.zeros_like(beta1), torch.zeros_like(beta1)
+        residual = beta1.clone()
+        for _ in range(max_iter):
+            active = residual > tol # converged batch elements are kept, not iterated on past the end of their Krylov space
+            if not active.any():
+                break
+            # Lanczos step:
+            AV = A(V)
+            alpha = (V * AV).sum(-1)
+            V_new = AV - alpha.unsqueeze(-1) * V - beta.unsqueeze(-1) * V_old
+            beta_new = V_new.norm(dim=-1)
+            V_new = safe_div(V_new, beta_new.unsqueeze(-1))
+            # QR step (apply previous rotations, then compute the new one):
+            delta = c * alpha - c_old * s * beta
+            rho1 = (delta ** 2 + beta_new ** 2).sqrt()
+            rho2 = s * alpha + c_old * c * beta
+            rho3 = s_old * beta
+            c_new, s_new = safe_div(delta, rho1), safe_div(beta_new, rho1)
+            # Update solution:
+            W = safe_div(V - rho3.unsqueeze(-1) * W_older
+                - rho2.unsqueeze(-1) * W_old, rho1.unsqueeze(-1))
+            X = X + (c_new * eta * active).unsqueeze(-1) * W
+            eta = -s_new * eta
+            residual = torch.where(active, residual * s_new.abs(), residual)
+            V_old, V, beta = V, V_new, beta_new
+            W_older, W_old = W_old, W
+            c_old, c, s_old, s = c, c_new, s, s_new
+        else:
+            if not return_converged:
+                warnings.warn("MINRES did not converge in {} iterations, "
+                    "residual norms:\n{}".format(max_iter,
+                    residual.detach().cpu().numpy()))
+        if return_converged:
+            return X, residual <= tol
+        return X
+
+    @profiled('node.jacobian')
     def jacobian(self, *xs, y=None, ctx=None):
         """Computes the Jacobian, that is, the derivative of the output with
         respect to the problem parameters. The returned Jacobian is a tuple of
         batched Torch tensors. Can be overridden by the derived class to provide
         a more efficient implementation.
-        Note: this function is highly inefficient so should be used for learning
-        purposes only (computes the vector--Jacobian product multiple times).
+        The objective derivatives and the factorization of H are computed once,
+        and all m rows of the Jacobian come from one multi-column solve
+        (memory is bounded by chunk_size, as each fXY chunk is used then freed).
+        Matrix-free nodes and derived classes that override gradient fall back
+        to the (inefficient) vector--Jacobian product per output.
 
         Arguments:
             xs: ((b, ...), ...) tuple of Torch tensors,
@@ -170,6 +341,54 @@ class AbstractDeclarativeNode(AbstractNode):
                 batch of Jacobians of the loss function with respect to the
                 problem parameters
         """
+        if (self.matrix_free is not None or
+            type(self).gradient is not AbstractDeclarativeNode.gradient):
+            return self._jacobian_from_gradients(*xs, y=y, ctx=ctx)
+        return self._jacobian_factored(*xs, y=y, ctx=ctx)
+
+    def _jacobian_factored(self, *xs, y=None, ctx=None):
+        """Computes the Jacobian -H^-1 fXY of gradient, factorizing H once
+        """
+        xs_in = xs
+        xs, xs_split, xs_sizes, y, _, ctx = self._gradient_init(xs, y, None, ctx)
+
+        fY, fYY, fXY = self._get_objective_derivatives(xs, y)
+
+        if not self._check_optimality_cond(fY):
+            warnings.warn(
+                "Non-zero objective function gradient at y:\n{}".format(
+                    fY.detach().squeeze().cpu().numpy()))
+
+        # Form H:
+        H = fYY
+        H = 0.5 * (H + H.transpose(1, 2)) # Ensure that H is symmetric
+        if self.gamma is not None:
+            H += self.gamma * torch.eye(
+                self.m, dtype=H.dtype, device=H.device).unsqueeze(0)
+
+        # Solve -H^-1 for all m right-hand sides at once (H^-1 is symmetric):
+        I = torch.eye(self.m, dtype=H.dtype, device=H.device).expand(
+            self.b, self.m, self.m)
+        H_inv = self._solve_factored(self._factor_linear_system(H), -1.0 * I) # bxmxm
+
+        # Compute -H^-1 B_i for all i:
+        jacobians = []
+        for x, x_split, x_size in zip(xs_in, xs_split, xs_sizes):
+            if isinstance(x_split[0], torch.Tensor) and x_split[0].requires_grad:
+                jacobian = []
+                for Bi in fXY(x_split):
+                    jacobian.append(torch.einsum('bmk,bkc->bmc', (H_inv, Bi)))
+                    del Bi # before the next chunk is computed
+                jacobian = torch.cat(jacobian, dim=-1) # bxmxn
+                jacobians.append(jacobian.reshape(y.shape + x.shape[1:]))
+            else:
+                jacobians.append(None)
+        return tuple(jacobians)
+
+    def _jacobian_from_gradients(self, *xs, y=None, ctx=None):
+        """Computes the Jacobian one vector--Jacobian product (gradient) per
+        output, for any gradient (highly inefficient, see jacobian)
+        """
         v = torch.zeros_like(y) # v: bxm1xm2x...
         b = v.size(0)
         v = v.reshape(b, -1) # v: bxm
@@ -186,6 +405,7 @@ class AbstractDeclarativeNode(AbstractNode):
             ) else None for i, jacobian in enumerate(jacobians)]
         return tuple(jacobians)
 
+    @profiled('node.gradient_init')
     def _gradient_init(self, xs, y, v, ctx):
         # Compute optimal value if have not already done so:
         if y is None:
@@ -199,27 +419,93 @@ class AbstractDeclarativeNode(AbstractNode):
         self.b = y.size(0)
         self.m = y.reshape(self.b, -1).size(-1)
 
+        chunk_size = self.chunk_size
+        if self.max_backward_memory is not None:
+            chunk_size, self._planned_rows = self._plan_chunks(xs, y)
+
         # Split each input x into a tuple of n//chunk_size tensors of size (b, chunk_size):
         # Required since gradients can only be computed wrt individual
         # tensors, not slices of a tensor. See:
         # https://discuss.pytorch.org/t/how-to-calculate-gradients-wrt-one-of-inputs/24407
-        xs_split, xs_sizes, self.n = self._split_inputs(xs)
+        xs_split, xs_sizes, self.n = self._split_inputs(xs, chunk_size)
         xs = self._cat_inputs(xs_split, xs_sizes)
 
         return xs, xs_split, xs_sizes, y, v, ctx
 
+    @profiled('node.plan_chunks')
+    def _plan_chunks(self, xs, y):
+        """Chooses the input chunk size (for _split_inputs) and the Jacobian
+        rows per batched backward pass (for _batch_jacobian) that keep the
+        derivatives of the backward pass within max_backward_memory bytes.
+
+        The memory is modelled as the graph of fY, the bxmxm matrices of the
+        linear system (fYY, H and its factorization) and the gradients
+        (twice, as chunks and concatenated), plus the rows in
+        flight of a batched backward pass (each about the tensors saved by the
+        graph of fY, see _graph_bytes, and a gradient of every input), plus
+        the fXY chunks (bxmxchunk_size, _chunk_buffers of them at a time).
+        Half the memory left after the fixed part goes to the backward pass
+        rows, the rest to the chunks.
+        """
+        itemsize = y.element_size()
+        n = sum(x.numel() // self.b for x in xs
+            if isinstance(x, torch.Tensor) and x.requires_grad)
+        n_max = max([x.numel() // self.b for x in xs
+            if isinstance(x, torch.Tensor) and x.requires_grad], default=1)
+        graph = self._graph_bytes(xs, y)
+        per_row = graph + self.b * n * itemsize
+        per_column = self._chunk_buffers * self.b * self.m * itemsize
+        available = (self.max_backward_memory - graph # the graph of fY itself
+            - 3 * self.b * self.m * self.m * itemsize # fYY, H, factorization
+            - 2 * self.b * n * itemsize) # gradient chunks and their concatenation
+        if available < per_row + per_column:
+            warnings.warn("max_backward_memory of {} bytes is below the {} "
+                "bytes needed for one row and column at a time".format(
+                self.max_backward_memory, self.max_backward_memory - available
+                + per_row + per_column))
+        rows = min(self.m, max(1, available // 2 // per_row))
+        chunk_size = min(n_max, max(1, (available - rows * per_row) // per_column))
+        return chunk_size, rows
+
+    @torch.enable_grad()
+    def _graph_bytes(self, xs, y):
+        """Bytes of the tensors saved by the graph of fY (the objective and
+        its gradient wrt y), which one row of a batched backward pass through
+        fY holds about as much of
+        """
+        saved = [0]
+        def pack(tensor):
+            saved[0] += tensor.numel() * tensor.element_size()
+            return tensor
+        xs = tuple(x.detach().requires_grad_(True) if isinstance(x,
+            torch.Tensor) and x.requires_grad else x for x in xs)
+        y = y.detach().requires_grad_(True)
+        with torch.autograd.graph.saved_tensors_hooks(pack, lambda x: x), \
+            warnings.catch_warnings(): # gradient warns about the same checks
+            warnings.simplefilter("ignore")
+            for f in self._graph_functions(xs, y):
+                grad(f, y, grad_outputs=torch.ones_like(f), create_graph=True,
+                    allow_unused=True)
+        return saved[0]
+
+    def _graph_functions(self, xs, y):
+        """The functions whose derivatives are taken by gradient, for
+        _graph_bytes
+        """
+        return (self.objective(*xs, y=y),)
+
     @torch.enable_grad()
-    def _split_inputs(self, xs):
+    def _split_inputs(self, xs, chunk_size=None):
         """Split inputs into a sequence of tensors by input dimension
         For each input x in xs, generates a tuple of n//chunk_size tensors of size (b, chunk_size)
         """
         xs_split, xs_sizes, xs_n = [], [], []
         for x in xs: # Loop over input tuple
             if isinstance(x, torch.Tensor) and x.requires_grad:
-                if self.chunk_size is None:
+                if chunk_size is None:
                     xs_split.append((x.reshape(self.b, -1),))
                 else:
-                    xs_split.append(x.reshape(self.b, -1).split(self.chunk_size, dim=-1))
+                    xs_split.append(x.reshape(self.b, -1).split(chunk_size, dim=-1))
                 xs_sizes.append(x.size())
                 xs_n.append(x.reshape(self.b, -1).size(-1))
             else:
@@ -240,6 +526,7 @@ class AbstractDeclarativeNode(AbstractNode):
                 xs.append(torch.cat(x_split, dim=-1).reshape(x_size))
         return tuple(xs)
 
+    @profiled('node.objective_derivatives')
     def _get_objective_derivatives(self, xs, y):
         # Evaluate objective function at (xs,y):
         f = torch.enable_grad()(self.objective)(*xs, y=y) # b
@@ -255,10 +542,16 @@ class AbstractDeclarativeNode(AbstractNode):
         fYY = fYY.detach() if fYY is not None else y.new_zeros(
             self.b, self.m, self.m)
 
-        # Create function that returns generator expression for fXY given input:
-        fXY = lambda x: (fXiY.detach()
-            if fXiY is not None else torch.zeros_like(fY).unsqueeze(-1)
-            for fXiY in (self._batch_jacobian(fY, xi) for xi in x))
+        # Create generator of the fXY chunks given input, holding no reference
+        # to a chunk while the next is computed (so callers that drop each
+        # chunk before the next hold only one at a time):
+        def fXY(x):
+            for xi in x:
+                with phase('node.fXY'):
+                    fXiY = self._batch_jacobian(fY, xi)
+                yield fXiY.detach() if fXiY is not None else torch.zeros_like(
+                    fY).unsqueeze(-1)
+                del fXiY
 
         return fY, fYY, fXY
 
@@ -267,11 +560,51 @@ class AbstractDeclarativeNode(AbstractNode):
         """
         return torch.allclose(fY, torch.zeros_like(fY), rtol=0.0, atol=self.eps)
 
+    @profiled('node.solve_linear_system')
     def _solve_linear_system(self, A, B):
         """Solves linear system AX = B.
         If B is a tuple (B1, B2, ...), returns tuple (X1, X2, ...).
         Otherwise returns X.
         """
+        return self._solve_factored(self._factor_linear_system(A), B)
+
+    @profiled('node.factor_linear_system')
+    def _factor_linear_system(self, A, cholesky=True):
+        """Factorizes A (bxmxm) once, for any number of solves with
+        _solve_factored. Batchwise Cholesky, then only the samples where it
+        fails are refactorized together: batched LU, then the pseudo-inverse
+        for those that are singular (e.g. the null space of a Laplacian).
+        cholesky=False starts from the LU, for indefinite A.
+        The number of samples taken by each path is added to solver_stats.
+        """
+        if cholesky:
+            L, info = torch.linalg.cholesky_ex(A, upper=False) # NOTE: this line was changed by Garth Wales to update it for modern pytorch (previously torch.cholesky with no param changes)
+            cholesky = info == 0 # samples that are positive definite
+            self.solver_stats['cholesky'] += int(cholesky.sum())
+            if cholesky.all():
+                return L
+            A_decomp = {'cholesky': (cholesky.nonzero().squeeze(-1), L[cholesky])}
+        else:
+            cholesky = torch.zeros(A.size(0), dtype=torch.bool, device=A.device)
+            A_decomp = {'cholesky': (cholesky.nonzero().squeeze(-1), None)}
+        failed = (~cholesky).nonzero().squeeze(-1)
+        LU, pivots, info = torch.linalg.lu_factor_ex(A if not cholesky.any() else A[failed])
+        U_diag = LU.diagonal(dim1=-2, dim2=-1).abs()
+        lu = (info == 0) & (U_diag.amin(-1) > A.size(-1) * torch.finfo(A.dtype).eps
+            * U_diag.amax(-1)) # singular (to working precision) samples have a (near) zero pivot
+        A_decomp['lu'] = (failed, LU, pivots) if lu.all() else (failed[lu], LU[lu], pivots[lu])
+        A_decomp['pinv'] = (failed[~lu], torch.linalg.pinv(A[failed[~lu]]))
+        self.solver_stats['lu'] += int(lu.sum())
+        self.solver_stats['pinv'] += int((~lu).sum())
+        return A_decomp
+
+    @profiled('node.solve_factored')
+    def _solve_factored(self, A_decomp, B):
+        """Solves linear system AX = B given A_decomp from
+        _factor_linear_system, with all the columns of B solved at once.
+        If B is a tuple (B1, B2, ...), returns tuple (X1, X2, ...).
+        Otherwise returns X.
+        """
         B_sizes = None
         # If B is a tuple, concatenate into single tensor:
         if isinstance(B, (tuple, list)):
@@ -280,23 +613,27 @@ class AbstractDeclarativeNode(AbstractNode):
         # Ensure B is 2D (bxmxn):
         if len(B.size()) == 2:
             B = B.unsqueeze(-1)
-        try: # Batchwise Cholesky solve
-            A_decomp = torch.linalg.cholesky(A, upper=False) # NOTE: this line was changed by Garth Wales to update it for modern pytorch (previously torch.cholesky with no param changes)
+        if isinstance(A_decomp, torch.Tensor): # Batchwise Cholesky solve
             X = torch.cholesky_solve(B, A_decomp, upper=False) # bxmxn
-        except: # Revert to loop if batchwise solve fails
+        elif A_decomp['lu'][0].numel() == B.size(0): # Batchwise LU solve
+            X = torch.linalg.lu_solve(*A_decomp['lu'][1:], B)
+        else: # each subset of the batch with its own factorization
             X = torch.zeros_like(B)
-            for i in range(A.size(0)):
-                try: # Cholesky solve
-                    A_decomp = torch.linalg.cholesky(A[i, ...], upper=False) # NOTE: this line was changed by Garth Wales to update it for modern pytorch (previously torch.cholesky with no param changes)
-                    X[i, ...] = torch.cholesky_solve(B[i, ...], A_decomp,
-                        upper=False) # mxn
-                except: # Revert to LU solve
-                    X[i, ...]= torch.linalg.solve(A[i, ...], B[i, ...]) # mxn # NOTE: this line was changed by Garth Wales to update it for modern pytorch (previously torch.solve(B,A))
+            cholesky, L = A_decomp['cholesky']
+            if cholesky.numel() > 0:
+                X[cholesky] = torch.cholesky_solve(B[cholesky], L, upper=False)
+            lu, LU, pivots = A_decomp['lu']
+            if lu.numel() > 0:
+                X[lu] = torch.linalg.lu_solve(LU, pivots, B[lu])
+            pinv, A_pinv = A_decomp['pinv']
+            if pinv.numel() > 0:
+                X[pinv] = torch.einsum('bij,bjk->bik', A_pinv, B[pinv])
         if B_sizes is not None:
             X = X.split(B_sizes, dim=-1)
         return X
 
     @torch.enable_grad()
+    @profiled('node.batch_jacobian')
     def _batch_jacobian(self, y, x, create_graph=False):
         """Compute Jacobian of y with respect to x and reduce over batch
         dimension.
@@ -326,6 +663,19 @@ class AbstractDeclarativeNode(AbstractNode):
         y = y.reshape(self.b, -1) # bxm
         m = y.size(-1)
         n = x.reshape(self.b, -1).size(-1)
+        if self.vectorize:
+            try:
+                return self._batch_jacobian_vectorized(y, x, m, n,
+                    create_graph=create_graph)
+            except (RuntimeError, NotImplementedError) as e:
+                # Some operations in the objective do not support batched
+                # gradients, so use the loop for this node from now on
+                # (anything else, e.g. running out of memory, is raised)
+                if not self._batched_grad_unsupported(e):
+                    raise
+                warnings.warn("Vectorized Jacobian not supported, reverting "
+                    "to loop over outputs:\n{}".format(e))
+                self.vectorize = False
         jacobian = y.new_zeros(self.b, m, n) # bxmxn
         for i in range(m):
             grad_outputs = torch.zeros_like(y, requires_grad=False) # bxm
@@ -337,6 +687,46 @@ class AbstractDeclarativeNode(AbstractNode):
             jacobian[:, i:(i+1), :] = yiX.reshape(self.b, -1).unsqueeze(1) # bx1xn
         return jacobian # bxmxn
 
+    def _batch_jacobian_vectorized(self, y, x, m, n, create_graph=False):
+        """Compute Jacobian of y (b, m) with respect to x using backward
+        passes batched over rows_per_pass rows of the Jacobian at a time (vmap
+        over the vector--Jacobian product), instead of m separate backward
+        passes. Each pass holds about rows_per_pass times the saved graph.
+        Returns None if x is not in the graph for y.
+        """
+        rows = self._planned_rows if self._planned_rows is not None else self.rows_per_pass
+        rows = m if rows is None else min(m, rows)
+        if rows < m: # bounded memory, rows_per_pass rows at a time
+            jacobian = y.new_zeros(self.b, m, n) # bxmxn
+        for k in range(0, m, rows):
+            block = torch.arange(k, min(k + rows, m), device=y.device)
+            grad_outputs = y.new_zeros(len(block), m)
+            grad_outputs[torch.arange(len(block), device=y.device), block] = 1.0
+            grad_outputs = grad_outputs.unsqueeze(1).expand(-1, self.b, m) # kxbxm (only the k rows of the identity)
+            yX, = grad(y, x, grad_outputs=grad_outputs, retain_graph=True,
+                create_graph=create_graph, allow_unused=True,
+                is_grads_batched=True) # kxbxn1xn2x...
+            if yX is None: # grad returns None instead of zero
+                return None
+            yX = yX.reshape(-1, self.b, n).transpose(0, 1) # bxkxn
+            if rows >= m:
+                return yX
+            jacobian[:, k:k+rows, :] = yX
+        return jacobian # bxmxn
+
+    @staticmethod
+    def _batched_grad_unsupported(e):
+        """Whether the exception e of a batched backward pass means that the
+        objective does not support batched gradients (vmap), rather than
+        e.g. running out of memory
+        """
+        if isinstance(e, NotImplementedError):
+            return True
+        if isinstance(e, torch.OutOfMemoryError):
+            return False
+        message = str(e) # only the errors of vmap itself, not e.g. "Batch element 2" of a linear algebra error
+        return 'vmap' in message or 'Batching rule not implemented' in message
+
 class EqConstDeclarativeNode(AbstractDeclarativeNode):
     """A general deep declarative node defined by a parameterized optimization
     problem with at least one (non-linear) equality constraint of the form
@@ -347,10 +737,14 @@ class EqConstDeclarativeNode(AbstractDeclarativeNode):
     `solve` functions.
     """
 
-    def __init__(self, eps=1e-12, gamma=None, chunk_size=None):
+    def __init__(self, eps=1e-12, gamma=None, chunk_size=None, vectorize=True,
+        max_backward_memory=None, rows_per_pass=64):
         """Create an equality constrained declarative node
         """
-        super().__init__(eps=eps, gamma=gamma, chunk_size=None)
+        super().__init__(eps=eps, gamma=gamma, chunk_size=chunk_size,
+            vectorize=vectorize, max_backward_memory=max_backward_memory,
+            rows_per_pass=rows_per_pass)
+        self._chunk_buffers = 2 # fXY chunk and a hXY chunk
 
     def equality_constraints(self, *xs, y):
         """Evaluates the equality constraint functions on a given input-output
@@ -376,6 +770,7 @@ class EqConstDeclarativeNode(AbstractDeclarativeNode):
         raise NotImplementedError()
         return None, None
 
+    @profiled('node.eq_gradient')
     def gradient(self, *xs, y=None, v=None, ctx=None):
         """Computes the vector--Jacobian product, that is, the gradient of the
         loss function with respect to the problem parameters. The returned
@@ -403,13 +798,28 @@ class EqConstDeclarativeNode(AbstractDeclarativeNode):
                 strictly, returns the vector--Jacobian products J_Y(x,y) * y'(x)
         """
         xs, xs_split, xs_sizes, y, v, ctx = self._gradient_init(xs, y, v, ctx)
-
+        return self._constrained_gradient(xs, xs_split, xs_sizes, y, v, ctx)
+
+    def _constrained_gradient(self, xs, xs_split, xs_sizes, y, v, ctx,
+        mask=None):
+        """Computes the gradient for the constraints of _get_constraint_set,
+        of which only those where mask (bxp, None = all) is true are active in
+        each sample. Inactive constraints are padding: their rows of hY and hX
+        and their multipliers nu are zero, and they are decoupled in the
+        (A H^-1 A^T) system, so a batch with different numbers of active
+        constraints per sample is solved together.
+        """
         fY, fYY, fXY = self._get_objective_derivatives(xs, y)
 
         hY, hYY, hXY, hX = self._get_constraint_derivatives(xs, y)
+        if mask is not None:
+            mask = mask.to(hY.dtype) # bxp
+            hY = hY * mask.unsqueeze(-1)
 
-        nu = self._get_nu(fY, hY) if (ctx is None or 'nu' not in ctx
+        nu = self._get_nu(fY, hY, mask) if (ctx is None or 'nu' not in ctx
             ) else self._ensure2d(ctx['nu'])
+        if mask is not None:
+            nu = nu * mask
 
         if not self._check_optimality_cond(fY, hY, nu):
             warnings.warn("Non-zero Lagrangian gradient at y:\n{}\n"
@@ -435,8 +845,12 @@ class EqConstDeclarativeNode(AbstractDeclarativeNode):
 
         # ToDo: check for NaN values in u and t
 
-        # Solve s = (A H^-1 A^T)^-1 A H^-1 v = -(A t)^-1 A u:
-        s = self._solve_linear_system(torch.einsum('bpm,bmq->bpq', (A, t)),
+        # Solve s = (A H^-1 A^T)^-1 A H^-1 v = -(A t)^-1 A u
+        # (inactive constraints have zero rows in A, and identity rows in A t so that s is zero):
+        At = torch.einsum('bpm,bmq->bpq', (A, t))
+        if mask is not None:
+            At = At + torch.diag_embed(1.0 - mask)
+        s = self._solve_linear_system(At,
             torch.einsum('bpm,bm->bp', (A, -1.0 * u))) # bxpx1
         s = s.squeeze(-1) # bxp
         
@@ -451,11 +865,15 @@ class EqConstDeclarativeNode(AbstractDeclarativeNode):
             if isinstance(x_split[0],torch.Tensor) and x_split[0].requires_grad:
                 gradient = []
                 for i, Bi in enumerate(fXY(x_split)):
-                    Bi -= sum(torch.einsum('b,bmc->bmc', (nu[:, j], hjXiY))
-                        for j, hjXiY in enumerate(hXY(x_split[i])))
+                    for j, hjXiY in hXY(x_split[i]): # in place, one at a time
+                        Bi -= hjXiY.mul_(nu[:, j].view(-1, 1, 1))
+                        del hjXiY
                     g = torch.einsum('bmc,bm->bc', (Bi, uts))
+                    del Bi # before the next chunk is computed
                     Ci = hX(x_split[i])
                     if Ci is not None:
+                        if mask is not None:
+                            Ci = Ci * mask.unsqueeze(-1)
                         g -= torch.einsum('bpc,bp->bc', (Ci, s))
                     gradient.append(g)
                 gradient = torch.cat(gradient, dim=-1) # bxn
@@ -464,6 +882,13 @@ class EqConstDeclarativeNode(AbstractDeclarativeNode):
                 gradients.append(None)
         return tuple(gradients)
 
+    def _graph_functions(self, xs, y):
+        """The objective and the constraints, for _graph_bytes
+        """
+        h = self._get_constraint_set(xs, y)
+        return (self.objective(*xs, y=y),) + (() if h is None else (h,))
+
+    @profiled('node.constraint_derivatives')
     def _get_constraint_derivatives(self, xs, y):
         # Evaluate constraint function(s) at (xs,y):
         h = torch.enable_grad()(self._get_constraint_set)(xs, y) # bxp
@@ -480,11 +905,16 @@ class EqConstDeclarativeNode(AbstractDeclarativeNode):
             for i in range(p)
             ) if hiYY is not None)
 
-        # Compute 2nd-order partial derivative of hj wrt y and xi at (xs,y):
-        hXY = lambda x: (hiXY.detach() for hiXY in (
-            self._batch_jacobian(torch.enable_grad()(hY.select)(1, i), x)
-            for i in range(p)
-            ) if hiXY is not None)
+        # Compute 2nd-order partial derivative of hj wrt y and xi at (xs,y)
+        # (a generator like fXY, one chunk at a time):
+        def hXY(x):
+            for i in range(p):
+                with phase('node.hXY'):
+                    hiXY = self._batch_jacobian(
+                        torch.enable_grad()(hY.select)(1, i), x)
+                if hiXY is not None:
+                    yield i, hiXY.detach()
+                del hiXY
 
         # Compute partial derivative of h wrt xi at (xs,y):
         def hX(x):
@@ -505,16 +935,19 @@ class EqConstDeclarativeNode(AbstractDeclarativeNode):
                     h.detach().squeeze().cpu().numpy()))
         return h
 
-    def _get_nu(self, fY, hY):
+    @profiled('node.nu')
+    def _get_nu(self, fY, hY, mask=None):
         """Compute nu (ie lambda) if not provided by the problem's solver.
-        That is, solve: hY^T nu = fY^T.
+        That is, solve: hY^T nu = fY^T (in the least squares sense, batched).
+        Constraints that are inactive in mask (bxp) are fixed to nu = 0 by
+        appending the rows diag(1 - mask) nu = 0, keeping full column rank.
         """
-        p = hY.size(1)
-        nu = fY.new_zeros(self.b, p)
-        for i in range(self.b): # loop over batch
-            solution,_ = torch.lstsq(fY[i, :].unsqueeze(-1), hY[i, :, :].t())
-            nu[i, :] = solution[:p, :].squeeze() # extract first p values
-        return nu
+        hYt = hY.detach().transpose(-2, -1) # bxmxp
+        fY = fY.detach().unsqueeze(-1) # bxmx1
+        if mask is not None:
+            hYt = torch.cat((hYt, torch.diag_embed(1.0 - mask)), dim=-2) # bx(m+p)xp
+            fY = torch.cat((fY, fY.new_zeros(self.b, mask.size(-1), 1)), dim=-2)
+        return torch.linalg.lstsq(hYt, fY).solution.squeeze(-1) # bxp
 
     def _check_equality_constraints(self, h):
         """Check that the problem's constraints are satisfied.
@@ -551,10 +984,13 @@ class IneqConstDeclarativeNode(EqConstDeclarativeNode):
     `inequality_constraints` and `solve` functions.
     """
 
-    def __init__(self, eps=1e-12, gamma=None, chunk_size=None):
+    def __init__(self, eps=1e-12, gamma=None, chunk_size=None, vectorize=True,
+        max_backward_memory=None, rows_per_pass=64):
         """Create an inequality constrained declarative node
         """
-        super().__init__(eps=eps, gamma=gamma, chunk_size=None)
+        super().__init__(eps=eps, gamma=gamma, chunk_size=chunk_size,
+            vectorize=vectorize, max_backward_memory=max_backward_memory,
+            rows_per_pass=rows_per_pass)
 
     def equality_constraints(self, *xs, y):
         """Evaluates the equality constraint functions on a given input-output
@@ -571,6 +1007,7 @@ class IneqConstDeclarativeNode(EqConstDeclarativeNode):
         warnings.warn("inequality constraint function not implemented")
         return None
 
+    @profiled('node.ineq_gradient')
     def gradient(self, *xs, y=None, v=None, ctx=None):
         """Computes the vector--Jacobian product, that is, the gradient of the
         loss function with respect to the problem parameters. The returned
@@ -599,47 +1036,18 @@ class IneqConstDeclarativeNode(EqConstDeclarativeNode):
         """
         xs, xs_split, xs_sizes, y, v, ctx = self._gradient_init(xs, y, v, ctx)
 
-        # Collect batch indices such that each sub-batch will have the same
-        # number of active constraints:
-        indices_list, unconstrained = self._get_uniform_indices(xs, y)
+        # Active constraints of each sample (batch elements may have different
+        # numbers of active constraints, which are solved together):
+        mask = self._get_active_mask(xs, y)
 
-        # If all batch elements have same number of active constraints:
-        if indices_list is None:
-            if unconstrained:
-                gradients = AbstractDeclarativeNode.gradient(self,
-                    *xs, y=y, v=v, ctx=ctx)
-            else:
-                gradients = EqConstDeclarativeNode.gradient(self,
-                    *xs, y=y, v=v, ctx=ctx)
-        else: # Otherwise, loop over uniform batch subsets:
-            gradients = [torch.zeros_like(x)
-                if x.requires_grad else None for x in xs]
-            for indices in indices_list:
-                xs_subset = tuple([x.index_select(0, indices).requires_grad_()
-                    for x in xs])
-                y_subset = y.index_select(0, indices).requires_grad_()
-                v_subset = v.index_select(0, indices)
-                ctx_subset = None if ctx is None else {
-                    key : value.index_select(0, indices)
-                    if isinstance(value, torch.Tensor) else value
-                    for key, value in ctx.items()}
-                if unconstrained:
-                    gradients_subset = AbstractDeclarativeNode.gradient(self,
-                        *xs_subset, y=y_subset, v=v_subset, ctx=ctx_subset)
-                    unconstrained = False # Only first subset is uncontrained
-                else:
-                    gradients_subset = EqConstDeclarativeNode.gradient(self,
-                        *xs_subset, y=y_subset, v=v_subset, ctx=ctx_subset)
-                # Insert gradients into correct locations:
-                for i in range(len(gradients)):
-                    if gradients[i] is not None:
-                        gradients[i][indices, ...] = gradients_subset[i]
-            gradients = tuple(gradients)
-        return gradients
-
-    def _get_uniform_indices(self, xs, y):
-        """Collects batch indices such that each subset will have the same
-        number of active constraints.
+        if mask is None or not mask.any(): # Unconstrained
+            return AbstractDeclarativeNode.gradient(self,
+                *xs, y=y, v=v, ctx=ctx)
+        return self._constrained_gradient(xs, xs_split, xs_sizes, y, v, ctx,
+            mask=None if mask.all() else mask)
+
+    def _get_active_mask(self, xs, y):
+        """Finds the active constraints of each sample.
 
         Arguments:
             xs: ((b, ...), ...) tuple of Torch tensors,
@@ -649,28 +1057,20 @@ class IneqConstDeclarativeNode(EqConstDeclarativeNode):
                 batch of minima of the objective function
 
         Return values:
-            indices_list: [(k1), (k2), ...] list of Torch tensors or None,
-                list of variable-length index tensors
-
-            unconstrained: bool,
-                true if first subset has no active constraints
+            mask: (b, p+q) Torch tensor or None,
+                true for the equality constraints and the active inequality
+                constraints (in the order of _get_constraint_set), or None if
+                there are no constraints
         """
+        masks = []
         h = self.equality_constraints(*xs, y=y) # bxp or None
-        p = 0 if h is None else self._ensure2d(h).size(-1)
-        g = self.inequality_constraints(*xs, y=y) # bxq
-        if g is None:
-            indices_list = None
-            unconstrained = True if p == 0 else False
-        else:
+        if h is not None:
+            masks.append(torch.ones_like(self._ensure2d(h), dtype=torch.bool))
+        g = self.inequality_constraints(*xs, y=y) # bxq or None
+        if g is not None:
             g = self._ensure2d(g)
-            q = torch.stack([gi.isclose(torch.zeros_like(gi),
-                rtol=0.0, atol=self.eps).long().sum() for gi in g])
-            q_sorted, indices = q.sort()
-            q_unique, counts = q_sorted.unique_consecutive(return_counts=True)
-            indices_list = indices.split(counts.split(1)) if (
-                q_unique.size(-1) > 1) else None
-            unconstrained = True if (p + q_unique[0] == 0) else False
-        return indices_list, unconstrained
+            masks.append(g.isclose(torch.zeros_like(g), rtol=0.0, atol=self.eps))
+        return torch.cat(masks, dim=-1).detach() if masks else None
 
     def _get_constraint_set(self, xs, y):
         """Filters constraints.
@@ -683,11 +1083,8 @@ class IneqConstDeclarativeNode(EqConstDeclarativeNode):
                 batch of minima of the objective function
 
         Return values:
-            constraint_set: (b, p) Torch tensor,
-                tensor of active constraints
-
-        Assumptions:
-            batch has a uniform number of active constraints
+            constraint_set: (b, p+q) Torch tensor,
+                tensor of equality and inequality constraints
         """
         # ToDo: remove duplicate constraints (first-order identical)
         constraint_set = None
@@ -707,13 +1104,11 @@ class IneqConstDeclarativeNode(EqConstDeclarativeNode):
                 warnings.warn(
                     "Inequality constraints not satisfied exactly:\n{}".format(
                     g.detach().squeeze().cpu().numpy()))
-            # Identify active constraints:
-            mask = g.isclose(torch.zeros_like(g), rtol=0.0, atol=self.eps)
-            g = g.masked_select(mask).reshape(self.b, -1) if mask.any() else None
-
+            # All inequality constraints, the inactive ones are masked by
+            # _get_active_mask:
             if h is None:
                 constraint_set = g # bxq
-            elif g is not None:
+            else:
                 constraint_set = torch.cat((h, g), dim=-1) # bx(p+q)
         return constraint_set
 
@@ -729,10 +1124,19 @@ class LinEqConstDeclarativeNode(EqConstDeclarativeNode):
     where x is given, and A and d are independent of x. Derived classes must
     implement the objective and solve functions.
     """
-    def __init__(self, eps=1e-12, gamma=None, chunk_size=None):
+    def __init__(self, eps=1e-12, gamma=None, chunk_size=None, vectorize=True,
+        max_backward_memory=None, rows_per_pass=64):
         """Create a linear equality constrained declarative node
         """
-        super().__init__(eps=eps, gamma=gamma, chunk_size=None)
+        super().__init__(eps=eps, gamma=gamma, chunk_size=chunk_size,
+            vectorize=vectorize, max_backward_memory=max_backward_memory,
+            rows_per_pass=rows_per_pass)
+        self._chunk_buffers = 1 # no hXY
+
+    def _graph_functions(self, xs, y):
+        """The objective only (A and d are independent of x), for _graph_bytes
+        """
+        return AbstractDeclarativeNode._graph_functions(self, xs, y)
 
     def linear_constraint_parameters(self, y):
         """Defines the linear equality constraint parameters A and d, where the
@@ -749,6 +1153,7 @@ class LinEqConstDeclarativeNode(EqConstDeclarativeNode):
         raise NotImplementedError()
         return None, None
 
+    @profiled('node.lineq_gradient')
     def gradient(self, *xs, y=None, v=None, ctx=None):
         """Computes the vector--Jacobian product, that is, the gradient of the
         loss function with respect to the problem parameters. The returned
@@ -821,6 +1226,7 @@ class LinEqConstDeclarativeNode(EqConstDeclarativeNode):
                 gradient = []
                 for i, Bi in enumerate(fXY(x_split)):
                     gradient.append(torch.einsum('bmc,bm->bc', (Bi, u)))
+                    del Bi # before the next chunk is computed
                 gradient = torch.cat(gradient, dim=-1) # bxn
                 gradients.append(gradient.reshape(x_size))
             else:
@@ -829,14 +1235,16 @@ class LinEqConstDeclarativeNode(EqConstDeclarativeNode):
 
 class DeclarativeFunction(torch.autograd.Function):
     """Generic declarative autograd function.
-    Defines the forward and backward functions. Saves all inputs and outputs,
-    which may be memory-inefficient for the specific problem.
+    Defines the forward and backward functions. Saves the outputs and the
+    problem's backward_context (all inputs unless the problem provides a
+    more compact one).
     
     Assumptions:
     * All inputs are PyTorch tensors
     * All inputs have a single batch dimension (b, ...)
     """
     @staticmethod
+    @profiled('declarative.forward')
     def forward(ctx, problem, *inputs):
         # NOTE - Garth Wales 2022: 
         #           ensure the problem.solve detaches the inputs (a tuple of inputs) within its routine 
@@ -845,17 +1253,26 @@ class DeclarativeFunction(torch.autograd.Function):
         #           ensure it returns a object with requires_grad_(True), pytorch will complain otherwise
         #           despite the gradient being calculated in DeclarativeFunction.backward
         output, solve_ctx = torch.no_grad()(problem.solve)(*inputs)
-        ctx.save_for_backward(output, *inputs)
+        # Save only what the problem needs for its gradient (the inputs by default)
+        saved, ctx.restore_inputs = torch.no_grad()(problem.backward_context)(
+            *inputs, y=output, ctx=solve_ctx)
+        ctx.save_for_backward(output, *saved)
         ctx.problem = problem
         ctx.solve_ctx = solve_ctx
         return output.clone()
 
     @staticmethod
+    @profiled('declarative.backward')
     def backward(ctx, grad_output):
         output, *inputs = ctx.saved_tensors
         problem = ctx.problem
         solve_ctx = ctx.solve_ctx
         output.requires_grad = True
+        if ctx.restore_inputs is not None: # Rebuild the inputs from the saved context
+            inputs = torch.no_grad()(ctx.restore_inputs)(*inputs)
+            inputs = [x.requires_grad_(needs_grad) if isinstance(x, torch.Tensor)
+                and x.is_floating_point() else x for x, needs_grad in zip(
+                inputs, ctx.needs_input_grad[1:])]
         inputs = tuple(inputs)
         grad_inputs = problem.gradient(*inputs, y=output, v=grad_output,
             ctx=solve_ctx)
@@ -0,0 +1,162 @@
+# Opt-in profiling of the phases of the declarative nodes (timers, call counts, peak memory and torch.profiler ranges)
+#
+# Usage:
+#     profiler = profiling.enable()
+#     ... forward / backward passes ...
+#     print(profiler); profiler.save('profile.json'); wandb.log(profiler.wandb_dict())
+#     profiling.disable()
+import os, json, time, resource, functools
+from contextlib import nullcontext
+import torch
+
+_profiler = None # the enabled Profiler, None when disabled (phases are then no-ops)
+_null = nullcontext() # reusable, returned by phase when disabled
+
+class Profiler:
+    """
+    Accumulates the calls, wall time and peak memory of named phases, which are also
+    torch.profiler.record_function ranges (so they show up in a torch.profiler trace).
+    Phases nest, the time of a phase includes its children.
+
+    Peak memory is the peak above the memory at the start of the phase (max over calls): of the
+    cuda caching allocator when on the gpu, otherwise how far the phase raised the peak RSS
+    of the process above the RSS at its start (0 if it stayed under an earlier peak).
+    """
+    def __init__(self, cuda=None):
+        self.cuda = torch.cuda.is_available() if cuda is None else cuda
+        self.stats = {} # name -> {'calls', 'time', 'peak_mb'}
+        self._stack = [] # open phases, [start memory, peak memory]
+
+    def reset(self):
+        self.stats = {}
+
+    def phase(self, name):
+        return _Phase(self, name)
+
+    def _memory(self):
+        """(current, peak) memory in bytes"""
+        if self.cuda:
+            return torch.cuda.memory_allocated(), torch.cuda.max_memory_allocated()
+        return _rss(), resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def summary(self):
+        """Stats of each phase (calls, total and mean time in seconds, peak memory in MB), most time first"""
+        return {name: {**stat, 'mean': stat['time'] / stat['calls']}
+            for name, stat in sorted(self.stats.items(), key=lambda item: -item[1]['time'])}
+
+    def save(self, path):
+        """Writes the summary as JSON"""
+        with open(path, 'w') as fp:
+            json.dump(self.summary(), fp, indent=2)
+
+    def wandb_dict(self, prefix='profile/'):
+        """Flat {prefix/phase/stat: value} of the summary, for wandb.log"""
+        return {f'{prefix}{name}/{key}': value for name, stat in self.summary().items() for key, value in stat.items()}
+
+    def __str__(self):
+        lines = [f'{"phase":<32} {"calls":>7} {"time (s)":>10} {"mean (ms)":>10} {"peak (MB)":>10}']
+        for name, stat in self.summary().items():
+            lines.append(f'{name:<32} {stat["calls"]:>7} {stat["time"]:>10.4f} {stat["mean"] * 1e3:>10.3f} {stat["peak_mb"]:>10.1f}')
+        return '\n'.join(lines)
+
+class _Phase:
+    def __init__(self, profiler, name):
+        self.profiler, self.name = profiler, name
+
+    def __enter__(self):
+        profiler = self.profiler
+        current, peak = profiler._memory()
+        if profiler.cuda:
+            for frame in profiler._stack: # the parents' peak so far, before the counter is reset
+                frame[1] = max(frame[1], peak)
+            torch.cuda.reset_peak_memory_stats()
+            peak = current
+        self.frame = [current, peak] # on the cpu, the process peak before the phase
+        profiler._stack.append(self.frame)
+        self.range = torch.profiler.record_function(self.name)
+        self.range.__enter__()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        self.range.__exit__(*exc)
+        profiler = self.profiler
+        profiler._stack.pop()
+        _, peak = profiler._memory()
+        start = self.frame[0]
+        if profiler.cuda:
+            for frame in profiler._stack:
+                frame[1] = max(frame[1], peak)
+            peak = max(self.frame[1], peak)
+        elif peak <= self.frame[1]: # the process peak (which can't be reset) was not raised
+            peak = start
+        stat = profiler.stats.setdefault(self.name, {'calls': 0, 'time': 0.0, 'peak_mb': 0.0})
+        stat['calls'] += 1
+        stat['time'] += elapsed
+        stat['peak_mb'] = max(stat['peak_mb'], (peak - start) / 2**20)
+        return False
+
+def _rss():
+    """Current resident set size (bytes) of this process"""
+    try:
+        with open('/proc/self/statm') as fp:
+            return int(fp.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError: # not linux, fall back to the peak
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def enable(profiler=None):
+    """Starts profiling the phases (into profiler, or a new Profiler), and returns the profiler"""
+    global _profiler
+    _profiler = profiler or Profiler()
+    return _profiler
+
+def disable():
+    """Stops profiling, and returns the profiler that was enabled (or None)"""
+    global _profiler
+    profiler, _profiler = _profiler, None
+    return profiler
+
+def get_profiler():
+    return _profiler
+
+def phase(name):
+    """Context manager timing the enclosed code as phase name of the enabled profiler (a no-op when disabled)"""
+    return _null if _profiler is None else _profiler.phase(name)
+
+def profiled(name):
+    """Decorator timing each call of the function as phase name of the enabled profiler (a direct call when disabled)"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _profiler is None:
+                return func(*args, **kwargs)
+            with _profiler.phase(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+if __name__ == '__main__':
+    import tempfile
+
+    profiler = enable()
+    with phase('outer'):
+        with phase('inner'):
+            x = torch.ones(2**22) # 16 MB
+        time.sleep(0.01)
+        del x
+    @profiled('decorated')
+    def square(x):
+        return x * x
+    for _ in range(3):
+        square(torch.ones(10))
+    print(profiler)
+    stats = profiler.summary()
+    print(f'calls counted: {stats["decorated"]["calls"] == 3}, nested time included: {stats["outer"]["time"] >= stats["inner"]["time"]}')
+    with tempfile.TemporaryDirectory() as dir:
+        profiler.save(os.path.join(dir, 'profile.json'))
+        with open(os.path.join(dir, 'profile.json')) as fp:
+            print(f'json round trip: {json.load(fp) == json.loads(json.dumps(stats))}')
+    print(f'wandb keys: {sorted(profiler.wandb_dict())[:3]}')
+    disable()
+    print(f'disabled is a no-op: {phase("outer") is _null and get_profiler() is None}')
@@ -0,0 +1,81 @@
+# Packed on-disk arrays for the datasets (replacing the pickled lists in data.py)
+import os, json
+import numpy as np
+
+class PackedArray:
+    """
+    Append-only array of fixed-shape records, stored as raw binary (name.bin) plus a JSON header (name.json)
+    with the dtype, record shape and record count. Reads are memory-mapped, so indexing a record only
+    touches its pages on disk, and the header is only rewritten after the new records are on disk
+    (the count in it is the commit point, anything past it is overwritten by the next append).
+    """
+    def __init__(self, path, shape=None, dtype=None):
+        """
+        path: file path without extension
+        shape, dtype: of each record, only needed when creating (otherwise read from the header,
+            or taken from the first append if neither is given)
+        """
+        self.path = path
+        self._memmap = None
+        if os.path.isfile(path + '.json'):
+            with open(path + '.json') as fp:
+                header = json.load(fp)
+            self.shape, self.dtype, self.count = tuple(header['shape']), np.dtype(header['dtype']), header['count']
+        else:
+            self.shape = tuple(shape) if shape is not None else None
+            self.dtype = np.dtype(dtype) if dtype is not None else None
+            self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        return self.array[index]
+
+    def __getstate__(self): # e.g. for DataLoader workers, which reopen the file instead of copying the data
+        state = self.__dict__.copy()
+        state['_memmap'] = None
+        return state
+
+    @property
+    def array(self):
+        """(count, *shape) read-only view (copy-on-write, so torch.from_numpy accepts it)"""
+        if self._memmap is None:
+            if self.count == 0:
+                return np.empty((0,) + (self.shape or ()), dtype=self.dtype)
+            self._memmap = np.memmap(self.path + '.bin', dtype=self.dtype, mode='c', shape=(self.count,) + self.shape)
+        return self._memmap
+
+    def append(self, records):
+        """Appends a (n, *shape) batch of records (converted to the stored dtype)"""
+        records = np.asarray(records)
+        if len(records) == 0:
+            return
+        if self.shape is None:
+            self.shape, self.dtype = records.shape[1:], self.dtype or records.dtype
+        records = np.ascontiguousarray(records, dtype=self.dtype).reshape((-1,) + self.shape)
+        with open(self.path + '.bin', 'r+b' if os.path.isfile(self.path + '.bin') else 'wb') as fp:
+            fp.seek(self.count * self.dtype.itemsize * int(np.prod(self.shape)))
+            fp.write(records.tobytes())
+            fp.truncate()
+        self.count += len(records)
+        with open(self.path + '.json.tmp', 'w') as fp:
+            json.dump({'dtype': self.dtype.str, 'shape': list(self.shape), 'count': self.count}, fp)
+        os.replace(self.path + '.json.tmp', self.path + '.json') # atomic, so a crash leaves the old count
+        self._memmap = None # remapped with the new count on the next read
+
+if __name__ == '__main__':
+    import tempfile, pickle
+    with tempfile.TemporaryDirectory() as dir:
+        path = os.path.join(dir, 'test')
+        store = PackedArray(path, shape=(64, 64), dtype=np.uint8)
+        a = np.random.default_rng(0).integers(0, 255, (10, 64, 64), dtype=np.uint8)
+        store.append(a[:6])
+        store.append(a[6:])
+        print(f'appended records consistent: {np.array_equal(store.array, a)}')
+        reopened = PackedArray(path)
+        print(f'reopened consistent: {np.array_equal(reopened[3], a[3])}, length: {len(reopened)}')
+        print(f'pickles without the data: {len(pickle.dumps(reopened)) < a.nbytes}')
+        lazy = PackedArray(os.path.join(dir, 'lazy'))
+        lazy.append(np.ones((2, 3), dtype=np.float32))
+        print(f'shape from the first append: {PackedArray(os.path.join(dir, "lazy")).shape == (3,)}')
@@ -1,4 +1,4 @@
-from nc import NormalizedCuts
+from nc import NormalizedCuts, partition
 from node import DeclarativeLayer
 from net_argparser import net_argparser
 from data import *
@@ -22,37 +22,6 @@ node = NormalizedCuts(eps=1e-3)
 DL = DeclarativeLayer(node)
 
 
-def partition(eigenvectors):
-    """
-    eigenvectors : (b, x, y)
-    for dim = (x,y)
-    """
-    b,x,y = eigenvectors.shape
-
-    output = []
-
-    # eigenvectors = F.normalize(eigenvectors)
-
-    for i in range(b):
-        eigenvec = torch.clone(eigenvectors[i]).flatten()
-
-        # Using average point to compute bipartition 
-        second_smallest_vec = eigenvectors[i].flatten()
-        avg = torch.sum(second_smallest_vec).item() / torch.numel(second_smallest_vec)
-
-        bipartition = second_smallest_vec > avg
-        seed = torch.argmax(torch.abs(second_smallest_vec))
-
-        if bipartition[seed] != 1:
-            eigenvec = eigenvec * -1
-            bipartition = torch.logical_not(bipartition)
-        bipartition = bipartition.reshape(args.img_size[0], args.img_size[1]).type(torch.double)
-        
-        output.append(bipartition.numpy())
-    # output.
-    return torch.tensor(output)
-
-
 args = net_argparser(ipynb=True)
 args.network = 1
 args.total_images = 3
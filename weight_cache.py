@@ -0,0 +1,137 @@
+# Content-addressed cache of weight (affinity) matrices, shared by the datasets and experiment scripts
+import os, json, hashlib
+import numpy as np
+import scipy.sparse
+import torch
+
+class WeightCache:
+    """
+    Caches the weights of an image on disk, keyed by a hash of the image bytes and the full spec of the
+    weight function (name and parameters), so any run (or script) computing the same weights for the
+    same image shares them, whatever dataset or list position the image comes from.
+
+    Entries are .npz files: the nonzero (flat) indices and values of mostly zero weights (as neighbourhood
+    weights are, which is smaller than compressing them and faster to read back), compressed dense weights
+    otherwise, and scipy.sparse.save_npz for sparse weights. The least recently used entries (by modification
+    time, which get refreshes) are evicted once the cache exceeds max_mb.
+    """
+    def __init__(self, path='data/weight-cache/', max_mb=1024):
+        self.path = path
+        self.max_bytes = max_mb * 2**20
+        self.hits, self.misses = 0, 0
+        self._size = None # bytes on disk, scanned once then tracked by put (rescanned when evicting)
+        os.makedirs(path, exist_ok=True)
+
+    @staticmethod
+    def key(image, spec):
+        """sha1 of the image (bytes, shape and dtype) and the spec (a json serialisable dict)"""
+        if isinstance(image, torch.Tensor):
+            image = image.detach().cpu().numpy()
+        image = np.ascontiguousarray(image)
+        sha = hashlib.sha1(image.tobytes())
+        sha.update(f'{image.shape}{image.dtype.str}'.encode())
+        sha.update(json.dumps(spec, sort_keys=True).encode())
+        return sha.hexdigest()
+
+    def _file(self, key):
+        return os.path.join(self.path, key[:2], key + '.npz')
+
+    def get(self, key):
+        """The cached weights (numpy, scipy.sparse or torch as they were put) or None"""
+        file = self._file(key)
+        if not os.path.isfile(file):
+            self.misses += 1
+            return None
+        os.utime(file) # most recently used
+        self.hits += 1
+        with np.load(file) as entry:
+            if 'format' in entry.files: # written by scipy.sparse.save_npz
+                return scipy.sparse.load_npz(file)
+            if 'index' in entry.files:
+                W = np.zeros(entry['shape'], dtype=entry['values'].dtype)
+                W.flat[entry['index']] = entry['values']
+            else:
+                W = entry['W']
+            return torch.from_numpy(W) if entry['torch'] else W
+
+    def put(self, key, W):
+        """Stores the weights W (numpy, scipy.sparse or torch), then evicts down to max_mb"""
+        file = self._file(key)
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        tmp = file + '.tmp' # not an entry until renamed
+        with open(tmp, 'wb') as fp:
+            if scipy.sparse.issparse(W):
+                scipy.sparse.save_npz(fp, W)
+            else:
+                is_torch = isinstance(W, torch.Tensor)
+                W = W.detach().cpu().numpy() if is_torch else np.asarray(W)
+                index = np.flatnonzero(W)
+                index = index.astype(np.int32) if W.size < 2**31 else index
+                if index.nbytes + index.size * W.itemsize < W.nbytes // 4:
+                    np.savez(fp, index=index, values=W.flat[index], shape=W.shape, torch=is_torch)
+                else:
+                    np.savez_compressed(fp, W=W, torch=is_torch)
+        os.replace(tmp, file) # atomic, so readers never see a partial entry
+        if self._size is None:
+            self._size = self._scan()[1]
+        else:
+            self._size += os.path.getsize(file)
+        if self._size > self.max_bytes:
+            self.evict()
+
+    def _scan(self):
+        """(modification time, size, file) of every entry and their total size"""
+        entries = [entry for dir in os.scandir(self.path) if dir.is_dir() for entry in os.scandir(dir.path) if entry.name.endswith('.npz')]
+        entries = [(entry.stat().st_mtime, entry.stat().st_size, entry.path) for entry in entries]
+        return entries, sum(size for _, size, _ in entries)
+
+    def evict(self):
+        """Removes the least recently used entries until the cache is within max_mb"""
+        entries, total = self._scan() # other processes may share the cache, so not the tracked size
+        for _, size, file in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(file)
+            except FileNotFoundError: # removed by another process
+                pass
+            total -= size
+        self._size = total
+
+    def get_or_compute(self, image, spec, func):
+        """The weights of image, from the cache or computed as func(image) and cached"""
+        key = self.key(image, spec)
+        W = self.get(key)
+        if W is None:
+            W = func(image)
+            self.put(key, W)
+        return W
+
+if __name__ == '__main__':
+    import tempfile, time
+    from nc_suite import weights_2
+
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as dir:
+        cache = WeightCache(dir, max_mb=1)
+        img = rng.random((16, 16))
+        spec = {'func': 'weights_2', 'r': 3}
+        W = cache.get_or_compute(img, spec, lambda img: weights_2(img, r=3))
+        W_cached = cache.get_or_compute(img.copy(), spec, lambda img: None)
+        print(f'cached weights consistent: {np.array_equal(W, W_cached)}, hits {cache.hits}, misses {cache.misses}')
+        print(f'different spec is a different entry: {cache.key(img, spec) != cache.key(img, {**spec, "r": 2})}')
+        W_sparse = cache.get_or_compute(img, {**spec, 'sparse': True}, lambda img: weights_2(img, r=3, sparse=True))
+        print(f'sparse round trip: {np.array_equal(cache.get(cache.key(img, {**spec, "sparse": True})).toarray(), W)}')
+        W_torch = cache.get_or_compute(torch.from_numpy(img), {**spec, 'torch': True}, lambda img: weights_2(img, r=3))
+        print(f'torch round trip: {torch.equal(cache.get(cache.key(img, {**spec, "torch": True})), W_torch)}')
+
+        W_full = rng.random((64, 64))
+        print(f'dense round trip: {np.array_equal(cache.get_or_compute(W_full, {"func": "identity"}, lambda img: img), cache.get(cache.key(W_full, {"func": "identity"})))}')
+
+        # dense 256x256 float64 entries are well under 1MB each, fill past max_mb and check the oldest go first
+        first = cache.key(img, spec)
+        for i in range(40):
+            time.sleep(0.01) # distinct modification times
+            cache.get_or_compute(rng.random((16, 16)), spec, lambda img: weights_2(img, r=3))
+        size = sum(entry.stat().st_size for dir in os.scandir(cache.path) for entry in os.scandir(dir.path))
+        print(f'evicted to within max_mb: {size <= cache.max_bytes}, least recently used evicted: {cache.get(first) is None}')